@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Microbenchmark: ranking friends by distance with the scalar getMiles() loop
+(what index() used to do) against the vectorized distance.nearest().
+
+        python benchmarks/bench_distance.py
+        python benchmarks/bench_distance.py --sizes 10,1000,100000 --repeat 5
+"""
+
+import os
+import random
+import sys
+import timeit
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from distance import getMiles, nearest  # noqa: E402
+
+
+def scalar_rank(home, rows):
+    data = list()
+    for row in rows:
+        distance = getMiles(home[0], home[1], row[2], row[3])
+        data.append([row[0], row[1], distance])
+    return sorted(data, key=lambda x: x[2])
+
+
+def vector_rank(home, rows):
+    order, miles = nearest(home[0], home[1], [row[2] for row in rows],
+                           [row[3] for row in rows])
+    miles = miles.tolist()
+    return [[rows[i][0], rows[i][1], miles[i]] for i in order.tolist()]
+
+
+def make_rows(n, rng):
+    # same shape as the index() friends query: name, location, lat, long
+    return [('friend%d' % i, 'place%d' % i, rng.uniform(-90, 90),
+             rng.uniform(-180, 180)) for i in range(n)]
+
+
+@click.command()
+@click.option('--sizes', default='10,1000,100000')
+@click.option('--repeat', default=5, type=int)
+@click.option('--seed', default=4111, type=int)
+def main(sizes, repeat, seed):
+    rng = random.Random(seed)
+    home = (40.8075, -73.9626)
+    print("%10s %14s %14s %9s" % ('friends', 'getMiles (ms)',
+                                  'nearest (ms)', 'speedup'))
+    for n in [int(x) for x in sizes.split(',')]:
+        rows = make_rows(n, rng)
+        expected = [r[2] for r in scalar_rank(home, rows)]
+        got = [r[2] for r in vector_rank(home, rows)]
+        assert max([abs(a - b) for a, b in zip(expected, got)] or [0]) <= 0.01
+
+        number = max(1, 100000 // n)
+        scalar = min(timeit.repeat(lambda: scalar_rank(home, rows),
+                                   number=number, repeat=repeat)) / number
+        vector = min(timeit.repeat(lambda: vector_rank(home, rows),
+                                   number=number, repeat=repeat)) / number
+        print("%10d %14.3f %14.3f %8.1fx" % (n, scalar * 1e3, vector * 1e3,
+                                            scalar / vector))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Benchmark for the in-memory friend graph (graph.py) on a synthetic graph:
+bulk build, mutual-friend counts, friend-of-friend suggestions for typical
+and for the most popular users, and edge patches, plus the memory it takes.
+
+        python benchmarks/bench_graph.py
+        python benchmarks/bench_graph.py --users 100000 --edges 2000000
+
+Defaults to 1M users and 50M edges (about 1.5GB of scratch memory while
+generating; the graph itself takes about 220MB). Targets are skewed towards
+low uids, so there are popular users with tens of thousands of followers.
+"""
+
+import timeit
+
+import click
+import numpy as np
+
+import common  # noqa: F401 (puts the webserver directory on sys.path)
+from common import best_of, report
+from graph import FriendGraph
+
+
+def synthetic(users, edges, rng):
+    """edges distinct (uid, uid_2) pairs, uids 1..users, no self loops."""
+    sources = rng.integers(1, users + 1, edges, dtype=np.int64)
+    targets = 1 + np.floor(users * rng.random(edges) ** 2).astype(np.int64)
+    keys = np.unique(sources << 32 | targets)
+    keys = keys[(keys >> 32) != (keys & 0xffffffff)]
+    return keys >> 32, keys & 0xffffffff
+
+
+@click.command()
+@click.option('--users', default=1000000)
+@click.option('--edges', default=50000000)
+@click.option('--queries', default=1000, help='users sampled per query type')
+@click.option('--repeat', default=3)
+@click.option('--seed', default=1)
+def main(users, edges, queries, repeat, seed):
+    rng = np.random.default_rng(seed)
+    print("generating %d users / %d edges" % (users, edges))
+    sources, targets = synthetic(users, edges, rng)
+    graph = FriendGraph()
+    start = timeit.default_timer()
+    graph.build(sources, targets)
+    build = timeit.default_timer() - start
+    graph.loaded = True
+    del sources, targets
+
+    sample = rng.integers(1, users + 1, queries).tolist()
+    others = rng.integers(1, users + 1, queries).tolist()
+    degree = np.diff(graph.indptr)
+    popular = graph.ids[np.argsort(-degree)[:10]].tolist()
+
+    def each(fn, uids):
+        return lambda: [fn(uid) for uid in uids]
+
+    rows = [('bulk build (s)', '%.1f' % build)]
+    for name, fn, uids in [
+            ('friends', graph.friends, sample),
+            ('mutual count', lambda u: graph.mutual(u, others[u % queries]),
+             sample),
+            ('2-hop suggestions', graph.suggestions, sample),
+            ('2-hop, most friends', graph.suggestions, popular)]:
+        t = best_of(each(fn, uids), repeat) / len(uids)
+        rows.append((name + ' (us)', '%.1f' % (t * 1e6)))
+
+    pairs = rng.integers(1, users + 1, (queries, 2)).tolist()
+    add = best_of(lambda: [graph.add(a, b) for a, b in pairs], 1) / queries
+    patched = best_of(each(graph.suggestions, sample), repeat) / queries
+    remove = best_of(lambda: [graph.remove(a, b) for a, b in pairs],
+                     1) / queries
+    for a, b in pairs:
+        graph.add(a, b)
+    merge = best_of(graph.merge, 1)
+    rows.extend([('add edge (us)', '%.1f' % (add * 1e6)),
+                 ('2-hop with overlay (us)', '%.1f' % (patched * 1e6)),
+                 ('remove edge (us)', '%.1f' % (remove * 1e6)),
+                 ('overlay merge (s)', '%.1f' % merge),
+                 ('graph memory (MB)', '%.0f' % (graph.nbytes / 1e6))])
+    report(rows, ('operation', 'time'))
+
+
+if __name__ == "__main__":
+    main()
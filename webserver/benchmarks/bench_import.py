@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Benchmark for python server.py import: loading locations with bulk.py
+(COPY into a staging table, one merge per chunk) against one ADD_LOCATION
+INSERT per row, as /locationaddreq does.
+
+        python benchmarks/bench_import.py --uri postgresql://localhost/bench
+
+Defaults to a 500k row CSV file; the per-row path is timed on --sample
+rows and reported in rows/s like the rest.
+"""
+
+import io
+import timeit
+
+import click
+from sqlalchemy import text
+
+from common import report, scratch_schema
+import bulk
+import leaderboard
+import migrations
+
+SEED = '''CREATE TABLE location (lid serial PRIMARY KEY, gps_lat real,
+    gps_long real, name text, description text, country text);'''
+
+
+def make_csv(rows, bad_every):
+    f = io.StringIO()
+    f.write('name,gps_lat,gps_long,description,country\n')
+    for i in range(rows):
+        lat = 200 if bad_every and i % bad_every == 0 else i % 180 - 90
+        f.write('place %d,%s,%s,"a ""quoted"", description",country %d\n' % (
+            i, lat, i % 360 - 180, i % 200))
+    f.seek(0)
+    return f
+
+
+def rate(rows, seconds):
+    return '%.0f' % (rows / seconds)
+
+
+@click.command()
+@click.option('--uri', required=True, help='PostgreSQL database to use')
+@click.option('--rows', default=500000)
+@click.option('--sample', default=5000, help='rows for the per-row path')
+@click.option('--chunk', default=bulk.CHUNK)
+@click.option('--bad-every', default=1000, help='one invalid row per N')
+def main(uri, rows, sample, chunk, bad_every):
+    with scratch_schema(uri) as conn:
+        conn.execute(text(SEED))
+        migrations.apply(conn, 1)  # with the summary rows of new locations
+
+        records = list(bulk.records(make_csv(sample, 0), 'csv'))
+        start = timeit.default_timer()
+        for record in records:
+            with conn.begin():
+                leaderboard.ADD_LOCATION.execute(
+                    conn, lat=record['gps_lat'], lng=record['gps_long'],
+                    name=record['name'] + ' (row)',
+                    desc=record['description'],
+                    country=record['country']).close()
+        per_row = timeit.default_timer() - start
+
+        progress = bulk.import_file(conn, bulk.LOCATION,
+                                    make_csv(rows, bad_every), chunk=chunk)
+        copy = timeit.default_timer() - progress.started
+        print(progress)
+
+        # every row is a duplicate the second time
+        again = bulk.import_file(conn, bulk.LOCATION,
+                                 make_csv(rows, bad_every), chunk=chunk)
+        rerun = timeit.default_timer() - again.started
+
+        out = io.StringIO()
+        start = timeit.default_timer()
+        bulk.export(conn, bulk.LOCATION.export, out)
+        exported = timeit.default_timer() - start
+
+        report([('INSERT per row (%d rows)' % sample, rate(sample, per_row)),
+                ('COPY + merge (%d rows)' % rows, rate(rows, copy)),
+                ('COPY, all duplicates', rate(rows, rerun)),
+                ('export, CSV', rate(rows + sample, exported))],
+               ('path', 'rows/s'))
+
+
+if __name__ == "__main__":
+    main()
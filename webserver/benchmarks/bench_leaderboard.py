@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Benchmark for the /location leaderboard: the old LOCATION LEFT JOIN REVIEWS
+aggregate against the maintained LOCATION_RATING summary, both for the
+first page of rows, and the whole page through the Flask test client:
+rendered (cold), from the rendered page cache (warm) and as a 304 for a
+matching If-None-Match (httpcache). Run it from the webserver directory
+(it imports server.py for the route):
+
+        python benchmarks/bench_leaderboard.py --uri postgresql://localhost/bench
+
+Defaults to 100k locations and 10M reviews (seeding takes a few minutes).
+"""
+
+import random
+
+import click
+from sqlalchemy import text
+from werkzeug.datastructures import MultiDict
+
+from common import best_of, report, scratch_engine, scratch_schema
+import httpcache
+import jobs
+import leaderboard
+import migrations
+import pagination
+import replicas
+import server
+import versions
+
+# the old query, cut to the rows of one page
+OLD_QUERY = '''SELECT max(lid), max(gps_lat), max(gps_long), max(name),
+    max(description), max(country),  AVG(coalesce(rating, 0)) AS avg from
+    (SELECT location.lid, gps_lat, gps_long, name, description, country,
+    rating FROM Location left Join Reviews on location.lid = reviews.lid)
+    as f group by lid order by avg DESC LIMIT %d;''' % (
+    pagination.DEFAULT_PAGE_SIZE)
+
+SEED = '''CREATE TABLE location (lid serial PRIMARY KEY, gps_lat real,
+    gps_long real, name text, description text, country text);
+CREATE TABLE reviews (rating integer, comment text, uid integer,
+    lid integer REFERENCES location(lid));
+INSERT INTO location(gps_lat, gps_long, name, description, country)
+    SELECT random() * 180 - 90, random() * 360 - 180, 'place ' || i,
+        'description ' || i, 'country ' || (i % 200)
+    FROM generate_series(1, :locations) AS i;
+INSERT INTO reviews
+    SELECT 1 + (random() * 4)::int, 'comment', (random() * 100000)::int,
+        1 + floor(:locations * power(random(), 2))::int
+    FROM generate_series(1, :reviews);
+ANALYZE location; ANALYZE reviews;'''
+
+
+def fetch(conn, cmd):
+    res = conn.execute(text(cmd))
+    rows = res.fetchall()
+    res.close()
+    return rows
+
+
+def serve_from(engine):
+    """Points server.py's requests (and versions.py) at engine."""
+    server.ROUTER = replicas.Router(engine)
+    versions.configure(engine)
+    jobs.QUEUE = None
+
+
+def get(client, status, **headers):
+    response = client.get('/location', headers=headers)
+    assert response.status_code == status, response.status_code
+    return response
+
+
+@click.command()
+@click.option('--uri', required=True, help='PostgreSQL database to use')
+@click.option('--locations', default=100000)
+@click.option('--reviews', default=10000000)
+@click.option('--repeat', default=3)
+def main(uri, locations, reviews, repeat):
+    with scratch_schema(uri) as conn:
+        print("seeding %d locations / %d reviews" % (locations, reviews))
+        conn.execute(text(SEED), locations=locations, reviews=reviews)
+        build = best_of(lambda: migrations.apply(conn, 1), repeat=1)
+        migrations.apply(conn, 9)  # data_version, for the page cache
+
+        old = best_of(lambda: fetch(conn, OLD_QUERY), repeat)
+        new = best_of(lambda: list(leaderboard.LEADERBOARD.page(
+            conn, MultiDict())), repeat)
+        assert len(fetch(conn, OLD_QUERY)) == len(list(
+            leaderboard.LEADERBOARD.page(conn, MultiDict())))
+
+        engine = scratch_engine(uri)
+        serve_from(engine)
+        client = server.app.test_client()
+
+        def cold():
+            httpcache.PAGES.clear()
+            get(client, 200)
+        rendered = best_of(cold, repeat)
+        etag = get(client, 200).headers['ETag']
+        warm = best_of(lambda: get(client, 200), repeat, number=100)
+        not_modified = best_of(
+            lambda: get(client, 304, **{'If-None-Match': etag}),
+            repeat, number=100)
+        engine.dispose()
+
+        def add_review():
+            with conn.begin():
+                leaderboard.ADD_REVIEW.execute(
+                    conn, lid=random.randint(1, locations), rating=4)
+        write = best_of(add_review, repeat, number=100)
+
+        report([('aggregate over reviews, first page (old)',
+                 '%.1f' % (old * 1e3)),
+                ('summary, first page', '%.1f' % (new * 1e3)),
+                ('GET /location, rendered', '%.1f' % (rendered * 1e3)),
+                ('GET /location, cached page', '%.2f' % (warm * 1e3)),
+                ('GET /location, 304', '%.2f' % (not_modified * 1e3)),
+                ('summary upsert per review', '%.3f' % (write * 1e3)),
+                ('one-off backfill', '%.1f' % (build * 1e3))],
+               ('path', 'ms'))
+
+
+if __name__ == "__main__":
+    main()
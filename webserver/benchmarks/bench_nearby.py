@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Benchmark for /nearby: radius queries against the spatial.GridIndex versus
+a brute-force getMiles() scan over every location.
+
+        python benchmarks/bench_nearby.py
+        python benchmarks/bench_nearby.py --locations 1000000 --radius 50
+"""
+
+import random
+
+import click
+
+from common import best_of, report
+from distance import getMiles
+import spatial
+
+
+def brute_force(points, lat, lng, radius):
+    hits = list()
+    for lid, plat, plng in points:
+        miles = getMiles(lat, lng, plat, plng)
+        if miles <= radius:
+            hits.append([lid, miles])
+    return sorted(hits, key=lambda x: (x[1], x[0]))
+
+
+@click.command()
+@click.option('--locations', default=1000000)
+@click.option('--radius', default='10,50,500')
+@click.option('--queries', default=20)
+@click.option('--cell', default=1.0, help='grid cell size in degrees')
+@click.option('--seed', default=4111)
+def main(locations, radius, queries, cell, seed):
+    rng = random.Random(seed)
+    points = [(i, rng.uniform(-60, 70), rng.uniform(-180, 180))
+              for i in range(locations)]
+    index = spatial.GridIndex(cell)
+    index.loaded = True
+    build = best_of(lambda: [index._add(*p) for p in points], repeat=1)
+    probes = [(rng.uniform(-60, 70), rng.uniform(-180, 180))
+              for _ in range(queries)]
+
+    rows = list()
+    for r in [float(x) for x in radius.split(',')]:
+        lat, lng = probes[0]
+        assert (sorted(h[0] for h in brute_force(points, lat, lng, r)) ==
+                sorted(h[0] for h in index.within(lat, lng, r)))
+        brute = best_of(lambda: brute_force(points, lat, lng, r), repeat=1)
+        grid = best_of(lambda: [index.within(la, ln, r)
+                                for la, ln in probes], repeat=3) / queries
+        rows.append((r, '%.1f' % (brute * 1e3), '%.3f' % (grid * 1e3),
+                     '%.0fx' % (brute / grid)))
+    print("%d locations, index built in %.1f s" % (locations, build))
+    report(rows, ('radius (mi)', 'getMiles scan (ms)', 'grid (ms)',
+                  'speedup'))
+
+
+if __name__ == "__main__":
+    main()
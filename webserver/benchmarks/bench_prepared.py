@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Benchmark for the named queries (queries.py) behind the hot routes: the
+same statement sent as text() on every call against PREPARE once and
+EXECUTE from then on, on one connection. Run it from the webserver
+directory (it imports server.py for the route queries) against a database
+filled by seed.py:
+
+        python benchmarks/seed.py --uri postgresql://localhost/travel --users 100000 --create
+        python benchmarks/bench_prepared.py --uri postgresql://localhost/travel --users 100000
+
+The planning and execution time the server reports for one run of each
+statement (EXPLAIN ANALYZE) is printed as well, to show how much of a call
+is parse/plan work that a prepared statement can skip.
+"""
+
+import random
+import re
+
+import click
+from sqlalchemy import create_engine, text
+
+from common import best_of, report
+import migrations
+import queries
+import server  # noqa: F401 (declares the route queries)
+
+TIMING = re.compile(r'(Planning|Execution) Time: ([\d.]+) ms')
+
+
+def hot_queries(rng, users):
+    """(query name, function returning fresh parameters) per hot route."""
+    uid = lambda: rng.randint(1, users)
+    return [
+        ('profile_friends', lambda: dict(uid=uid())),
+        ('profile_activities', lambda: dict(uid=uid())),
+        ('other_activities', lambda: dict(uid=uid())),
+        ('user_names', lambda: dict(uids=[uid() for _ in range(20)])),
+        ('trips', lambda: dict(uid=uid())),
+        ('login', lambda: dict(username='user%d@example.com' % uid(),
+                               password='password')),
+        ('leaderboard_first', lambda: dict(limit=26)),
+        ('reviews_first', lambda: dict(limit=26)),
+        ('rentals_first', lambda: dict(uid=uid(), limit=26)),
+        ('requests_first', lambda: dict(uid=uid(), limit=26)),
+    ]
+
+
+def drain(res):
+    res.fetchall()
+    res.close()
+
+
+def explain(conn, sql, params):
+    """(planning ms, execution ms) the server reports for one run."""
+    res = conn.execute(text('EXPLAIN (ANALYZE) ' + sql), **params)
+    timings = dict(TIMING.findall('\n'.join(row[0] for row in res)))
+    return (float(timings.get('Planning', 0)),
+            float(timings.get('Execution', 0)))
+
+
+@click.command()
+@click.option('--uri', required=True, help='seeded PostgreSQL database')
+@click.option('--users', default=1000, help='--users given to seed.py')
+@click.option('--calls', default=200, help='calls per query and mode')
+@click.option('--seed', default=4111)
+def main(uri, users, calls, seed):
+    rng = random.Random(seed)
+    engine = create_engine(uri)
+    conn = engine.connect()
+    migrations.apply(conn, 1)
+    rows = list()
+    for name, params in hot_queries(rng, users):
+        query = queries.REGISTRY[name]
+        plan, execute = explain(conn, query.sql, params())
+        unprepared = best_of(lambda: drain(conn.execute(query.text,
+                                                        **params())),
+                             repeat=3, number=calls)
+        conn.info.pop('prepared_queries', None)
+        conn.execute(text('DEALLOCATE ALL'))
+        first = best_of(lambda: drain(query.execute(conn, **params())),
+                        repeat=1)
+        prepared = best_of(lambda: drain(query.execute(conn, **params())),
+                           repeat=3, number=calls)
+        rows.append((name, '%.2f' % plan, '%.2f' % execute,
+                     '%.3f' % (unprepared * 1e3), '%.3f' % (first * 1e3),
+                     '%.3f' % (prepared * 1e3),
+                     '%.2fx' % (unprepared / prepared)))
+    report(rows, ('query', 'plan ms', 'exec ms', 'text() ms',
+                  'PREPARE+1st ms', 'EXECUTE ms', 'speedup'))
+    conn.close()
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
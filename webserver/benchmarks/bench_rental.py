@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Benchmark for rental availability: the "leases free between D1 and D2"
+page and the overlap check in /rentalreq, with and without the GiST date
+range index and the per-property request index from rentals.py
+(migration 2).
+
+        python benchmarks/bench_rental.py --uri postgresql://localhost/bench --leases 2000000
+"""
+
+import datetime
+import random
+
+import click
+from sqlalchemy import text
+from werkzeug.datastructures import MultiDict
+
+from common import best_of, report, scratch_schema
+import migrations
+import rentals
+
+SEED = '''CREATE TABLE rental_lease (owner integer, address text,
+    start_date date, end_date date, price numeric,
+    PRIMARY KEY (owner, address, start_date));
+CREATE TABLE rental_request (requester integer, address text, owner integer,
+    comment text, start_date date, end_data date);
+INSERT INTO rental_lease
+    SELECT i % 100000, i || ' Main St', d, d + (2 + (random() * 28)::int),
+        100
+    FROM (SELECT i, CURRENT_DATE + (random() * 3650)::int AS d
+          FROM generate_series(1, :leases) AS i) AS l;
+INSERT INTO rental_request
+    SELECT (random() * 100000)::int, address, owner, 'hi', start_date,
+        end_date
+    FROM rental_lease WHERE random() < 0.5;
+ANALYZE rental_lease; ANALYZE rental_request;'''
+
+CONFLICT = '''SELECT 1 FROM rental_request WHERE owner = :owner
+    AND address = :address AND daterange(start_date, end_data, '[]') &&
+        daterange(CAST(:start AS date), CAST(:end AS date), '[]')'''
+
+
+@click.command()
+@click.option('--uri', required=True, help='PostgreSQL database to use')
+@click.option('--leases', default=2000000)
+@click.option('--repeat', default=5)
+def main(uri, leases, repeat):
+    rng = random.Random(4111)
+    with scratch_schema(uri) as conn:
+        print("seeding %d leases" % leases)
+        conn.execute(text(SEED), leases=leases)
+
+        def window():
+            day = datetime.date.today() + datetime.timedelta(
+                rng.randint(0, 3600))
+            return day, day + datetime.timedelta(3)
+
+        def search():
+            start, end = window()
+            list(rentals.AVAILABLE.page(conn, MultiDict(), uid=-1,
+                                        start=start, end=end))
+
+        def conflict():
+            i = rng.randint(1, leases)
+            start, end = window()
+            conn.execute(text(CONFLICT), owner=i % 100000,
+                         address='%d Main St' % i, start=start,
+                         end=end).fetchall()
+
+        rows = list()
+        scan = (best_of(search, repeat), best_of(conflict, repeat))
+        migrations.apply(conn, 2)
+        conn.execute(text('ANALYZE rental_lease; ANALYZE rental_request'))
+        indexed = (best_of(search, repeat), best_of(conflict, repeat))
+        for name, before, after in zip(('available D1..D2, first page',
+                                        'overlapping request check'),
+                                       scan, indexed):
+            rows.append((name, '%.2f' % (before * 1e3),
+                         '%.3f' % (after * 1e3), '%.0fx' % (before / after)))
+        report(rows, ('query', 'no index (ms)', 'indexed (ms)', 'speedup'))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Benchmark for /search: a sequential ILIKE '%word%' scan of the three tables
+against the full-text query over their GIN indexes (search.py), and name
+completion by ILIKE against the prefix index.
+
+        python benchmarks/bench_search.py --uri postgresql://localhost/bench
+
+Defaults to 1M locations, 100k activities and 5M reviews.
+"""
+
+import click
+from sqlalchemy import text
+
+from common import best_of, report, scratch_schema
+import migrations
+import search
+
+WORDS = ['harbor', 'museum', 'mountain', 'beach', 'garden', 'castle',
+         'market', 'river', 'bridge', 'temple', 'island', 'valley']
+
+SEED = '''CREATE TABLE location (lid serial PRIMARY KEY, gps_lat real,
+    gps_long real, name text, description text, country text);
+CREATE TABLE activity (name text PRIMARY KEY, description text);
+CREATE TABLE reviews (rating integer, comment text, uid integer,
+    lid integer REFERENCES location(lid));
+CREATE TEMPORARY TABLE words AS
+    SELECT CAST(:words AS text[]) AS w, array_length(CAST(:words AS text[]),
+        1) AS n;
+INSERT INTO location(gps_lat, gps_long, name, description, country)
+    SELECT random() * 180 - 90, random() * 360 - 180,
+        w[1 + i % n] || ' ' || i, 'near the ' || w[1 + (i / 7) % n],
+        'country ' || (i % 200)
+    FROM generate_series(1, :locations) AS i, words;
+INSERT INTO activity
+    SELECT w[1 + i % n] || ' tour ' || i, 'visit a ' || w[1 + (i / 3) % n]
+    FROM generate_series(1, :activities) AS i, words;
+INSERT INTO reviews
+    SELECT 1 + (random() * 4)::int,
+        'the ' || w[1 + i % n] || ' was lovely, ' || w[1 + (i / 11) % n],
+        (random() * 100000)::int, 1 + floor(:locations * random())::int
+    FROM generate_series(1, :reviews) AS i, words;
+ANALYZE location; ANALYZE activity; ANALYZE reviews;'''
+
+ILIKE = '''(SELECT 'location', lid, name, country FROM location
+        WHERE name ILIKE :pattern OR description ILIKE :pattern
+            OR country ILIKE :pattern LIMIT :limit)
+    UNION ALL (SELECT 'activity', NULL, name, description FROM activity
+        WHERE name ILIKE :pattern OR description ILIKE :pattern
+        LIMIT :limit)
+    UNION ALL (SELECT 'review', lid, NULL, comment FROM reviews
+        WHERE comment ILIKE :pattern LIMIT :limit)'''
+
+ILIKE_PREFIX = '''(SELECT name FROM location WHERE name ILIKE :pattern
+        ORDER BY name LIMIT :limit)
+    UNION (SELECT name FROM activity WHERE name ILIKE :pattern
+        ORDER BY name LIMIT :limit)'''
+
+
+def fetch(conn, cmd, **params):
+    res = conn.execute(text(cmd), **params)
+    rows = res.fetchall()
+    res.close()
+    return rows
+
+
+@click.command()
+@click.option('--uri', required=True, help='PostgreSQL database to use')
+@click.option('--locations', default=1000000)
+@click.option('--activities', default=100000)
+@click.option('--reviews', default=5000000)
+@click.option('--repeat', default=3)
+def main(uri, locations, activities, reviews, repeat):
+    with scratch_schema(uri) as conn:
+        print("seeding %d locations / %d activities / %d reviews" % (
+            locations, activities, reviews))
+        conn.execute(text(SEED), words=WORDS, locations=locations,
+                     activities=activities, reviews=reviews)
+        build = best_of(lambda: migrations.apply(conn, 6), repeat=1)
+
+        rows = list()
+        for q in ('castle', 'harbor mus', 'lovely riv'):
+            pattern = '%%%s%%' % q.split()[0]
+            scan = best_of(lambda: fetch(conn, ILIKE, pattern=pattern,
+                                         limit=20), repeat)
+            fts = best_of(lambda: search.search(conn, q), repeat)
+            rows.append(('"%s"' % q, '%.1f' % (scan * 1e3),
+                         '%.1f' % (fts * 1e3)))
+        for prefix in ('cas', 'harbor 12'):
+            scan = best_of(lambda: fetch(conn, ILIKE_PREFIX,
+                                         pattern=prefix + '%', limit=10),
+                           repeat)
+            index = best_of(lambda: search.suggest(conn, prefix), repeat)
+            rows.append(('suggest "%s"' % prefix, '%.1f' % (scan * 1e3),
+                         '%.1f' % (index * 1e3)))
+        report(rows, ('query', 'ILIKE ms', 'index ms'))
+        print("index build: %.1f s" % build)
+
+
+if __name__ == "__main__":
+    main()
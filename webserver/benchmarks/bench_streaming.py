@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Benchmark for streamed list pages (streaming.py) on /reviews: the whole
+review list fetched into a list and rendered into one string, against the
+same list read through a server-side cursor and rendered as a generator.
+Reports time to the first chunk, total time and peak Python memory
+(tracemalloc). Run it from the webserver directory (it imports server.py
+for the route query and templates):
+
+        python benchmarks/bench_streaming.py --uri postgresql://localhost/bench --reviews 1000000
+"""
+
+import timeit
+import tracemalloc
+
+import click
+from flask import render_template
+from sqlalchemy import text
+from werkzeug.datastructures import MultiDict
+
+from common import report, scratch_schema
+import server
+import streaming
+
+SEED = '''CREATE TABLE location (lid serial PRIMARY KEY, gps_lat real,
+    gps_long real, name text, description text, country text);
+CREATE TABLE users (uid serial PRIMARY KEY, name text);
+CREATE TABLE reviews (rating integer, comment text, uid integer,
+    lid integer);
+INSERT INTO location(name) SELECT 'place ' || i
+    FROM generate_series(1, 1000) AS i;
+INSERT INTO users(name) SELECT 'user ' || i
+    FROM generate_series(1, :users) AS i;
+INSERT INTO reviews
+    SELECT 1 + (random() * 4)::int, 'comment number ' || i,
+        1 + (random() * (:users - 1))::int, 1 + (random() * 999)::int
+    FROM generate_series(1, :reviews) AS i;
+ANALYZE location; ANALYZE users; ANALYZE reviews;'''
+
+
+def measure(fn):
+    """(first chunk seconds, total seconds, peak MB) of iterating fn()."""
+    tracemalloc.start()
+    start = timeit.default_timer()
+    first = None
+    for chunk in fn():
+        if first is None:
+            first = timeit.default_timer() - start
+    total = timeit.default_timer() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return first, total, peak / 1e6
+
+
+@click.command()
+@click.option('--uri', required=True, help='PostgreSQL database to use')
+@click.option('--reviews', default=1000000)
+@click.option('--users', default=100000)
+def main(uri, reviews, users):
+    with scratch_schema(uri) as conn:
+        print("seeding %d reviews" % reviews)
+        conn.execute(text(SEED), users=users, reviews=reviews)
+
+        def buffered():
+            # every row in a list, then the page as one string
+            page = server.REVIEWS.page(conn, MultiDict(), stream=True)
+            rows = list(page)
+            yield render_template('reviews.html', reviews=rows, page=page)
+
+        def streamed():
+            page = server.REVIEWS.page(conn, MultiDict(), stream=True)
+            response = streaming.render('reviews.html', reviews=page,
+                                        page=page)
+            for chunk in response.response:
+                yield chunk
+
+        rows = list()
+        for name, fn in (('buffered', buffered), ('streamed', streamed)):
+            with server.app.test_request_context('/reviews?stream=1'):
+                first, total, peak = measure(fn)
+            rows.append((name, '%.1f' % (first * 1e3), '%.1f' % total,
+                         '%.1f' % peak))
+        report(rows, ('%d reviews' % reviews, 'first chunk ms', 'total s',
+                      'peak MB'))
+
+
+if __name__ == "__main__":
+    main()
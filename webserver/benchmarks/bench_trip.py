@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Benchmark for the "already reviewed" flag on /trip: the old scan of every
+review row per previous trip against the hashed lid set trip() uses now.
+
+        python benchmarks/bench_trip.py --sizes 100,1000,5000
+"""
+
+import random
+
+import click
+
+from common import best_of, report
+
+
+def nested_loop(previous_trips, rows):
+    out = list()
+    for trip in previous_trips:
+        exists = False
+        for row in rows:
+            if(trip[4] == row[0]):
+                exists = True
+        out.append(list(trip) + [exists])
+    return out
+
+
+def lid_set(previous_trips, rows):
+    reviewed = set(row[0] for row in rows)
+    return [list(trip) + [trip[4] in reviewed] for trip in previous_trips]
+
+
+@click.command()
+@click.option('--sizes', default='100,1000,5000',
+              help='previous trips (and as many reviews) per user')
+@click.option('--seed', default=4111)
+def main(sizes, seed):
+    rng = random.Random(seed)
+    results = list()
+    for n in [int(x) for x in sizes.split(',')]:
+        trips = [(i, '2018-01-01', '2018-01-05', 'place', rng.randint(1, 2 * n))
+                 for i in range(n)]
+        reviews = [[rng.randint(1, 2 * n)] for _ in range(n)]
+        assert nested_loop(trips, reviews) == lid_set(trips, reviews)
+        old = best_of(lambda: nested_loop(trips, reviews), repeat=3)
+        new = best_of(lambda: lid_set(trips, reviews), repeat=3)
+        results.append((n, '%.2f' % (old * 1e3), '%.3f' % (new * 1e3),
+                        '%.0fx' % (old / new)))
+    report(results, ('trips', 'nested loop (ms)', 'lid set (ms)', 'speedup'))
+
+
+if __name__ == "__main__":
+    main()
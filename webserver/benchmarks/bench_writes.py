@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Concurrency benchmark for the write paths: many users creating trips at
+once with the old "INSERT INTO trip ...; INSERT INTO USER_TRIP SELECT :uid,
+max(id) from trip" statement and with writes.CREATE_TRIP (INSERT ...
+RETURNING), counting trips that end up lost or attached to the wrong user.
+Also times adding friends one request at a time against one bulk request.
+
+        python benchmarks/bench_writes.py --uri postgresql://localhost/bench --users 32 --trips 200
+"""
+
+import threading
+import timeit
+
+import click
+from sqlalchemy import text
+
+from common import report, scratch_engine, scratch_schema
+import writes
+
+SCHEMA = '''CREATE TABLE trip (id serial PRIMARY KEY, start_date date,
+    end_date date, lid integer);
+CREATE TABLE user_trip (user_id integer, trip_id integer,
+    PRIMARY KEY (user_id, trip_id));
+CREATE TABLE user_friends (uid integer, uid_2 integer,
+    PRIMARY KEY (uid, uid_2));'''
+
+OLD_TRIP = '''INSERT INTO trip(start_date, end_date, lid)
+    VALUES (:start, :end, :location);\
+    INSERT INTO USER_TRIP SELECT :uid, max(id) from trip;'''
+
+# every user marks their trips with lid = uid, so a trip belongs to the
+# wrong user exactly when user_id <> lid
+CHECK = '''SELECT
+    (SELECT count(*) FROM trip) AS trips,
+    (SELECT count(*) FROM trip WHERE id NOT IN
+        (SELECT trip_id FROM user_trip)) AS lost,
+    (SELECT count(*) FROM user_trip JOIN trip ON id = trip_id
+        WHERE user_id <> lid) AS misattributed'''
+
+
+def old_trip(conn, uid):
+    conn.execute(text(OLD_TRIP), start='2030-01-01', end='2030-01-02',
+                 location=uid, uid=uid).close()
+
+
+def new_trip(conn, uid):
+    writes.insert_returning(conn, writes.CREATE_TRIP,
+                            dict(start='2030-01-01', end='2030-01-02',
+                                 location=uid, uid=uid))
+
+
+def hammer(engine, create, users, trips):
+    def user(uid):
+        conn = engine.connect()
+        for _ in range(trips):
+            create(conn, uid)
+        conn.close()
+    threads = [threading.Thread(target=user, args=(uid,))
+               for uid in range(1, users + 1)]
+    start = timeit.default_timer()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return timeit.default_timer() - start
+
+
+@click.command()
+@click.option('--uri', required=True, help='PostgreSQL database to use')
+@click.option('--users', default=32, help='concurrent users')
+@click.option('--trips', default=200, help='trips created per user')
+@click.option('--friends', default=500, help='friends added in bulk')
+def main(uri, users, trips, friends):
+    rows = list()
+    with scratch_schema(uri) as conn:
+        engine = scratch_engine(uri, pool_size=users)
+        for name, create in (('max(id) (old)', old_trip),
+                             ('INSERT ... RETURNING', new_trip)):
+            conn.execute(text('DROP TABLE IF EXISTS trip, user_trip, '
+                              'user_friends; ' + SCHEMA))
+            elapsed = hammer(engine, create, users, trips)
+            total, lost, wrong = conn.execute(text(CHECK)).fetchone()
+            rows.append((name, total, lost, wrong,
+                         '%.0f' % (total / elapsed)))
+        report(rows, ('trip insert', 'trips', 'lost', 'misattributed',
+                      'trips/s'))
+
+        params = [dict(uid=1, uid_2=i) for i in range(2, friends + 2)]
+        single = timeit.default_timer()
+        for p in params:
+            writes.execute(conn, writes.ADD_FRIEND, p)
+        single = timeit.default_timer() - single
+        conn.execute(text('DELETE FROM user_friends'))
+        bulk = timeit.default_timer()
+        writes.execute(conn, writes.ADD_FRIEND, params)
+        bulk = timeit.default_timer() - bulk
+        print('')
+        report([('one per request', '%.1f' % (single * 1e3)),
+                ('one bulk request', '%.1f' % (bulk * 1e3))],
+               ('add %d friends' % friends, 'ms'))
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Helpers shared by the benchmark scripts.
+
+Database benchmarks take a --uri to a PostgreSQL database they may write to
+(a local one, not the class server). Everything they create lives in a
+scratch schema that is dropped afterwards.
+"""
+
+import os
+import sys
+import timeit
+from contextlib import contextmanager
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from sqlalchemy import create_engine, text  # noqa: E402
+
+
+def best_of(fn, repeat=5, number=1):
+    """Best wall time of fn() in seconds, averaged over number calls."""
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+@contextmanager
+def scratch_schema(uri, name='bench', keep=False):
+    """Yields a connection whose search_path is a fresh schema."""
+    engine = create_engine(uri)
+    conn = engine.connect()
+    conn.execute(text('DROP SCHEMA IF EXISTS %s CASCADE' % name))
+    conn.execute(text('CREATE SCHEMA %s' % name))
+    conn.execute(text('SET search_path TO %s, public' % name))
+    try:
+        yield conn
+    finally:
+        if not keep:
+            conn.execute(text('DROP SCHEMA IF EXISTS %s CASCADE' % name))
+        conn.close()
+        engine.dispose()
+
+
+def scratch_engine(uri, name='bench', pool_size=20):
+    """An engine whose connections all use the scratch schema."""
+    return create_engine(uri, pool_size=pool_size, max_overflow=0,
+                         connect_args=dict(
+                             options='-c search_path=%s,public' % name))
+
+
+def report(rows, header):
+    widths = [max(len(str(x)) for x in col) for col in zip(header, *rows)]
+    for row in [header] + list(rows):
+        print('  '.join(str(x).rjust(w) for x, w in zip(row, widths)))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Side-by-side latency/throughput, using the load driver, of the threaded
+server with each page's independent queries run concurrently (see
+parallel.py) and with them run one after another (PAGE_WORKERS=0).
+
+        python benchmarks/compare_serving.py --users 1000 --clients 50 --duration 60
+
+Starts each server from the webserver directory (so it must hold
+credentials.json pointing at a seeded local database), drives it with
+loadtest.run_load() and stops it again.
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+try:
+    from urllib.request import urlopen
+except ImportError:  # python 2
+    from urllib2 import urlopen
+
+import click
+
+from common import HERE
+from loadtest import run_load
+
+WEBSERVER = os.path.dirname(HERE)
+
+
+def wait_until_up(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urlopen(url + '/login', timeout=2).read()
+            return
+        except Exception:
+            time.sleep(0.2)
+    raise click.ClickException('%s did not come up' % url)
+
+
+@click.command()
+@click.option('--users', default=1000, help='--users given to seed.py')
+@click.option('--clients', default=50)
+@click.option('--duration', default=30.0)
+@click.option('--port', default=8199)
+def main(users, clients, duration, port):
+    modes = [('sequential', ['--threaded'], dict(PAGE_WORKERS='0')),
+             ('concurrent', ['--threaded'], dict())]
+    results = dict()
+    for name, flags, env in modes:
+        proc = subprocess.Popen(
+            [sys.executable, 'server.py'] + flags + ['127.0.0.1', str(port)],
+            cwd=WEBSERVER, env=dict(os.environ, **env))
+        try:
+            url = 'http://127.0.0.1:%d' % port
+            wait_until_up(url)
+            results[name] = run_load(url, users, clients, duration)
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    names = [name for name, _, _ in modes]
+    print("%-22s" % '' + ''.join("%21s" % ('%s p50/p95 ms' % name)
+                                 for name in names))
+    for route in sorted(results['concurrent']['routes']):
+        line = "%-22s" % route
+        for name in names:
+            r = results[name]['routes'].get(route)
+            line += "%21s" % ('%.1f/%.1f' % (r['p50'] * 1e3, r['p95'] * 1e3)
+                              if r else '-')
+        print(line)
+    print("%-22s" % 'throughput (req/s)' + ''.join(
+        "%21.1f" % results[name]['throughput'] for name in names))
+
+
+if __name__ == "__main__":
+    main()
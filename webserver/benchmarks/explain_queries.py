@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""
+Index advisor: runs EXPLAIN (ANALYZE, BUFFERS) over every named query
+(queries.REGISTRY, as declared by server.py and its modules) against a
+seeded LOCAL database, and reports per query the server's planning and
+execution time, buffers touched, the tables read with a sequential scan
+and the worst row estimate error (actual/estimated rows, either way) of
+any plan node. Writes are explained inside a transaction that is rolled
+back. Run it from the webserver directory:
+
+        python benchmarks/seed.py --uri postgresql://localhost/travel --users 100000 --reset
+        python benchmarks/explain_queries.py --uri postgresql://localhost/travel --json before.json
+        python server.py migrate
+        python benchmarks/explain_queries.py --uri postgresql://localhost/travel --compare before.json
+
+or, in one go, --migrate explains, applies the pending migrations (see
+migrations.py) and explains again.
+"""
+
+import json
+
+import click
+from sqlalchemy import create_engine, text
+
+import common  # noqa: F401 (puts the webserver directory on sys.path)
+import migrations
+import pagination
+import queries
+import server  # noqa: F401 (declares the route queries)
+
+# parameter values looked up in the seeded data (the seed makes low ids
+# the busiest, so these are the expensive cases)
+LOOKUPS = '''SELECT
+    (SELECT min(uid) FROM users) AS uid,
+    (SELECT max(uid) FROM users) AS uid_2,
+    (SELECT min(lid) FROM location) AS lid,
+    (SELECT min(id) FROM trip) AS trip,
+    (SELECT min(name) FROM activity) AS activity,
+    (SELECT email FROM users ORDER BY uid LIMIT 1) AS username,
+    (SELECT password FROM users ORDER BY uid LIMIT 1) AS password'''
+
+LEASE = '''SELECT owner, address, start_date, end_date FROM rental_lease
+    ORDER BY start_date DESC LIMIT 1'''
+
+CONSTANTS = dict(limit=26, before=None, rating=4, comment='explain',
+                 name='explain', description='explain', desc='explain',
+                 country='explain', lat=40.0, lng=-73.0,
+                 email='explain@example.com', profilepic='', args='{}',
+                 error='explain', delay=1, max_attempts=5, id=0,
+                 query='explain:*', prefix='ex%', since=None)
+
+
+def samples(conn):
+    values = dict(CONSTANTS)
+    values.update(dict(conn.execute(text(LOOKUPS)).fetchone().items()))
+    lease = conn.execute(text(LEASE)).fetchone()
+    if lease is not None:
+        values.update(owner=lease[0], address=lease[1],
+                      start=lease[2].isoformat(), end=lease[3].isoformat())
+    res = conn.execute(text('SELECT uid FROM users ORDER BY uid LIMIT 20'))
+    values['uids'] = [row[0] for row in res]
+    res = conn.execute(text('SELECT lid FROM location ORDER BY lid '
+                            'LIMIT 20'))
+    values['lids'] = [row[0] for row in res]
+    values.update(member=values['uid_2'], location=values['lid'],
+                  home=values['lid'])
+    return values
+
+
+def keyset_values(conn, name, params):
+    """k0, k1 ... for an _after/_before variant: the first page's last key."""
+    base, _, variant = name.rpartition('_')
+    keyset = pagination.KEYSETS.get(base)
+    if variant not in ('after', 'before') or keyset is None:
+        return dict()
+    first = queries.REGISTRY['%s_first' % base]
+    rows = conn.execute(first.text, **dict(
+        (p, params[p]) for p in first.params if p in params)).fetchall()
+    if not rows:
+        return None
+    return dict(('k%d' % i, value)
+                for i, value in enumerate(keyset.row_key(rows[-1])))
+
+
+def nodes(plan):
+    yield plan
+    for child in plan.get('Plans', ()):
+        for node in nodes(child):
+            yield node
+
+
+def explain(conn, query, params, repeat):
+    """The summary of the best of repeat EXPLAIN ANALYZE runs."""
+    best = None
+    for _ in range(repeat):
+        tx = conn.begin()
+        try:
+            res = conn.execute(
+                text('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query.sql),
+                **params)
+            output = res.scalar()
+        finally:
+            tx.rollback()
+        if not isinstance(output, list):
+            output = json.loads(output)
+        if best is None or output[0]['Execution Time'] < \
+                best[0]['Execution Time']:
+            best = output
+    plan = best[0]
+    root = plan['Plan']
+    error = 1.0
+    for node in nodes(root):
+        actual = max(node.get('Actual Rows', 0), 1)
+        estimated = max(node.get('Plan Rows', 0), 1)
+        error = max(error, actual / float(estimated),
+                    estimated / float(actual))
+    return dict(
+        planning_ms=plan.get('Planning Time', 0.0),
+        execution_ms=plan.get('Execution Time', 0.0),
+        buffers=root.get('Shared Hit Blocks', 0) +
+        root.get('Shared Read Blocks', 0),
+        seq_scans=sorted(set(node['Relation Name'] for node in nodes(root)
+                             if node['Node Type'] == 'Seq Scan')),
+        estimate_error=round(error, 1))
+
+
+def snapshot(conn, repeat):
+    values = samples(conn)
+    result = dict()
+    for name, query in sorted(queries.REGISTRY.items()):
+        params = dict((p, values[p]) for p in query.params if p in values)
+        keys = keyset_values(conn, name, values)
+        missing = [p for p in query.params
+                   if p not in params and p not in (keys or {})]
+        if keys is None or missing:
+            result[name] = dict(skipped='no sample for %s' % (
+                ', '.join(missing) or 'the cursor'))
+            continue
+        params.update(keys)
+        try:
+            result[name] = explain(conn, query, params, repeat)
+        except Exception as e:
+            result[name] = dict(skipped=str(e).splitlines()[0])
+    return result
+
+
+def print_report(result, baseline=None):
+    print("%-26s %9s %9s %8s %7s  %s" % ('query', 'exec ms', 'plan ms',
+                                        'buffers', 'est x', 'seq scans'))
+    for name, r in sorted(result.items()):
+        if 'skipped' in r:
+            print("%-26s skipped: %s" % (name, r['skipped']))
+            continue
+        line = "%-26s %9.2f %9.2f %8d %7.1f  %s" % (
+            name, r['execution_ms'], r['planning_ms'], r['buffers'],
+            r['estimate_error'], ', '.join(r['seq_scans']) or '-')
+        old = (baseline or {}).get(name)
+        if old and 'skipped' not in old:
+            line += "   (was %.2f ms, %s)" % (
+                old['execution_ms'], ', '.join(old['seq_scans']) or '-')
+        print(line)
+
+
+@click.command()
+@click.option('--uri', required=True, help='seeded PostgreSQL database')
+@click.option('--repeat', default=3, help='EXPLAIN ANALYZE runs per query')
+@click.option('--migrate', is_flag=True,
+              help='explain, apply pending migrations, explain again')
+@click.option('--json', 'json_out', default=None, help='save results here')
+@click.option('--compare', default=None, help='earlier --json to diff')
+def main(uri, repeat, migrate, json_out, compare):
+    engine = create_engine(uri)
+    baseline = None
+    if compare:
+        with open(compare) as f:
+            baseline = json.load(f)
+    if migrate:
+        with engine.connect() as conn:
+            baseline = snapshot(conn, repeat)
+        for version in migrations.migrate(engine):
+            print("applied migration %d" % version)
+    with engine.connect() as conn:
+        result = snapshot(conn, repeat)
+    print_report(result, baseline)
+    if json_out:
+        with open(json_out, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+"""
+Load driver: logs in many simulated users and exercises every route of
+server.py concurrently, then reports throughput and latency percentiles.
+
+        python benchmarks/seed.py --uri postgresql://localhost/travel --users 1000 --reset
+        python server.py --threaded 127.0.0.1 8111
+        python benchmarks/loadtest.py --url http://127.0.0.1:8111 --users 1000 \\
+            --clients 50 --duration 60 --json before.json
+
+--users must match the seed so the generated ids exist. Redirects are not
+followed, so each line of the report is the cost of that route alone. A
+response counts as an error unless it has the route's expected status, or
+redirects where the route sends you when it worked (the routes turn
+failures into redirects to / or /login). Use --json to keep results and
+--compare to diff a run against an earlier one.
+
+A client that hits /logout logs in again, so /loginreq is measured
+throughout the run. /rentalreq asks for a lease the client's last
+/rental?start=&end= search listed as free, so it measures accepted
+requests as well as refused ones. Left out on purpose: the ?stream=1
+variants of the list pages, which send a whole table each (see
+bench_streaming.py), and the import/export commands, which are not routes
+(see bench_import.py).
+"""
+
+import datetime
+import json
+import random
+import re
+import threading
+import timeit
+
+try:
+    from http.cookiejar import CookieJar
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import urlencode, urlparse
+    from urllib.request import (HTTPCookieProcessor, HTTPRedirectHandler,
+                                build_opener)
+except ImportError:  # python 2
+    from cookielib import CookieJar
+    from urllib import urlencode
+    from urlparse import urlparse
+    from urllib2 import (HTTPCookieProcessor, HTTPError, HTTPRedirectHandler,
+                         URLError, build_opener)
+
+import click
+
+from seed import sizes
+
+
+class NoRedirect(HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def today_plus(rng, lo, hi):
+    day = datetime.date.today() + datetime.timedelta(rng.randint(lo, hi))
+    return day.isoformat()
+
+
+def some(rng, name, n, k=5):
+    """k (name, random id in 1..n) form fields, as the bulk routes take."""
+    return [(name, rng.randint(1, n)) for _ in range(k)]
+
+
+def lease(rng, c, take=False):
+    """
+    owner/address/start/end of a lease the client's last date search
+    listed as free (take: so it isn't requested twice), or else of a
+    seeded lease that may not exist.
+    """
+    if c['leases']:
+        return c['leases'].pop() if take else c['leases'][-1]
+    return '%d/%d Main St/%s/%s' % (
+        rng.randint(1, c['users']), rng.randint(1, c['rental_lease']),
+        today_plus(rng, 30, 40), today_plus(rng, 41, 50))
+
+
+def dates(rng):
+    """?start=&end= of a three night stay."""
+    start = datetime.date.today() + datetime.timedelta(rng.randint(10, 300))
+    return urlencode(dict(start=start.isoformat(),
+                          end=(start + datetime.timedelta(2)).isoformat()))
+
+
+# the request links of a /rental?start=&end= page
+LEASE_LINK = re.compile(r'action="/rentalrequest/([^"]+)"')
+
+
+# (route name, weight, method, function(rng, counts) -> (path, form),
+#  expected: a status, or the path it redirects to when it worked)
+ROUTES = [
+    ('GET /', 10, 'GET', lambda r, c: ('/', None), 200),
+    ('GET /location', 6, 'GET', lambda r, c: ('/location', None), 200),
+    ('GET /nearby', 3, 'GET', lambda r, c: ('/nearby', None), 200),
+    ('GET /reviews', 6, 'GET', lambda r, c: ('/reviews', None), 200),
+    ('GET /rental', 4, 'GET', lambda r, c: ('/rental', None), 200),
+    ('GET /rental?start', 2, 'GET', lambda r, c: (
+        '/rental?' + dates(r), None), 200),
+    ('GET /requests', 3, 'GET', lambda r, c: ('/requests', None), 200),
+    ('GET /friend', 6, 'GET', lambda r, c: ('/friend', None), 200),
+    ('GET /activity', 5, 'GET', lambda r, c: ('/activity', None), 200),
+    ('GET /trip', 6, 'GET', lambda r, c: ('/trip', None), 200),
+    ('GET /metrics', 1, 'GET', lambda r, c: ('/metrics', None), 200),
+    ('GET /search', 3, 'GET', lambda r, c: (
+        '/search?q=place %d' % r.randint(1, c['location']), None), 200),
+    ('GET /search/suggest', 2, 'GET', lambda r, c: (
+        '/search/suggest?q=pla', None), 200),
+    ('GET /review', 2, 'GET', lambda r, c: (
+        '/review/%d/Place' % r.randint(1, c['location']), None), 200),
+    ('GET /rentalrequest', 1, 'GET', lambda r, c: (
+        '/rentalrequest/' + lease(r, c), None), 200),
+    ('GET /login', 1, 'GET', lambda r, c: ('/login', None), 200),
+    ('GET /signup', 1, 'GET', lambda r, c: ('/signup', None), 200),
+    ('GET /logout', 1, 'GET', lambda r, c: ('/logout', None), '/login'),
+    ('POST /signupreq', 1, 'POST', lambda r, c: (
+        '/signupreq', dict(email='load%d@example.com' % r.randint(1, 10 ** 12),
+                           password='password', name='Load user',
+                           profilepic='',
+                           home=r.randint(1, c['location']))), '/login'),
+    ('POST /activityadd', 1, 'POST', lambda r, c: (
+        '/activityadd/Activity %d' % r.randint(1, c['activity']), {}),
+        '/activity'),
+    ('POST /activityaddbulk', 1, 'POST', lambda r, c: (
+        '/activityaddbulk', [(name, 'Activity %d' % i) for name, i
+                             in some(r, 'activity', c['activity'])]),
+        '/activity'),
+    ('POST /activityremove', 1, 'POST', lambda r, c: (
+        '/activityremove/Activity %d' % r.randint(1, c['activity']), {}),
+        '/activity'),
+    ('POST /activitycreate', 1, 'POST', lambda r, c: (
+        '/activitycreate', dict(name='Load %d' % r.randint(1, 10 ** 9),
+                                description='made by the load test')),
+        '/activity'),
+    ('POST /friendaddreq', 1, 'POST', lambda r, c: (
+        '/friendaddreq/%d' % r.randint(1, c['users']), {}), '/friend'),
+    ('POST /friendaddbulk', 1, 'POST', lambda r, c: (
+        '/friendaddbulk', some(r, 'friend', c['users'])), '/friend'),
+    ('POST /friendremovereq', 1, 'POST', lambda r, c: (
+        '/friendremovereq/%d' % r.randint(1, c['users']), {}), '/friend'),
+    ('POST /locationadd', 1, 'POST', lambda r, c: (
+        '/locationadd', dict(latitude=r.uniform(25, 50),
+                             longditude=r.uniform(-125, -70),
+                             name='Load place', description='load test',
+                             country='Loadland')), '/location'),
+    ('POST /reviewsubmit', 1, 'POST', lambda r, c: (
+        '/reviewsubmit/%d' % r.randint(1, c['location']),
+        dict(rating=r.randint(1, 5), comment='load test')), '/trip'),
+    ('POST /tripreq', 1, 'POST', lambda r, c: (
+        '/tripreq', dict(start=today_plus(r, 10, 20),
+                         end=today_plus(r, 21, 30),
+                         location=r.randint(1, c['location']))), '/trip'),
+    ('POST /tripjoinreq', 1, 'POST', lambda r, c: (
+        '/tripjoinreq', dict(trip=r.randint(1, c['trip']))), '/trip'),
+    ('POST /tripaddmembers', 1, 'POST', lambda r, c: (
+        '/tripaddmembers', [('trip', r.randint(1, c['trip']))] +
+        some(r, 'member', c['users'])), '/trip'),
+    ('POST /tripleavereq', 1, 'POST', lambda r, c: (
+        '/tripleavereq', dict(trip=r.randint(1, c['trip']))), '/trip'),
+    ('POST /rentalreq', 1, 'POST', lambda r, c: (
+        '/rentalreq/' + lease(r, c, take=True),
+        dict(comment='load test')), '/rental'),
+]
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.latencies = dict()
+        self.errors = dict()
+        self._lock = threading.Lock()
+
+    def add(self, route, seconds, ok):
+        with self._lock:
+            self.latencies.setdefault(route, []).append(seconds)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+def client(base, uid, counts, deadline, stats, rng):
+    opener = build_opener(HTTPCookieProcessor(CookieJar()), NoRedirect())
+
+    def call(route, method, path, form, expected):
+        url = base + path.replace(' ', '%20')
+        data = urlencode(form).encode('ascii') if method == 'POST' else None
+        start = timeit.default_timer()
+        body = b''
+        try:
+            response = opener.open(url, data, timeout=60)
+            body = response.read()
+            ok = response.getcode() == expected
+        except HTTPError as e:
+            # a redirect, as redirects are not followed, or an error
+            location = e.headers.get('Location') or ''
+            ok = 300 <= e.code < 400 and \
+                urlparse(location).path == expected
+        except URLError:
+            ok = False
+        stats.add(route, timeit.default_timer() - start, ok)
+        return body.decode('utf-8', 'replace')
+
+    def login():
+        call('POST /loginreq', 'POST', '/loginreq',
+             dict(username='user%d@example.com' % uid, password='password'),
+             '/')
+
+    login()
+    counts = dict(counts, leases=list())
+    weights = [route[1] for route in ROUTES]
+    total = float(sum(weights))
+    while timeit.default_timer() < deadline:
+        pick, acc = rng.random() * total, 0
+        for name, weight, method, make, expected in ROUTES:
+            acc += weight
+            if pick <= acc:
+                break
+        path, form = make(rng, counts)
+        body = call(name, method, path, form, expected)
+        if path == '/logout':
+            login()
+        elif name == 'GET /rental?start':
+            # what the next /rentalrequest and /rentalreq ask for
+            counts['leases'] = LEASE_LINK.findall(body)[::-1]
+
+
+def summarize(stats, elapsed):
+    result = dict(elapsed=elapsed, routes=dict())
+    requests = 0
+    for route, samples in sorted(stats.latencies.items()):
+        requests += len(samples)
+        result['routes'][route] = dict(
+            requests=len(samples), errors=stats.errors.get(route, 0),
+            p50=percentile(samples, 0.5), p95=percentile(samples, 0.95),
+            p99=percentile(samples, 0.99))
+    everything = [s for samples in stats.latencies.values() for s in samples]
+    result['requests'] = requests
+    result['throughput'] = requests / elapsed
+    result['p50'] = percentile(everything, 0.5) if everything else 0
+    result['p95'] = percentile(everything, 0.95) if everything else 0
+    result['p99'] = percentile(everything, 0.99) if everything else 0
+    return result
+
+
+def print_report(result, baseline=None):
+    print("%-22s %8s %6s %9s %9s %9s" % ('route', 'requests', 'errors',
+                                        'p50 ms', 'p95 ms', 'p99 ms'))
+    for route, r in sorted(result['routes'].items()):
+        line = "%-22s %8d %6d %9.1f %9.1f %9.1f" % (
+            route, r['requests'], r['errors'], r['p50'] * 1e3,
+            r['p95'] * 1e3, r['p99'] * 1e3)
+        if baseline and route in baseline['routes']:
+            old = baseline['routes'][route]['p95']
+            line += "   p95 %+.0f%%" % ((r['p95'] - old) / old * 100
+                                        if old else 0)
+        print(line)
+    print("%d requests in %.1f s: %.1f req/s, p50 %.1f ms, p95 %.1f ms, "
+          "p99 %.1f ms" % (result['requests'], result['elapsed'],
+                           result['throughput'], result['p50'] * 1e3,
+                           result['p95'] * 1e3, result['p99'] * 1e3))
+    if baseline:
+        print("baseline: %.1f req/s, p95 %.1f ms" % (
+            baseline['throughput'], baseline['p95'] * 1e3))
+
+
+def run_load(url, users, clients, duration, seed=4111):
+    """Runs the load and returns the summary dict."""
+    counts = sizes(users)
+    stats = Stats()
+    rng = random.Random(seed)
+    deadline = timeit.default_timer() + duration
+    threads = [threading.Thread(target=client, args=(
+        url.rstrip('/'), rng.randint(1, counts['users']), counts, deadline,
+        stats, random.Random(rng.random()))) for _ in range(clients)]
+    start = timeit.default_timer()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return summarize(stats, timeit.default_timer() - start)
+
+
+@click.command()
+@click.option('--url', default='http://127.0.0.1:8111')
+@click.option('--users', default=1000, help='--users given to seed.py')
+@click.option('--clients', default=20, help='concurrent simulated users')
+@click.option('--duration', default=30.0, help='seconds')
+@click.option('--seed', default=4111)
+@click.option('--json', 'json_out', default=None, help='save results here')
+@click.option('--compare', default=None, help='earlier --json to diff')
+def main(url, users, clients, duration, seed, json_out, compare):
+    result = run_load(url, users, clients, duration, seed)
+    baseline = None
+    if compare:
+        with open(compare) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if json_out:
+        with open(json_out, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+Reproducible synthetic data for the whole schema, for benchmarks and load
+tests against a LOCAL PostgreSQL database (never the class server).
+
+        python benchmarks/seed.py --uri postgresql://localhost/travel --users 1000 --create
+        python benchmarks/seed.py --uri postgresql://localhost/travel --users 500000 --reset
+
+Row counts scale with --users (user_friends, the biggest table, gets 20 rows
+per user, so --users 500000 is ~10M friend rows). References are skewed:
+low ids are far more popular than high ones (a power law on random()), which
+is what makes popular activities and locations expensive. All generation
+happens server side with generate_series, seeded with setseed() so the same
+arguments give the same data.
+
+Every user can log in as user<uid>@example.com / password. Seed into empty
+tables (--create or --reset) so generated ids line up.
+"""
+
+import timeit
+
+import click
+from sqlalchemy import create_engine, text
+
+SCHEMA = '''
+CREATE TABLE location (lid serial PRIMARY KEY, gps_lat real, gps_long real,
+    name text NOT NULL, description text, country text);
+CREATE TABLE users (uid serial PRIMARY KEY, email text UNIQUE NOT NULL,
+    password text NOT NULL, name text NOT NULL, profile_picture text,
+    home integer REFERENCES location(lid));
+CREATE TABLE user_friends (uid integer REFERENCES users(uid),
+    uid_2 integer REFERENCES users(uid), PRIMARY KEY (uid, uid_2));
+CREATE TABLE activity (name text PRIMARY KEY, description text);
+CREATE TABLE user_activity (name text REFERENCES activity(name),
+    uid integer REFERENCES users(uid), PRIMARY KEY (name, uid));
+CREATE TABLE reviews (rating integer, comment text,
+    uid integer REFERENCES users(uid), lid integer REFERENCES location(lid),
+    PRIMARY KEY (uid, lid));
+CREATE TABLE trip (id serial PRIMARY KEY, start_date date NOT NULL,
+    end_date date NOT NULL, lid integer REFERENCES location(lid));
+CREATE TABLE user_trip (user_id integer REFERENCES users(uid),
+    trip_id integer REFERENCES trip(id), PRIMARY KEY (user_id, trip_id));
+CREATE TABLE rental_lease (owner integer REFERENCES users(uid),
+    address text, start_date date, end_date date, price numeric,
+    PRIMARY KEY (owner, address, start_date));
+CREATE TABLE rental_request (requester integer REFERENCES users(uid),
+    address text, owner integer, comment text, start_date date,
+    end_data date, PRIMARY KEY (requester, owner, address, start_date));
+'''
+
+TABLES = ('rental_request', 'rental_lease', 'user_trip', 'trip', 'reviews',
+          'user_activity', 'activity', 'user_friends', 'users', 'location',
+          'location_rating')
+
+# skewed pick of an id in 1..n: power > 1 favours the low ids
+PICK = "(1 + floor(%s * power(random(), %s)))::int"
+
+# (table, rows per user, INSERT ... SELECT using :n rows)
+STEPS = [
+    ('location', 0.1, '''INSERT INTO location(gps_lat, gps_long, name,
+        description, country)
+        SELECT 25 + random() * 25, -125 + random() * 55, 'Place ' || i,
+            'A nice place number ' || i, 'Country ' || (i % 50)
+        FROM generate_series(1, :n) AS i'''),
+    ('users', 1, '''INSERT INTO users(email, password, name,
+        profile_picture, home)
+        SELECT 'user' || i || '@example.com', 'password', 'User ' || i,
+            'http://example.com/' || i || '.png', ''' + PICK % (':locations', 2)
+        + ''' FROM generate_series(1, :n) AS i'''),
+    ('user_friends', 20, '''INSERT INTO user_friends
+        SELECT u, f FROM (SELECT ''' + PICK % (':users', 1) + ''' AS u, '''
+        + PICK % (':users', 3) + ''' AS f FROM generate_series(1, :n)) AS p
+        WHERE u <> f ON CONFLICT DO NOTHING'''),
+    ('activity', 0.01, '''INSERT INTO activity
+        SELECT 'Activity ' || i, 'Doing thing number ' || i
+        FROM generate_series(1, greatest(:n, 10)) AS i'''),
+    ('user_activity', 5, '''INSERT INTO user_activity
+        SELECT 'Activity ' || ''' + PICK % ('greatest(:activities, 10)', 3) +
+        ''', ''' + PICK % (':users', 1) + '''
+        FROM generate_series(1, :n) ON CONFLICT DO NOTHING'''),
+    ('reviews', 10, '''INSERT INTO reviews
+        SELECT 1 + floor(random() * 5)::int, 'Review comment',
+            ''' + PICK % (':users', 1) + ', ' + PICK % (':locations', 2) + '''
+        FROM generate_series(1, :n) ON CONFLICT DO NOTHING'''),
+    ('trip', 3, '''INSERT INTO trip(start_date, end_date, lid)
+        SELECT d, d + (1 + floor(random() * 14))::int, '''
+        + PICK % (':locations', 2) + '''
+        FROM (SELECT CURRENT_DATE - 730 + floor(random() * 1095)::int AS d
+              FROM generate_series(1, :n)) AS t'''),
+    ('user_trip', 4, '''INSERT INTO user_trip
+        SELECT ''' + PICK % (':users', 1) + ', ' + PICK % (':trips', 1) + '''
+        FROM generate_series(1, :n) ON CONFLICT DO NOTHING'''),
+    ('rental_lease', 0.5, '''INSERT INTO rental_lease
+        SELECT o, i || ' Main St', d, d + (2 + floor(random() * 28))::int,
+            round((50 + random() * 450)::numeric, 2)
+        FROM (SELECT i, ''' + PICK % (':users', 1) + ''' AS o,
+            CURRENT_DATE - 180 + floor(random() * 540)::int AS d
+            FROM generate_series(1, :n) AS i) AS r
+        ON CONFLICT DO NOTHING'''),
+    # the first two nights of one lease in five, so the rest of those
+    # leases, and the other leases, can still be requested (see
+    # rentals.request: requests for a property may not overlap)
+    ('rental_request', 0.1, '''INSERT INTO rental_request
+        SELECT ''' + PICK % (':users', 1) + ''', address, owner,
+            'Can I stay?', start_date, start_date + 1
+        FROM rental_lease ORDER BY random() LIMIT :n
+        ON CONFLICT DO NOTHING'''),
+]
+
+
+def sizes(users):
+    """Rows generated per table for a given number of users."""
+    return dict((table, max(1, int(users * ratio)))
+                for table, ratio, _ in STEPS)
+
+
+@click.command()
+@click.option('--uri', required=True, help='local PostgreSQL database')
+@click.option('--users', default=1000, help='scale: number of users')
+@click.option('--seed', default=0.4111, help='setseed() value in [-1, 1]')
+@click.option('--create', is_flag=True, help='create the tables first')
+@click.option('--reset', is_flag=True, help='drop and recreate the tables')
+def main(uri, users, seed, create, reset):
+    engine = create_engine(uri)
+    conn = engine.connect()
+    if reset:
+        conn.execute(text('DROP TABLE IF EXISTS %s CASCADE' %
+                          ', '.join(TABLES)))
+    if create or reset:
+        conn.execute(text(SCHEMA))
+
+    counts = sizes(users)
+    params = dict(users=counts['users'], locations=counts['location'],
+                  activities=counts['activity'], trips=counts['trip'])
+    total = 0
+    for table, _, cmd in STEPS:
+        start = timeit.default_timer()
+        with conn.begin():
+            conn.execute(text('SELECT setseed(:seed)'), seed=seed)
+            res = conn.execute(text(cmd), n=counts[table], **params)
+            rows = res.rowcount
+            res.close()
+        total += rows
+        print("%-15s %10d rows  %7.1f s" % (
+            table, rows, timeit.default_timer() - start))
+    for table in TABLES[:-1]:
+        conn.execute(text('ANALYZE %s' % table))
+    print("%-15s %10d rows" % ('total', total))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+"""
+Bulk import and export of locations, reviews and rental leases
+(python server.py import / export).
+
+Import reads CSV (with a header row) or JSON lines, a chunk of rows at a
+time. Each row is checked against the table's COLUMNS, and rows that fail
+are reported (and written to --rejects) instead of failing the import. The
+good rows are COPYed into a temporary staging table, then merged into the
+table by one INSERT ... SELECT that drops duplicates on the natural key
+(within the file and against rows already there) and rows referring to
+unknown users or locations, and keeps LOCATION_RATING (leaderboard.py) up
+to date. Every chunk is its own transaction, so an interrupted import can
+simply be run again.
+
+Export streams COPY (SELECT ...) TO STDOUT straight into the output file,
+as CSV or JSON lines, without holding the rows in memory.
+
+Every chunk bumps the shared versions of what it changed (versions.py),
+so running servers drop their cached pages, and once a location import
+is done they rebuild the "near me" grid index (spatial.py); search sees
+the rows at once through its indexes. An
+import is a data load, not user activity: imported reviews are not fanned
+out to anyone's home feed (feed.py), and the per-user profile cache
+(profiles.py) only sees a user's imported reviews once its entry expires.
+"""
+
+import csv
+import datetime
+import decimal
+import io
+import json
+import math
+import timeit
+
+from sqlalchemy import text
+
+import versions
+
+CHUNK = 50000  # rows per COPY and merge
+
+
+class Invalid(ValueError):
+    pass
+
+
+def number(kind, low=None, high=None, required=True):
+    def parse(value):
+        if value is None or value == '':
+            if required:
+                raise Invalid('missing')
+            return None
+        # JSON gives numbers as int/float: no true/false, and no 3.7 for an
+        # integer column
+        if isinstance(value, bool) or (kind is int and isinstance(
+                value, float) and not value.is_integer()):
+            raise Invalid('not %s: %r' % (
+                'an integer' if kind is int else 'a number', value))
+        try:
+            value = kind(value)
+            finite = math.isfinite(value)
+        except (TypeError, ValueError, OverflowError,
+                decimal.InvalidOperation):
+            raise Invalid('not a number: %r' % (value,))
+        if not finite:
+            raise Invalid('not a number: %r' % (value,))
+        if (low is not None and value < low) or \
+                (high is not None and value > high):
+            raise Invalid('%s is out of range' % value)
+        return value
+    return parse
+
+
+def string(required=True):
+    def parse(value):
+        if value is None or value == '':
+            if required:
+                raise Invalid('missing')
+            return None
+        return str(value)
+    return parse
+
+
+def date(value):
+    try:
+        return datetime.datetime.strptime(str(value), '%Y-%m-%d').date()
+    except ValueError:
+        raise Invalid('not a YYYY-MM-DD date: %r' % (value,))
+
+
+class Table(object):
+    """
+    An importable table: its COLUMNS as (name, parser), the natural key
+    duplicates are dropped on, the statement merging BULK_STAGE into it,
+    which returns the number of rows inserted, the data versions an import
+    changes and the in-memory indexes it makes every process reload.
+    """
+
+    def __init__(self, name, columns, key, merge, check=None, export=None,
+                 changes=(), reloads=()):
+        self.name = name
+        self.columns = columns
+        self.names = [column for column, _ in columns]
+        self.key = key
+        self.check = check
+        self.changes = changes
+        self.reloads = reloads
+        self.stage = 'bulk_stage_%s' % name
+        self.merge = merge % dict(stage=self.stage, key=', '.join(key),
+                                  columns=', '.join(self.names))
+        self.export = export or 'SELECT %s FROM %s' % (
+            ', '.join(self.names), name)
+
+    def parse(self, record):
+        """The row's values in column order; raises Invalid."""
+        row = list()
+        for column, parse in self.columns:
+            try:
+                row.append(parse(record.get(column)))
+            except Invalid as e:
+                raise Invalid('%s: %s' % (column, e))
+        if self.check is not None:
+            self.check(dict(zip(self.names, row)))
+        return row
+
+
+def _lease_dates(row):
+    if row['end_date'] < row['start_date']:
+        raise Invalid('end_date is before start_date')
+
+
+LOCATION = Table('location', [
+    ('gps_lat', number(float, -90, 90)),
+    ('gps_long', number(float, -180, 180)),
+    ('name', string()),
+    ('description', string(required=False)),
+    ('country', string(required=False)),
+], key=('name', 'country'), merge='''WITH new AS (
+        INSERT INTO location (%(columns)s)
+        SELECT DISTINCT ON (name, coalesce(country, '')) %(columns)s
+        FROM %(stage)s s
+        WHERE NOT EXISTS (SELECT 1 FROM location l WHERE l.name = s.name
+            AND coalesce(l.country, '') = coalesce(s.country, ''))
+        ORDER BY name, coalesce(country, '')
+        RETURNING lid)
+SELECT count(*) FROM new''',
+    export='''SELECT lid, gps_lat, gps_long, name, description, country
+    FROM location''', changes=('location',), reloads=('location',))
+
+REVIEWS = Table('reviews', [
+    ('uid', number(int, 1)),
+    ('lid', number(int, 1)),
+    ('rating', number(int, 1, 5)),
+    ('comment', string(required=False)),
+], key=('uid', 'lid'), merge='''WITH new AS (
+        INSERT INTO reviews (%(columns)s)
+        SELECT DISTINCT ON (%(key)s) %(columns)s FROM %(stage)s s
+        WHERE EXISTS (SELECT 1 FROM users WHERE users.uid = s.uid)
+        AND EXISTS (SELECT 1 FROM location WHERE location.lid = s.lid)
+        ORDER BY %(key)s
+        ON CONFLICT DO NOTHING
+        RETURNING lid, rating),
+    totals AS (SELECT lid, count(*) AS n,
+            CAST(sum(coalesce(rating, 0)) AS numeric) AS total
+        FROM new GROUP BY lid),
+    summary AS (INSERT INTO location_rating AS r
+        SELECT lid, n, total, total / n FROM totals ORDER BY lid
+        ON CONFLICT (lid) DO UPDATE SET
+            review_count = r.review_count + excluded.review_count,
+            rating_sum = r.rating_sum + excluded.rating_sum,
+            avg_rating = (r.rating_sum + excluded.rating_sum) /
+                (r.review_count + excluded.review_count))
+SELECT count(*) FROM new''', changes=('location', 'reviews'))
+
+RENTAL_LEASE = Table('rental_lease', [
+    ('owner', number(int, 1)),
+    ('address', string()),
+    ('start_date', date),
+    ('end_date', date),
+    ('price', number(decimal.Decimal, 0, required=False)),
+], key=('owner', 'address', 'start_date'), check=_lease_dates,
+    merge='''WITH new AS (
+        INSERT INTO rental_lease (%(columns)s)
+        SELECT DISTINCT ON (%(key)s) %(columns)s FROM %(stage)s s
+        WHERE EXISTS (SELECT 1 FROM users WHERE users.uid = s.owner)
+        ORDER BY %(key)s
+        ON CONFLICT DO NOTHING
+        RETURNING 1)
+SELECT count(*) FROM new''')
+
+TABLES = dict((table.name, table) for table in (LOCATION, REVIEWS,
+                                                RENTAL_LEASE))
+
+
+def numbered(f, fmt):
+    """
+    (line number, dict) for the records of a CSV (header row) or JSON lines
+    file; the line a CSV record ends on, as quoted fields can span lines.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(f)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for number, line in enumerate(f, 1):
+        line = line.strip()
+        if line:
+            try:
+                yield number, json.loads(line)
+            except ValueError as e:
+                yield number, Invalid('bad JSON: %s' % e)
+
+
+def records(f, fmt):
+    """Dicts from a CSV (header row) or JSON lines file."""
+    for _, record in numbered(f, fmt):
+        yield record
+
+
+def _field(value):
+    if value is None:
+        return ''  # unquoted: NULL
+    return '"%s"' % str(value).replace('"', '""')
+
+
+def copy_rows(conn, table, rows):
+    """COPYs parsed rows into the table's staging table."""
+    buf = io.StringIO()
+    for row in rows:
+        buf.write(','.join(_field(value) for value in row))
+        buf.write('\n')
+    buf.seek(0)
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert('COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (
+            table.stage, ', '.join(table.names)), buf)
+    finally:
+        cursor.close()
+
+
+class Progress(object):
+
+    def __init__(self):
+        self.read = 0
+        self.inserted = 0
+        self.rejected = 0
+        self.started = timeit.default_timer()
+
+    @property
+    def skipped(self):
+        """Duplicates and rows referring to unknown users or locations."""
+        return self.read - self.inserted - self.rejected
+
+    def rate(self):
+        return self.read / max(timeit.default_timer() - self.started, 1e-9)
+
+    def __str__(self):
+        return '%d read, %d inserted, %d skipped, %d rejected (%.0f rows/s)' \
+            % (self.read, self.inserted, self.skipped, self.rejected,
+               self.rate())
+
+
+def _chunks(table, f, fmt, chunk, progress, rejects):
+    rows = list()
+    for line, record in numbered(f, fmt):
+        progress.read += 1
+        try:
+            if isinstance(record, Invalid):
+                raise record
+            if not isinstance(record, dict):
+                raise Invalid('not an object')
+            rows.append(table.parse(record))
+        except Invalid as e:
+            progress.rejected += 1
+            if rejects is not None:
+                rejects.write('%d\t%s\n' % (line, e))
+        if len(rows) == chunk:
+            yield rows
+            rows = list()
+    if rows:
+        yield rows
+
+
+def import_file(conn, table, f, fmt='csv', chunk=CHUNK, rejects=None,
+                report=None):
+    """
+    Loads the records of file f into table (a Table), chunk rows at a time.
+    report(progress) is called after every chunk; rejects, if given, is a
+    file that gets "line<TAB>reason" for every invalid record.
+    """
+    progress = Progress()
+    conn.execute(text('''CREATE TEMPORARY TABLE IF NOT EXISTS %s
+        ON COMMIT DELETE ROWS AS SELECT %s FROM %s WITH NO DATA''' % (
+        table.stage, ', '.join(table.names), table.name)))
+    for rows in _chunks(table, f, fmt, chunk, progress, rejects):
+        with conn.begin():
+            copy_rows(conn, table, rows)
+            inserted = conn.execute(text(table.merge)).scalar()
+            if inserted and table.changes:
+                versions.bump(conn, *table.changes)
+            progress.inserted += inserted
+        if report is not None:
+            report(progress)
+    if progress.inserted and table.reloads:
+        versions.reload(conn, *table.reloads)
+    if report is not None and not progress.read:
+        report(progress)
+    return progress
+
+
+def export(conn, query, f, fmt='csv'):
+    """Streams the rows of query into file f as CSV or JSON lines."""
+    if fmt == 'csv':
+        cmd = 'COPY (%s) TO STDOUT WITH (FORMAT csv, HEADER)' % query
+    else:
+        # one json value per line; the CSV quote and delimiter are
+        # characters json never contains unescaped, so it passes untouched
+        cmd = '''COPY (SELECT row_to_json(t) FROM (%s) AS t) TO STDOUT
+            WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')''' % query
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(cmd, f)
+    finally:
+        cursor.close()
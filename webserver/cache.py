@@ -0,0 +1,52 @@
+"""
+Small in-process caches shared by the pages.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """
+    Thread-safe LRU cache whose entries also expire ttl seconds after they
+    were stored. Keeps at most maxsize entries, evicting the least recently
+    used one first.
+    """
+
+    def __init__(self, maxsize=128, ttl=60, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None or item[0] <= self.clock():
+                self.misses += 1
+                return default
+            self._data[key] = item  # most recently used goes last
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (self.clock() + self.ttl, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
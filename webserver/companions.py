@@ -0,0 +1,205 @@
+"""
+"Trips you could join" on /trip.
+
+A trip is a candidate for a user when it starts within HORIZON_DAYS, goes
+somewhere within RADIUS_MILES of the user's home, doesn't overlap any trip
+the user is already on, and someone on it is a friend of the user (someone
+they added) or shares an activity with them. It scores 2 per friend and 1
+per other such member. Of the users sharing activities, only the
+MAX_FANOUT sharing the most are considered.
+
+Candidates are kept in TRIP_CANDIDATE and read by primary key. They are
+refreshed in the background (the "companions" job, see jobs.py) when trips
+change: /tripreq, /tripjoinreq, /tripaddmembers and /tripleavereq refresh
+the trip's rows for everyone it concerns (REFRESH_TRIP) and the acting
+user's own list, whose free dates just changed (REFRESH_USER), and the
+friend and activity routes refresh the user's list. Trip dates are
+compared as daterange(start_date, end_date, '[]') under a GiST index.
+
+Trips also come into the horizon just by time passing. The
+"companions_horizon" job, queued every HORIZON_CHECK_SECONDS by each
+process, moves COMPANIONS_HORIZON.through up to CURRENT_DATE +
+HORIZON_DAYS and queues refreshes, BATCH trips per job, for the trips that
+start in between. through starts out NULL, so the first run after
+migration 8 fills the table for every upcoming trip; the other runs of
+the day find nothing to do.
+"""
+
+import jobs
+from distance import EARTH_RADIUS_MILES
+from queries import query
+
+RADIUS_MILES = 500
+HORIZON_DAYS = 365
+PAGE_SIZE = 10
+MAX_FANOUT = 5000  # users sharing an activity considered per refresh
+BATCH = 50  # trips per job when the horizon moves
+HORIZON_CHECK_SECONDS = 3600
+
+DATES = "daterange(%(t)s.start_date, %(t)s.end_date, '[]')"
+
+# trips that haven't started and start within the horizon
+UPCOMING = '''%(dates)s && daterange(CURRENT_DATE,
+        CURRENT_DATE + %(horizon)d, '[]')
+    AND %(t)s.start_date >= CURRENT_DATE'''
+
+
+def _miles(a, b):
+    """Great-circle distance in SQL between locations aliased a and b."""
+    return '''(2 * %(r)r * asin(least(1, sqrt(
+        power(sin(radians(%(b)s.gps_lat - %(a)s.gps_lat) / 2), 2) +
+        cos(radians(%(a)s.gps_lat)) * cos(radians(%(b)s.gps_lat)) *
+        power(sin(radians(%(b)s.gps_long - %(a)s.gps_long) / 2), 2)))))''' % \
+        dict(a=a, b=b, r=EARTH_RADIUS_MILES)
+
+
+def _upcoming(t):
+    return UPCOMING % dict(dates=DATES % dict(t=t), t=t,
+                           horizon=HORIZON_DAYS)
+
+
+# every candidate trip of :uid
+REFRESH_USER = query('companions_user', '''WITH home AS (
+        SELECT location.gps_lat, location.gps_long FROM users
+        JOIN location ON location.lid = users.home WHERE users.uid = :uid),
+    mine AS (SELECT %(own)s AS dates FROM user_trip
+        JOIN trip own ON own.id = user_trip.trip_id
+        WHERE user_trip.user_id = :uid AND own.end_date >= CURRENT_DATE),
+    people AS (SELECT other, max(weight) AS weight FROM (
+        SELECT uid_2 AS other, 2 AS weight FROM user_friends
+            WHERE uid = :uid
+        UNION ALL (SELECT b.uid, 1 FROM user_activity a
+            JOIN user_activity b ON b.name = a.name AND b.uid <> a.uid
+            WHERE a.uid = :uid GROUP BY b.uid
+            ORDER BY count(*) DESC, b.uid LIMIT %(fanout)d)) AS p
+        GROUP BY other),
+    scored AS (SELECT trip.id AS trip_id, sum(people.weight) AS score
+        FROM people JOIN user_trip m ON m.user_id = people.other
+        JOIN trip ON trip.id = m.trip_id
+        JOIN location place ON place.lid = trip.lid, home
+        WHERE %(upcoming)s AND %(miles)s <= %(radius)d
+        AND NOT EXISTS (SELECT 1 FROM mine WHERE mine.dates && %(dates)s)
+        AND NOT EXISTS (SELECT 1 FROM user_trip
+            WHERE trip_id = trip.id AND user_id = :uid)
+        GROUP BY trip.id),
+    gone AS (DELETE FROM trip_candidate c WHERE c.uid = :uid
+        AND NOT EXISTS (SELECT 1 FROM scored
+                        WHERE scored.trip_id = c.trip_id))
+INSERT INTO trip_candidate AS c (uid, trip_id, score)
+    SELECT :uid, trip_id, score FROM scored
+    ON CONFLICT (uid, trip_id) DO UPDATE SET score = excluded.score''' % dict(
+    own=DATES % dict(t='own'), dates=DATES % dict(t='trip'),
+    upcoming=_upcoming('trip'), miles=_miles('home', 'place'),
+    radius=RADIUS_MILES, fanout=MAX_FANOUT))
+
+# the candidate rows of trip :trip, for every user
+REFRESH_TRIP = query('companions_trip', '''WITH t AS (
+        SELECT trip.id, %(dates)s AS dates, place.gps_lat, place.gps_long
+        FROM trip JOIN location place ON place.lid = trip.lid
+        WHERE trip.id = :trip AND %(upcoming)s),
+    members AS (SELECT user_id FROM user_trip WHERE trip_id = :trip),
+    pairs AS (SELECT uid, member, max(weight) AS weight FROM (
+        SELECT f.uid, members.user_id AS member, 2 AS weight
+            FROM members JOIN user_friends f ON f.uid_2 = members.user_id
+        UNION ALL (SELECT b.uid, members.user_id, 1 FROM members
+            JOIN user_activity a ON a.uid = members.user_id
+            JOIN user_activity b ON b.name = a.name AND b.uid <> a.uid
+            GROUP BY b.uid, members.user_id
+            ORDER BY count(*) DESC, b.uid, members.user_id
+            LIMIT %(fanout)d)) AS p GROUP BY uid, member),
+    scored AS (SELECT pairs.uid, sum(pairs.weight) AS score
+        FROM pairs JOIN users ON users.uid = pairs.uid
+        JOIN location home ON home.lid = users.home, t
+        WHERE pairs.uid NOT IN (SELECT user_id FROM members)
+        AND %(miles)s <= %(radius)d
+        AND NOT EXISTS (SELECT 1 FROM user_trip
+            JOIN trip own ON own.id = user_trip.trip_id
+            WHERE user_trip.user_id = pairs.uid AND %(own)s && t.dates)
+        GROUP BY pairs.uid),
+    gone AS (DELETE FROM trip_candidate c WHERE c.trip_id = :trip
+        AND NOT EXISTS (SELECT 1 FROM scored WHERE scored.uid = c.uid))
+INSERT INTO trip_candidate AS c (uid, trip_id, score)
+    SELECT uid, CAST(:trip AS integer), score FROM scored
+    ON CONFLICT (uid, trip_id) DO UPDATE SET score = excluded.score''' % dict(
+    dates=DATES % dict(t='trip'), own=DATES % dict(t='own'),
+    upcoming=_upcoming('trip'), miles=_miles('home', 't'),
+    radius=RADIUS_MILES, fanout=MAX_FANOUT))
+
+# [trip id, start, end, place, lid, score, friends going], best first
+PAGE = query('companions_page', '''SELECT trip.id, trip.start_date,
+        trip.end_date, location.name, location.lid, c.score,
+        (SELECT string_agg(users.name, ', ' ORDER BY users.name)
+            FROM user_trip JOIN user_friends f ON f.uid_2 = user_trip.user_id
+            JOIN users ON users.uid = f.uid_2
+            WHERE user_trip.trip_id = trip.id AND f.uid = :uid)
+    FROM trip_candidate c JOIN trip ON trip.id = c.trip_id
+    JOIN location ON location.lid = trip.lid
+    WHERE c.uid = :uid AND trip.start_date >= CURRENT_DATE
+    ORDER BY c.score DESC, trip.start_date, trip.id LIMIT :limit''')
+
+# moves the horizon to today's; returns the old one, or no row if it
+# already was today's
+ADVANCE = query('companions_advance', '''UPDATE companions_horizon h
+    SET through = CURRENT_DATE + %(horizon)d
+    FROM (SELECT through FROM companions_horizon) AS old
+    WHERE h.through IS DISTINCT FROM CURRENT_DATE + %(horizon)d
+    RETURNING old.through''' % dict(horizon=HORIZON_DAYS))
+
+# upcoming trips starting after :since (every upcoming trip when NULL)
+ENTERED = query('companions_entered', '''SELECT id FROM trip
+    WHERE %(upcoming)s
+    AND (CAST(:since AS date) IS NULL OR start_date > CAST(:since AS date))
+    ORDER BY id''' % dict(upcoming=_upcoming('trip')))
+
+PRUNE = query('companions_prune', '''DELETE FROM trip_candidate c
+    USING trip WHERE trip.id = c.trip_id
+    AND trip.start_date < CURRENT_DATE''')
+
+
+@jobs.job('companions')
+def refresh(conn, uids=(), trips=()):
+    """
+    The "companions" job: recomputes the candidates of each of uids and
+    every user's candidate rows for each of trips.
+    """
+    with conn.begin():
+        for trip in trips:
+            REFRESH_TRIP.execute(conn, trip=trip).close()
+        for uid in uids:
+            REFRESH_USER.execute(conn, uid=uid).close()
+
+
+@jobs.job('companions_horizon', every=HORIZON_CHECK_SECONDS)
+def advance(conn):
+    """
+    The "companions_horizon" job: queues the refresh of the trips that
+    came into the horizon since the last run, and drops the candidates of
+    trips that have started.
+    """
+    with conn.begin():
+        res = ADVANCE.execute(conn)
+        row = res.fetchone()
+        res.close()
+        if row is None:
+            return
+        res = ENTERED.execute(conn, since=row[0])
+        trips = [trip for trip, in res]
+        res.close()
+        PRUNE.execute(conn).close()
+        for start in range(0, len(trips), BATCH):
+            jobs.enqueue(conn, 'companions', trips=trips[start:start + BATCH])
+
+
+def changed(conn, uids, trips=()):
+    """
+    Queues the refresh after uids changed their trips, friends or
+    activities.
+    """
+    jobs.enqueue(conn, 'companions', uids=list(uids), trips=list(trips))
+
+
+def page(conn, uid, size=PAGE_SIZE):
+    res = PAGE.execute(conn, uid=uid, limit=size)
+    rows = res.fetchall()
+    res.close()
+    return rows
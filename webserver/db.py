@@ -0,0 +1,109 @@
+"""
+Database engine with an explicit connection pool, and the lazy per-request
+connection stored in g.conn.
+
+Pool settings come from credentials.json and can be overridden with
+environment variables:
+
+        credentials.json    environment          default
+        pool_size           DB_POOL_SIZE         5
+        max_overflow        DB_MAX_OVERFLOW      10
+        pool_pre_ping       DB_POOL_PRE_PING     true
+        pool_recycle        DB_POOL_RECYCLE      1800 (seconds)
+        pool_timeout        DB_POOL_TIMEOUT      30 (seconds)
+"""
+
+import os
+from timeit import default_timer
+
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+import metrics
+
+POOL_SETTINGS = (
+    # (credentials.json key, environment variable, type, default)
+    ('pool_size', 'DB_POOL_SIZE', int, 5),
+    ('max_overflow', 'DB_MAX_OVERFLOW', int, 10),
+    ('pool_pre_ping', 'DB_POOL_PRE_PING', bool, True),
+    ('pool_recycle', 'DB_POOL_RECYCLE', int, 1800),
+    ('pool_timeout', 'DB_POOL_TIMEOUT', float, 30),
+)
+
+CHECKOUT_SECONDS = metrics.histogram(
+    'db_pool_checkout_seconds',
+    'Time spent waiting for a pooled database connection')
+
+
+def _parse(kind, value):
+    if kind is bool and not isinstance(value, bool):
+        return str(value).lower() in ('1', 'true', 'yes', 'on')
+    return kind(value)
+
+
+def pool_options(creds):
+    """Pool keyword arguments for create_engine(), env over credentials."""
+    options = dict()
+    for key, env, kind, default in POOL_SETTINGS:
+        value = os.environ.get(env, creds.get(key, default))
+        options[key] = _parse(kind, value)
+    return options
+
+
+def make_engine(uri, creds, gauges=True):
+    """Creates the engine and, with gauges, publishes its pool state."""
+    options = pool_options(creds)
+    if uri.startswith('postgresql'):
+        # executemany() as batched round trips instead of one per row
+        options['executemany_mode'] = 'batch'
+    engine = create_engine(uri, poolclass=QueuePool, **options)
+    if not gauges:
+        return engine
+    metrics.gauge('db_pool_size', 'Configured pool size',
+                  lambda: engine.pool.size())
+    metrics.gauge('db_pool_checked_out', 'Connections currently in use',
+                  lambda: engine.pool.checkedout())
+    metrics.gauge('db_pool_overflow', 'Connections opened beyond pool_size',
+                  lambda: engine.pool.overflow())
+    return engine
+
+
+class LazyConnection(object):
+    """
+    Stands in for a Connection in g.conn. Nothing is checked out of the pool
+    until a route first uses it, so pages like /login never touch the
+    database. engine is anything with connect(): an Engine, or the
+    replicas.Reads of a read-only request, which picks a replica then.
+    """
+
+    def __init__(self, engine):
+        self._engine = engine
+        self._conn = None
+
+    @property
+    def checked_out(self):
+        return self._conn is not None
+
+    @property
+    def source(self):
+        """The Engine (or replicas.Reads) connections come from."""
+        return self._engine
+
+    def checkout(self):
+        if self._conn is None:
+            start = default_timer()
+            self._conn = self._engine.connect()
+            CHECKOUT_SECONDS.observe(default_timer() - start)
+        return self._conn
+
+    def sibling(self):
+        """Another lazy connection to the same engine (or replicas)."""
+        return LazyConnection(self._engine)
+
+    def __getattr__(self, name):
+        return getattr(self.checkout(), name)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,145 @@
+"""
+Per-user home page feed, written on fan-out.
+
+Routes that change something other users care about queue a "feed" job
+(see jobs.py) for the event, and a single statement appends it to the feed
+of every user it concerns:
+
+        trip       a friend planned a trip             (/tripreq)
+        join       a friend joined a trip, or someone
+                   joined a trip you are on            (/tripjoinreq)
+        review     a new review of a place you've
+                   been to                             (/reviewsubmit)
+        rental     a rental request for your lease     (/rentalreq)
+
+("Friends" are the users who added the actor as a friend.) Each feed is a
+ring of SIZE slots: FEED_HEAD holds the user's latest sequence number and
+event seq lives in FEED_EVENT slot seq mod SIZE, so old events are
+overwritten in place and a feed never grows. Reading a page looks up its
+slots by primary key, O(page size) whatever the user's history. Event
+bodies are small JSON objects with the names already resolved, so the page
+needs no joins.
+"""
+
+import json
+
+import jobs
+from queries import query
+
+SIZE = 200        # events kept per user
+PAGE_SIZE = 20
+MAX_FANOUT = 5000  # recipients of a single event (popular places)
+
+# recipients (a uid column) and body (one json value) are per event kind;
+# nothing is written when the body is empty (e.g. the trip is gone)
+FANOUT = '''WITH recipients AS (%(recipients)s),
+    body AS (%(body)s),
+    heads AS (INSERT INTO feed_head AS h (uid, seq)
+        SELECT DISTINCT uid, 1 FROM recipients
+        WHERE EXISTS (SELECT 1 FROM body)
+        ORDER BY uid  -- rows locked in the same order by every writer
+        ON CONFLICT (uid) DO UPDATE SET seq = h.seq + 1
+        RETURNING uid, seq)
+INSERT INTO feed_event AS e (uid, slot, seq, kind, body, created_at)
+    SELECT heads.uid, mod(heads.seq, %(size)d), heads.seq, '%(kind)s',
+        body.body, now()
+    FROM heads, body
+    ON CONFLICT (uid, slot) DO UPDATE SET seq = excluded.seq,
+        kind = excluded.kind, body = excluded.body,
+        created_at = excluded.created_at'''
+
+FOLLOWERS = '''SELECT uid FROM user_friends WHERE uid_2 = :uid'''
+
+TRIP_BODY = '''SELECT json_build_object('user', users.name, 'trip', trip.id,
+        'place', location.name, 'start', trip.start_date,
+        'end', trip.end_date) AS body
+    FROM trip JOIN location ON location.lid = trip.lid, users
+    WHERE trip.id = :trip AND users.uid = :uid'''
+
+
+def _event(kind, recipients, body):
+    return query('feed_' + kind, FANOUT % dict(
+        recipients=recipients, body=body, kind=kind, size=SIZE))
+
+
+TRIP = _event('trip', FOLLOWERS, TRIP_BODY)
+
+JOIN = _event('join', FOLLOWERS + '''
+    UNION SELECT user_id FROM user_trip
+        WHERE trip_id = :trip AND user_id <> :uid''', TRIP_BODY)
+
+# everyone who has been to the place (a trip there has started)
+REVIEW = _event('review', '''SELECT DISTINCT user_id AS uid FROM user_trip
+        JOIN trip ON id = trip_id
+        WHERE trip.lid = :lid AND start_date <= CURRENT_DATE
+        AND user_id <> :uid
+        LIMIT %d''' % MAX_FANOUT,
+    '''SELECT json_build_object('user', users.name, 'place', location.name,
+        'lid', location.lid, 'rating', CAST(:rating AS integer)) AS body
+    FROM location, users WHERE location.lid = :lid AND users.uid = :uid''')
+
+RENTAL = _event('rental', '''SELECT CAST(:owner AS integer) AS uid''',
+    '''SELECT json_build_object('user', name,
+        'address', CAST(:address AS text), 'start', CAST(:start AS date),
+        'end', CAST(:end AS date)) AS body
+    FROM users WHERE uid = :uid''')
+
+# the page of events ending at :before (the newest when NULL), newest first
+PAGE = query('feed_page', '''SELECT e.seq, e.kind, e.body, e.created_at
+    FROM feed_head h
+    CROSS JOIN generate_series(0, CAST(:limit AS integer) - 1) AS i
+    JOIN feed_event e ON e.uid = h.uid
+        AND e.slot = mod(least(h.seq, coalesce(CAST(:before AS bigint),
+                                                h.seq)) - i, %d)
+        AND e.seq = least(h.seq, coalesce(CAST(:before AS bigint),
+                                          h.seq)) - i
+    WHERE h.uid = :uid
+    ORDER BY e.seq DESC''' % SIZE)
+
+EVENTS = dict(trip=TRIP, join=JOIN, review=REVIEW, rental=RENTAL)
+
+TEMPLATES = dict(
+    trip=u'{user} is going to {place} ({start} to {end})',
+    join=u'{user} joined the trip to {place} ({start} to {end})',
+    review=u'{user} rated {place}, where you have been, {rating}/5',
+    rental=u'{user} asked to rent {address} from {start} to {end}',
+)
+
+
+def publish(conn, event, **params):
+    """Appends one event (TRIP, JOIN, REVIEW or RENTAL) to its feeds."""
+    event.execute(conn, **params).close()
+
+
+@jobs.job('feed')
+def fan_out(conn, event, params):
+    """The "feed" job: publishes EVENTS[event] with params."""
+    publish(conn, EVENTS[event], **params)
+
+
+def describe(kind, body):
+    if not isinstance(body, dict):  # json passed through as text
+        body = json.loads(body)
+    try:
+        return TEMPLATES[kind].format(**body)
+    except (KeyError, IndexError):
+        return kind
+
+
+def entries(rows, size=PAGE_SIZE):
+    """
+    Feed rows as [seq, text, created_at] for the template, and the
+    ?before= of the next page (None on the last one).
+    """
+    events = [[row[0], describe(row[1], row[2]), row[3]] for row in rows]
+    following = None
+    if len(events) == size and events[-1][0] > 1:
+        following = events[-1][0] - 1
+    return events, following
+
+
+def page(conn, uid, before=None, size=PAGE_SIZE):
+    res = PAGE.execute(conn, uid=uid, before=before, limit=size)
+    rows = res.fetchall()
+    res.close()
+    return entries(rows, size)
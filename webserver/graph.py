@@ -0,0 +1,325 @@
+"""
+In-memory friend graph for mutual-friend counts and friend-of-friend
+suggestions (/friend, /).
+
+USER_FRIENDS is held in compressed sparse row form: IDS are the sorted
+uids, and the friends (the users they added) of the user in row r are the
+rows INDICES[INDPTR[r]:INDPTR[r + 1]], sorted. That is 4 bytes per edge
+plus 16 per user, so 50M edges over 1M users take about 220MB, and a
+user's friends are one slice. Friends of friends are gathered for all of a
+user's friends at once with numpy, looking at no more than max_paths
+second-hop edges, so a popular user costs no more than anyone else.
+
+The arrays are built in bulk from the database the first time the graph
+is needed. /friendaddreq and /friendremovereq patch a small overlay of
+added and removed edges in front of them, and once the overlay holds
+max_delta edges a background thread merges it into new arrays. Like the
+recommender, each process keeps its own copy: the routes log the edges
+they change as 'friends' changes, which every other process replays into
+its overlay (see versions.Watch); only a bulk reload rebuilds the arrays
+from the database, in the background.
+"""
+
+import threading
+from collections import defaultdict
+
+import numpy as np
+from sqlalchemy import text
+
+import streaming
+import versions
+from recommend import USER_NAMES
+
+CHUNK = 100000      # edges per fetch while loading
+MAX_DELTA = 100000  # overlay edges before merging into the arrays
+MAX_PATHS = 200000  # second-hop edges looked at per suggestion query
+
+
+def _gather(indptr, indices, rows, max_paths):
+    """The concatenated rows' slices of indices, at most max_paths long."""
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    ends = np.cumsum(lengths)
+    if ends.size and ends[-1] > max_paths:
+        keep = int(np.searchsorted(ends, max_paths, side='right'))
+        starts, lengths, ends = starts[:keep], lengths[:keep], ends[:keep]
+    if not ends.size:
+        return indices[:0]
+    offsets = np.repeat(starts - (ends - lengths), lengths)
+    return indices[offsets + np.arange(ends[-1])]
+
+
+def _csr(sources, targets):
+    """(ids, indptr, indices) for the edges sources[i] -> targets[i]."""
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    ids = np.unique(np.concatenate((sources, targets)))
+    rows = np.searchsorted(ids, sources)
+    # one sort of (row, column) packed into an int64
+    keys = rows << 32 | np.searchsorted(ids, targets)
+    keys.sort()
+    indptr = np.zeros(ids.size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=ids.size), out=indptr[1:])
+    return ids, indptr, (keys & 0xffffffff).astype(np.int32)
+
+
+class FriendGraph(object):
+
+    def __init__(self, max_delta=MAX_DELTA, max_paths=MAX_PATHS,
+                 refresh=versions.POLL_SECONDS):
+        self.max_delta = max_delta
+        self.max_paths = max_paths
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.indices = np.zeros(0, dtype=np.int32)
+        self.added = defaultdict(set)    # uid -> uids added since the build
+        self.removed = defaultdict(set)  # uid -> uids removed since
+        self.delta = 0  # edges in the overlay
+        self.loaded = False
+        self.generation = 0  # arrays replaced from the database
+        self.watch = versions.Watch(['friends'], refresh)
+        self._log = None  # edges patched while a rebuild reads the table
+        self._merging = False
+        self._lock = threading.RLock()
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.indptr.nbytes + self.indices.nbytes
+
+    def _read(self, conn, chunk=CHUNK):
+        """(last change, sources, targets) of USER_FRIENDS as it is now."""
+        seen = self.watch.snapshot(conn)
+        sources, targets = list(), list()
+        res = streaming.cursor(conn, chunk).execute(
+            text('SELECT uid, uid_2 FROM user_friends'))
+        while True:
+            rows = res.fetchmany(chunk)
+            if not rows:
+                break
+            pairs = np.array([tuple(row) for row in rows], dtype=np.int64)
+            sources.append(pairs[:, 0])
+            targets.append(pairs[:, 1])
+        res.close()
+        if not sources:
+            return seen, np.zeros(0, dtype=np.int64), \
+                np.zeros(0, dtype=np.int64)
+        return seen, np.concatenate(sources), np.concatenate(targets)
+
+    def load(self, conn, chunk=CHUNK):
+        """
+        Builds the arrays from USER_FRIENDS on first use; later replays the
+        edges other processes changed.
+        """
+        with self._lock:
+            if not self.loaded:
+                seen, sources, targets = self._read(conn, chunk)
+                self.build(sources, targets)
+                self.loaded = True
+                self.watch.built(seen)
+                return
+        self.watch.check(conn, self._rebuild, self._apply)
+
+    def _apply(self, name, change):
+        uid, other, present = change
+        self._change(int(uid), int(other), present)
+
+    def _rebuild(self, conn):
+        with self._lock:
+            self._log = list()
+        seen, sources, targets = self._read(conn)
+        arrays = _csr(sources, targets)
+        del sources, targets
+        with self._lock:
+            log, self._log = self._log, None
+            self._replace(arrays)
+            # edges patched after the read started
+            for uid, other, present in log:
+                self._patch(uid, other, present)
+            self.watch.built(seen)
+
+    def build(self, sources, targets):
+        """Replaces the graph with the edges sources[i] -> targets[i]."""
+        arrays = _csr(sources, targets)
+        with self._lock:
+            self._replace(arrays)
+
+    def _replace(self, arrays):
+        self.ids, self.indptr, self.indices = arrays
+        self.added.clear()
+        self.removed.clear()
+        self.delta = 0
+        self.generation += 1
+
+    def _row(self, uid):
+        r = int(np.searchsorted(self.ids, uid))
+        if r < self.ids.size and self.ids[r] == uid:
+            return r
+        return None
+
+    def friends(self, uid):
+        """The sorted uids uid has added."""
+        uid = int(uid)
+        with self._lock:
+            r = self._row(uid)
+            if r is None:
+                base = self.ids[:0]
+            else:
+                base = self.ids[self.indices[self.indptr[r]:
+                                             self.indptr[r + 1]]]
+            removed = self.removed.get(uid)
+            added = self.added.get(uid)
+            if removed:
+                base = np.setdiff1d(base, list(removed), assume_unique=True)
+            if added:
+                base = np.union1d(base, list(added))
+            return base
+
+    def mutual(self, uid, other):
+        """How many users both uid and other have added."""
+        return int(np.intersect1d(self.friends(uid), self.friends(other),
+                                  assume_unique=True).size)
+
+    def suggestions(self, uid, limit=20):
+        """
+        [uid, mutual friends] for the friends of uid's friends that uid
+        hasn't added, most mutual friends first.
+        """
+        uid = int(uid)
+        with self._lock:
+            friends = self.friends(uid)
+            rows = np.searchsorted(self.ids, friends)
+            rows = np.minimum(rows, max(self.ids.size - 1, 0))
+            present = self.ids[rows] == friends if self.ids.size else \
+                np.zeros(friends.size, dtype=bool)
+            # friends whose own friends changed since the build
+            patched = [f for f in friends.tolist()
+                       if f in self.added or f in self.removed]
+            plain = rows[present & ~np.isin(friends, patched)]
+            hops = [self.ids[_gather(self.indptr, self.indices, plain,
+                                     self.max_paths)]]
+            for f in patched:
+                hops.append(self.friends(f))
+        hops = np.concatenate(hops)[:self.max_paths]
+        hops = hops[(hops != uid) & ~np.isin(hops, friends)]
+        if not hops.size:
+            return []
+        candidates, counts = np.unique(hops, return_counts=True)
+        order = np.lexsort((candidates, -counts))[:limit]
+        return [[int(candidates[i]), int(counts[i])] for i in order]
+
+    def _in_base(self, uid, other):
+        r, c = self._row(uid), self._row(other)
+        if r is None or c is None:
+            return False
+        edges = self.indices[self.indptr[r]:self.indptr[r + 1]]
+        i = int(np.searchsorted(edges, c))
+        return i < edges.size and edges[i] == c
+
+    def _patch(self, uid, other, present):
+        """Makes the edge uid -> other present (or not) in the overlay."""
+        undo, do = (self.removed, self.added) if present else \
+            (self.added, self.removed)
+        if other in undo.get(uid, ()):
+            undo[uid].discard(other)
+            if not undo[uid]:
+                del undo[uid]
+            self.delta -= 1
+        elif present != self._in_base(uid, other) and \
+                other not in do.get(uid, ()):
+            do[uid].add(other)
+            self.delta += 1
+            self._maybe_merge()
+
+    def add(self, uid, other):
+        self._change(int(uid), int(other), True)
+
+    def remove(self, uid, other):
+        self._change(int(uid), int(other), False)
+
+    def _change(self, uid, other, present):
+        with self._lock:
+            if self.loaded:
+                self._patch(uid, other, present)
+                if self._log is not None:
+                    self._log.append((uid, other, present))
+
+    def _has(self, uid, other):
+        if other in self.removed.get(uid, ()):
+            return False
+        return other in self.added.get(uid, ()) or \
+            self._in_base(uid, other)
+
+    def _overlay(self):
+        return [(u, v) for overlay in (self.added, self.removed)
+                for u, vs in overlay.items() for v in vs]
+
+    def _maybe_merge(self):
+        if self.delta >= self.max_delta and not self._merging:
+            self._merging = True
+            worker = threading.Thread(target=self.merge, name='graph-merge')
+            worker.daemon = True
+            worker.start()
+
+    def merge(self):
+        """
+        Folds the overlay into new arrays. The arrays are built without
+        holding the lock, so requests carry on meanwhile; edges patched
+        during the build stay in the overlay. A merge that a rebuild from
+        the database overtook is dropped.
+        """
+        with self._lock:
+            self._merging = True
+            generation = self.generation
+            ids, indptr, indices = self.ids, self.indptr, self.indices
+            added = [(u, v) for u, vs in self.added.items() for v in vs]
+            removed = [(u, v) for u, vs in self.removed.items() for v in vs]
+        try:
+            sources = np.repeat(ids, np.diff(indptr))
+            targets = ids[indices]
+            if removed:
+                gone = np.array(removed, dtype=np.int64)
+                keep = ~np.isin(sources << 32 | targets,
+                                gone[:, 0] << 32 | gone[:, 1])
+                sources, targets = sources[keep], targets[keep]
+            if added:
+                new = np.array(added, dtype=np.int64)
+                sources = np.concatenate((sources, new[:, 0]))
+                targets = np.concatenate((targets, new[:, 1]))
+            arrays = _csr(sources, targets)
+            del sources, targets
+            with self._lock:
+                if self.generation != generation:
+                    return
+                touched = set(added) | set(removed) | set(self._overlay())
+                present = [(u, v, self._has(u, v)) for u, v in touched]
+                self.ids, self.indptr, self.indices = arrays
+                self.added.clear()
+                self.removed.clear()
+                self.delta = 0
+                for u, v, edge in present:
+                    if edge != self._in_base(u, v):
+                        (self.added if edge else self.removed)[u].add(v)
+                        self.delta += 1
+        finally:
+            self._merging = False
+
+
+GRAPH = FriendGraph()
+
+
+def mutual_counts(conn, uid, others):
+    """How many friends uid has in common with each of others."""
+    GRAPH.load(conn)
+    return [GRAPH.mutual(uid, other) for other in others]
+
+
+def suggestion_rows(conn, uid, limit=20):
+    """Friends of friends as [uid, name, mutual friends], for /friend."""
+    GRAPH.load(conn)
+    rows = GRAPH.suggestions(uid, limit)
+    names = dict()
+    if rows:
+        res = USER_NAMES.execute(conn, uids=[row[0] for row in rows])
+        names = dict(res.fetchall())
+        res.close()
+    return [[row[0], names.get(row[0]), row[1]] for row in rows]
@@ -0,0 +1,108 @@
+"""
+Rendered-page and HTTP caching for read-mostly pages.
+
+        @app.route('/reviews')
+        @httpcache.cached_page(lambda: ['reviews'])
+        def reviews(): ...
+
+        httpcache.bump(g.conn, 'reviews')   # in the routes that change reviews
+
+A page is cached per (endpoint, query string, versions of the data it
+shows), and per user for pages made with per_user=True; other pages only
+tell logged-in visitors from the rest. Mutating routes bump() those
+versions, which changes the key, so stale entries are simply never looked
+up again. Each response carries a strong ETag for its key; a conditional
+GET whose If-None-Match still matches gets a 304 before the view runs,
+after one lookup of the versions.
+
+The versions live in the database (see versions.py) and are read from the
+primary once per request, so a change made through any process is seen by
+all of them on their next request. A page rendered from a replica that has
+not caught up with those versions yet is sent but not cached.
+"""
+
+import hashlib
+import threading
+from functools import wraps
+
+from flask import g, make_response, request, session
+
+import metrics
+import versions
+from cache import TTLCache
+
+TTL = 60
+PAGES = TTLCache(maxsize=1024, ttl=TTL)
+
+_lock = threading.Lock()
+_counts = dict(hit=0, miss=0, not_modified=0)
+
+
+def bump(conn, *names):
+    """Marks the data behind names as changed, for every process."""
+    versions.bump(conn, *names)
+
+
+def _count(outcome):
+    with _lock:
+        _counts[outcome] += 1
+
+
+def hit_ratio():
+    total = sum(_counts.values())
+    return (_counts['hit'] + _counts['not_modified']) / float(total) \
+        if total else 0.0
+
+
+metrics.gauge('http_cache_hit_ratio',
+              'Share of cached-page requests served without rendering',
+              hit_ratio)
+metrics.gauge('http_cache_not_modified', '304 responses sent',
+              lambda: _counts['not_modified'])
+metrics.gauge('http_cache_entries', 'Rendered pages in the cache',
+              lambda: len(PAGES))
+
+
+def page_key(current, per_user=False):
+    uid = session.get('uid')
+    user = uid if per_user else uid is not None
+    return repr((request.endpoint, request.query_string, user,
+                 sorted(current.items())))
+
+
+def etag_for(key):
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:24]
+
+
+def cached_page(names, per_user=False):
+    """
+    names is called inside the request and returns the names of the data
+    versions the page depends on; per_user pages show the user's own data.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            current = versions.latest(g.conn, names())
+            etag = etag_for(page_key(current, per_user))
+            if request.if_none_match.contains(etag):
+                _count('not_modified')
+                response = make_response('', 304)
+            else:
+                body = PAGES.get(etag)
+                if body is not None:
+                    _count('hit')
+                    response = make_response(body)
+                else:
+                    _count('miss')
+                    response = make_response(view(*args, **kwargs))
+                    # streamed pages (see streaming.py) are never buffered
+                    if response.status_code != 200 or response.is_streamed:
+                        return response
+                    if versions.on_primary(g.conn) or versions.current(
+                            g.conn, list(current)) == current:
+                        PAGES.set(etag, response.get_data())
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
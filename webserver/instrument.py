@@ -0,0 +1,144 @@
+"""
+Per-request performance instrumentation.
+
+install() hooks Flask's request and template signals and SQLAlchemy's
+cursor events, and for every request records, per route:
+
+        http_request_seconds          wall time
+        http_request_db_seconds       time spent in database cursors
+        http_request_render_seconds   time spent rendering templates
+        http_request_queries          number of statements executed
+        http_request_rows             rows fetched
+
+as p50/p95/p99 summaries in metrics.REGISTRY (served at /metrics).
+Statements slower than the slow_query_ms threshold (credentials.json, or
+the SLOW_QUERY_MS environment variable; 200ms by default) are logged to the
+"slow_query" logger together with the route that ran them. Statements a
+request runs on other threads (parallel.py) count towards it through
+bind().
+"""
+
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from timeit import default_timer
+
+from flask import before_render_template, g, has_request_context, request
+from flask import template_rendered
+from sqlalchemy import event
+
+import metrics
+
+ROUTE = ('route', 'method')
+
+REQUEST_SECONDS = metrics.summary(
+    'http_request_seconds', 'Request wall time', ROUTE)
+DB_SECONDS = metrics.summary(
+    'http_request_db_seconds', 'Database time per request', ROUTE)
+RENDER_SECONDS = metrics.summary(
+    'http_request_render_seconds', 'Template render time per request', ROUTE)
+QUERIES = metrics.summary(
+    'http_request_queries', 'Statements executed per request', ROUTE)
+ROWS = metrics.summary(
+    'http_request_rows', 'Rows fetched per request', ROUTE)
+QUERY_SECONDS = metrics.histogram(
+    'db_query_seconds', 'Duration of single statements', ('route',))
+
+slow_log = logging.getLogger('slow_query')
+
+_bound = threading.local()  # stats and route of bind()
+_lock = threading.Lock()    # a request's stats may be shared by threads
+
+
+def slow_query_threshold(creds):
+    """Seconds above which a statement is logged as slow."""
+    return float(os.environ.get('SLOW_QUERY_MS',
+                                creds.get('slow_query_ms', 200))) / 1000.0
+
+
+def _route():
+    if not has_request_context():
+        return getattr(_bound, 'route', None) or 'background'
+    if request.url_rule is not None:
+        return request.url_rule.rule
+    return 'unmatched'
+
+
+def _stats():
+    if has_request_context():
+        return getattr(g, 'perf', None)
+    return getattr(_bound, 'stats', None)
+
+
+def current():
+    """(stats, route) of the request being handled, for bind()."""
+    return _stats(), _route()
+
+
+@contextmanager
+def bind(stats, route):
+    """Counts the statements run on this thread towards another request."""
+    _bound.stats, _bound.route = stats, route
+    try:
+        yield
+    finally:
+        _bound.stats = _bound.route = None
+
+
+def install(app, engines, slow_query_seconds=0.2):
+
+    @app.before_request
+    def start_timer():
+        g.perf = dict(start=default_timer(), db=0.0, queries=0, rows=0,
+                      render=0.0, render_start=None)
+
+    @app.teardown_request
+    def record(exception):
+        stats = _stats()
+        if stats is None:
+            return
+        labels = (_route(), request.method)
+        REQUEST_SECONDS.observe(default_timer() - stats['start'], *labels)
+        DB_SECONDS.observe(stats['db'], *labels)
+        RENDER_SECONDS.observe(stats['render'], *labels)
+        QUERIES.observe(stats['queries'], *labels)
+        ROWS.observe(stats['rows'], *labels)
+
+    def render_started(sender, template, context, **extra):
+        stats = _stats()
+        if stats is not None:
+            stats['render_start'] = default_timer()
+
+    def render_finished(sender, template, context, **extra):
+        stats = _stats()
+        if stats is not None and stats['render_start'] is not None:
+            stats['render'] += default_timer() - stats['render_start']
+            stats['render_start'] = None
+
+    before_render_template.connect(render_started, app, weak=False)
+    template_rendered.connect(render_finished, app, weak=False)
+
+    def query_started(conn, cursor, statement, parameters, context,
+                      executemany):
+        conn.info.setdefault('query_start', []).append(default_timer())
+
+    def query_finished(conn, cursor, statement, parameters, context,
+                       executemany):
+        elapsed = default_timer() - conn.info['query_start'].pop()
+        stats = _stats()
+        route = _route() if stats is not None else 'background'
+        QUERY_SECONDS.observe(elapsed, route)
+        if stats is not None:
+            with _lock:
+                stats['db'] += elapsed
+                stats['queries'] += 1
+                if cursor.description is not None and cursor.rowcount > 0:
+                    stats['rows'] += cursor.rowcount
+        if elapsed >= slow_query_seconds:
+            slow_log.warning('%.1f ms in %s: %s', elapsed * 1e3, route,
+                             ' '.join(statement.split()))
+
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', query_started)
+        event.listen(engine, 'after_cursor_execute', query_finished)
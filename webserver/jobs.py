@@ -0,0 +1,331 @@
+"""
+Background jobs for the work a POST doesn't have to wait for.
+
+A job is a named function taking a connection and keyword arguments:
+
+        @jobs.job('feed')
+        def fan_out(conn, event, params): ...
+
+and a route enqueues it and redirects straight away:
+
+        jobs.enqueue(g.conn, 'feed', event='trip', params=dict(uid=1, trip=7))
+
+A job registered with every=seconds is also queued by each process that
+many seconds apart (the first time when its workers start), so it must
+cope with running several times in a row, e.g. by doing nothing when the
+work is already done.
+
+Jobs run on a small pool of worker threads, each on its own pooled
+connection. A job that raises is retried with exponential backoff (with
+jitter) up to max_attempts times, then logged as failed.
+
+By default the queue is in process and bounded: when it is full the job
+runs inline in the request instead. With "durable": true jobs are rows of
+JOB_QUEUE (migration 4) in the application database instead. The workers
+of every process claim them with SELECT ... FOR UPDATE SKIP LOCKED, and
+run each job in the same transaction that deletes its row, so a job's
+database work is done exactly once even if a worker dies halfway (the row
+just becomes visible again). Arguments must be JSON serializable either way.
+
+        credentials.json: "jobs": {"workers": 2, "maxsize": 1000,
+                                   "max_attempts": 5, "backoff": 0.5,
+                                   "durable": false}
+
+/metrics shows job_queue_depth, job_lag_seconds (due to started) and
+job_seconds (by job and outcome).
+"""
+
+import heapq
+import json
+import logging
+import os
+import random
+import threading
+import time
+from timeit import default_timer
+
+from sqlalchemy import text
+
+import metrics
+from queries import query
+
+log = logging.getLogger('jobs')
+
+JOBS = dict()
+EVERY = dict()  # name -> seconds between runs, for periodic jobs
+
+LAG_SECONDS = metrics.histogram(
+    'job_lag_seconds', 'Time from a job being due to it starting', ('job',))
+JOB_SECONDS = metrics.histogram(
+    'job_seconds', 'Job run time', ('job', 'outcome'))
+
+ENQUEUE = query('job_enqueue', '''INSERT INTO job_queue(name, args)
+    VALUES (:name, CAST(:args AS json))''')
+
+CLAIM = query('job_claim', '''SELECT id, name, args, attempts,
+        extract(epoch FROM now() - run_at)
+    FROM job_queue WHERE failed_at IS NULL AND run_at <= now()
+    ORDER BY run_at LIMIT 1 FOR UPDATE SKIP LOCKED''')
+
+DONE = query('job_done', '''DELETE FROM job_queue WHERE id = :id''')
+
+RETRY = query('job_retry', '''UPDATE job_queue SET attempts = attempts + 1,
+        last_error = CAST(:error AS text),
+        run_at = now() + CAST(:delay AS double precision) * interval '1 s',
+        failed_at = CASE WHEN attempts + 1 >= CAST(:max_attempts AS integer)
+                    THEN now() END
+    WHERE id = :id''')
+
+
+def job(name, every=None):
+    """
+    Registers the decorated function as the job called name, queued every
+    every seconds if given.
+    """
+    def decorator(fn):
+        JOBS[name] = fn
+        if every is not None:
+            EVERY[name] = every
+        return fn
+    return decorator
+
+
+class JobQueue(object):
+    """
+    In-process queue: a heap of (due time, sequence, job) shared by the
+    worker threads, bounded at maxsize jobs waiting.
+    """
+
+    def __init__(self, engine, workers=2, maxsize=1000, max_attempts=5,
+                 backoff=0.5):
+        self.engine = engine
+        self.workers = workers
+        self.maxsize = maxsize
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.counts = dict(done=0, retried=0, failed=0, inline=0)
+        self._heap = list()
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._pid = None
+        self._stopping = False
+        self._halt = threading.Event()  # wakes the scheduler on stop()
+
+    def start(self):
+        """Starts the workers once per process (so again after a fork)."""
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopping = False
+            self._halt.clear()
+        for i in range(self.workers):
+            worker = threading.Thread(target=self._work,
+                                      name='job-worker-%d' % i)
+            worker.daemon = True
+            worker.start()
+        if EVERY:
+            scheduler = threading.Thread(target=self._schedule,
+                                         name='job-scheduler')
+            scheduler.daemon = True
+            scheduler.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._halt.set()
+
+    def depth(self):
+        return len(self._heap)
+
+    def _schedule(self):
+        """Queues the periodic jobs (EVERY) when they are due."""
+        due = dict((name, 0) for name in EVERY)
+        while not self._halt.is_set():
+            now = time.time()
+            for name, seconds in EVERY.items():
+                if due[name] > now:
+                    continue
+                due[name] = now + seconds
+                try:
+                    with self.engine.connect() as conn:
+                        self.put(conn, name, {})
+                except Exception:
+                    log.exception('could not queue job %s', name)
+            self._halt.wait(max(min(due.values()) - time.time(), 0))
+
+    def put(self, conn, name, kwargs):
+        with self._cond:
+            if len(self._heap) < self.maxsize:
+                self._push(time.time(), [name, kwargs, 0])
+                return
+        # full: do it now rather than drop it
+        self.counts['inline'] += 1
+        JOBS[name](conn, **kwargs)
+
+    def _push(self, due, item):
+        self._seq += 1
+        heapq.heappush(self._heap, (due, self._seq, item))
+        self._cond.notify()
+
+    def _take(self):
+        """The next due job as (lag, item), or None once stopped."""
+        with self._cond:
+            while True:
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    due, _, item = heapq.heappop(self._heap)
+                    return now - due, item
+                if self._stopping and not self._heap:
+                    return None
+                timeout = self._heap[0][0] - now if self._heap else None
+                self._cond.wait(timeout)
+
+    def _work(self):
+        while True:
+            taken = self._take()
+            if taken is None:
+                return
+            lag, (name, kwargs, attempts) = taken
+            LAG_SECONDS.observe(lag, name)
+            try:
+                self._run(name, kwargs)
+            except Exception as e:
+                delay = self._failed(name, attempts, e)
+                if delay is not None:
+                    with self._cond:
+                        self._push(time.time() + delay,
+                                   [name, kwargs, attempts + 1])
+
+    def _run(self, name, kwargs, conn=None):
+        start = default_timer()
+        outcome = 'error'
+        own = conn is None
+        if own:
+            conn = self.engine.connect()
+        try:
+            JOBS[name](conn, **kwargs)
+            outcome = 'ok'
+            self.counts['done'] += 1
+        finally:
+            if own:
+                conn.close()
+            JOB_SECONDS.observe(default_timer() - start, name, outcome)
+
+    def _failed(self, name, attempts, error):
+        """Logs a failure; returns the retry delay, or None to give up."""
+        if attempts + 1 >= self.max_attempts:
+            self.counts['failed'] += 1
+            log.error('job %s failed after %d attempts: %r', name,
+                      attempts + 1, error)
+            return None
+        self.counts['retried'] += 1
+        log.warning('job %s failed (attempt %d), retrying: %r', name,
+                    attempts + 1, error)
+        return self.backoff * 2 ** attempts * random.uniform(1, 2)
+
+
+class DurableQueue(JobQueue):
+    """Jobs as rows of JOB_QUEUE, shared by every process."""
+
+    poll = 0.5  # seconds between looks at an empty queue
+
+    def __init__(self, *args, **kwargs):
+        super(DurableQueue, self).__init__(*args, **kwargs)
+        self._wake = threading.Event()
+
+    def depth(self):
+        with self.engine.connect() as conn:
+            return conn.execute(text('SELECT count(*) FROM job_queue '
+                                     'WHERE failed_at IS NULL')).scalar()
+
+    def stop(self):
+        super(DurableQueue, self).stop()
+        self._wake.set()
+
+    def put(self, conn, name, kwargs):
+        ENQUEUE.execute(conn, name=name, args=json.dumps(kwargs)).close()
+        self._wake.set()
+
+    def _work(self):
+        conn = None
+        while not self._stopping:
+            try:
+                if conn is None:
+                    conn = self.engine.connect()
+                if not self._claim(conn):
+                    self._wake.wait(self.poll)
+                    self._wake.clear()
+            except Exception:
+                log.exception('job worker lost its connection')
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                time.sleep(self.poll)
+        if conn is not None:
+            conn.close()
+
+    def _claim(self, conn):
+        """Runs one due job, if there is one; returns whether there was."""
+        tx = conn.begin()
+        row = None
+        try:
+            row = CLAIM.execute(conn).fetchone()
+            if row is None:
+                tx.commit()
+                return False
+            id, name, kwargs, attempts, lag = row
+            LAG_SECONDS.observe(max(float(lag), 0.0), name)
+            if not isinstance(kwargs, dict):
+                kwargs = json.loads(kwargs)
+            self._run(name, kwargs, conn)
+            DONE.execute(conn, id=id).close()
+            tx.commit()
+        except Exception as e:
+            tx.rollback()
+            if row is None:
+                raise
+            delay = self._failed(row[1], row[3], e)
+            with conn.begin():
+                RETRY.execute(conn, id=row[0], error=repr(e),
+                              delay=delay or 0,
+                              max_attempts=self.max_attempts).close()
+        return True
+
+
+QUEUE = None
+
+
+def configure(engine, creds):
+    """Creates the queue from credentials.json's "jobs" settings."""
+    global QUEUE
+    config = creds.get('jobs', {})
+    kind = DurableQueue if config.get('durable') else JobQueue
+    QUEUE = kind(engine, workers=config.get('workers', 2),
+                 maxsize=config.get('maxsize', 1000),
+                 max_attempts=config.get('max_attempts', 5),
+                 backoff=config.get('backoff', 0.5))
+    metrics.gauge('job_queue_depth', 'Jobs waiting to run',
+                  lambda: QUEUE.depth())
+    for outcome in ('done', 'retried', 'failed', 'inline'):
+        metrics.gauge('jobs_%s' % outcome, 'Jobs %s so far' % outcome,
+                      lambda outcome=outcome: QUEUE.counts[outcome])
+    return QUEUE
+
+
+def ensure_started():
+    if QUEUE is not None:
+        QUEUE.start()
+
+
+def enqueue(conn, name, **kwargs):
+    """
+    Queues the job called name. Without a configured queue it runs inline
+    on conn.
+    """
+    if QUEUE is None:
+        JOBS[name](conn, **kwargs)
+        return
+    QUEUE.start()
+    QUEUE.put(conn, name, kwargs)
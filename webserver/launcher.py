@@ -0,0 +1,104 @@
+"""
+Production launcher (python server.py serve): a prefork gunicorn server.
+
+The app is imported once in the master (preload), which also runs warm()
+to load the in-memory indexes, and the workers share it all copy-on-write:
+no worker, including one started to replace a recycled worker, loads the
+indexes on a user's request. Each worker throws away any pooled connection it inherited
+and opens its own after the fork. Workers are recycled gracefully after
+max_requests requests (with jitter so they don't all restart at once), or
+as soon as a request leaves them above max_rss_mb. Boot time and every
+worker's RSS are logged at startup.
+
+Needs: pip install gunicorn
+"""
+
+import gc
+import multiprocessing
+import os
+import resource
+import timeit
+
+from gunicorn.app.base import BaseApplication
+
+
+def rss_mb():
+    """Resident set size of this process in MB."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1048576.0
+    except (IOError, OSError, ValueError):
+        # not Linux: the peak is the best we can get
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class Launcher(BaseApplication):
+
+    def __init__(self, app, engine, options, started=None, warm=None):
+        self.application = app
+        self.engine = engine
+        self.options = options
+        self.started = started or timeit.default_timer()
+        self.warm = warm
+        self.warm_seconds = None
+        super(Launcher, self).__init__()
+
+    def load_config(self):
+        max_rss_mb = self.options.pop('max_rss_mb', None)
+        engine = self.engine
+        started = self.started
+
+        def when_ready(server):
+            if self.warm_seconds is not None:
+                server.log.info('indexes loaded in %.2f s',
+                                self.warm_seconds)
+            server.log.info('booted in %.2f s, master rss %.1f MB',
+                            timeit.default_timer() - started, rss_mb())
+
+        def post_fork(server, worker):
+            # connections must not be shared across processes (engine is
+            # the replicas.Router, which disposes every engine)
+            engine.dispose()
+            server.log.info('worker %d up, rss %.1f MB', worker.pid,
+                            rss_mb())
+
+        def post_request(worker, req, environ, resp):
+            if max_rss_mb and rss_mb() > max_rss_mb:
+                worker.log.info('worker %d over %d MB, recycling',
+                                worker.pid, max_rss_mb)
+                worker.alive = False
+
+        settings = dict(self.options, preload_app=True, when_ready=when_ready,
+                        post_fork=post_fork, post_request=post_request)
+        for key, value in settings.items():
+            if value is not None:
+                self.cfg.set(key, value)
+
+    def load(self):
+        if self.warm is not None and self.warm_seconds is None:
+            start = timeit.default_timer()
+            self.warm()
+            self.warm_seconds = timeit.default_timer() - start
+            if hasattr(gc, 'freeze'):
+                # keep the collector from touching (and so copying) every
+                # page of the loaded indexes in each worker
+                gc.freeze()
+        return self.application
+
+
+def serve(app, engine, host, port, workers=None, threads=1,
+          max_requests=10000, max_rss_mb=None, timeout=30, started=None,
+          warm=None):
+    """
+    started: timeit.default_timer() when the process began booting; warm:
+    called in the master before the workers are forked.
+    """
+    options = dict(bind='%s:%d' % (host, port),
+                   workers=workers or multiprocessing.cpu_count(),
+                   threads=threads, max_requests=max_requests,
+                   max_requests_jitter=max(max_requests // 10, 1)
+                   if max_requests else 0,
+                   graceful_timeout=timeout, timeout=timeout,
+                   max_rss_mb=max_rss_mb)
+    Launcher(app, engine, options, started, warm).run()
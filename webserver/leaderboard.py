@@ -0,0 +1,38 @@
+"""
+Per-location rating summary behind the /location leaderboard.
+
+LOCATION_RATING keeps a review count, rating sum and average for every
+location so the page never has to aggregate REVIEWS. It is created (and
+backfilled from REVIEWS) by migration 1 (see migrations.py), along with
+a trigger on LOCATION that adds the (empty) row of every new location,
+however it is inserted, so the leaderboard can join the two without
+losing places. ADD_REVIEW, which /reviewsubmit runs next to its insert,
+keeps the totals up to date. The rendered page itself is cached by
+httpcache.
+"""
+
+from pagination import Keyset
+from queries import query
+
+# Inserts a location (the trigger adds its summary row)
+ADD_LOCATION = query('add_location', '''INSERT INTO
+    location(gps_lat, gps_long, name, description, country)
+    VALUES (:lat, :lng, :name, :desc, :country) RETURNING lid''')
+
+# Folds one new review into the summary of its location
+ADD_REVIEW = query('add_review_rating', '''INSERT INTO location_rating
+    AS s VALUES (:lid, 1, coalesce(CAST(:rating AS numeric), 0),
+        coalesce(CAST(:rating AS numeric), 0))
+    ON CONFLICT (lid) DO UPDATE SET
+        review_count = s.review_count + 1,
+        rating_sum = s.rating_sum + excluded.rating_sum,
+        avg_rating = (s.rating_sum + excluded.rating_sum) /
+            (s.review_count + 1)''')
+
+# Highest average rating first, a page at a time (see pagination.py)
+LEADERBOARD = Keyset('''SELECT location.lid, gps_lat, gps_long, name,
+        description, country, avg_rating
+    FROM location_rating JOIN location ON location.lid = location_rating.lid
+    WHERE %(seek)s ORDER BY %(order)s LIMIT :limit''',
+    keys=[('location_rating.avg_rating', 6), ('location.lid', 0)],
+    descending=True, name='leaderboard')
@@ -0,0 +1,168 @@
+"""
+Minimal in-process metrics, rendered in the Prometheus text format by the
+/metrics route.
+
+Histograms, summaries and gauges register themselves in REGISTRY when
+created:
+
+        CHECKOUT = histogram('db_pool_checkout_seconds', 'Time to get a conn')
+        CHECKOUT.observe(0.002)
+"""
+
+import threading
+from collections import deque
+
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5,
+                   1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = list()
+
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                             for k, v in pairs)
+
+
+class Histogram(object):
+    """Cumulative-bucket histogram, optionally split by label values."""
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = dict(
+                    counts=[0] * len(self.buckets), sum=0.0, count=0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s histogram' % self.name]
+        with self._lock:
+            for values, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series['counts']):
+                    lines.append('%s_bucket%s %d' % (
+                        self.name,
+                        _labels(self.labels, values, ('le', repr(bound))),
+                        count))
+                lines.append('%s_bucket%s %d' % (
+                    self.name, _labels(self.labels, values, ('le', '+Inf')),
+                    series['count']))
+                lines.append('%s_sum%s %r' % (
+                    self.name, _labels(self.labels, values), series['sum']))
+                lines.append('%s_count%s %d' % (
+                    self.name, _labels(self.labels, values), series['count']))
+        return lines
+
+
+class Summary(object):
+    """
+    p50/p95/p99 (and count/sum) of the last window observations per label
+    values. Quantiles are computed when the metrics are rendered.
+    """
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, name, help, labels=(), window=1024):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.window = window
+        self._series = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = dict(
+                    samples=deque(maxlen=self.window), sum=0.0, count=0)
+            series['samples'].append(value)
+            series['sum'] += value
+            series['count'] += 1
+
+    def quantiles(self, *labelvalues):
+        with self._lock:
+            series = self._series.get(labelvalues)
+            samples = sorted(series['samples']) if series else []
+        if not samples:
+            return dict((q, 0.0) for q in self.QUANTILES)
+        return dict((q, samples[min(int(q * len(samples)), len(samples) - 1)])
+                    for q in self.QUANTILES)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s summary' % self.name]
+        with self._lock:
+            keys = sorted(self._series)
+        for values in keys:
+            for q, value in sorted(self.quantiles(*values).items()):
+                lines.append('%s%s %r' % (
+                    self.name,
+                    _labels(self.labels, values, ('quantile', repr(q))),
+                    value))
+            series = self._series[values]
+            lines.append('%s_sum%s %r' % (
+                self.name, _labels(self.labels, values), series['sum']))
+            lines.append('%s_count%s %d' % (
+                self.name, _labels(self.labels, values), series['count']))
+        return lines
+
+
+class Gauge(object):
+    """A value read from a callback each time the metrics are rendered."""
+
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def render(self):
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        return ['# HELP %s %s' % (self.name, self.help),
+                '# TYPE %s gauge' % self.name,
+                '%s %r' % (self.name, value)]
+
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    metric = Histogram(name, help, labels, buckets)
+    REGISTRY.append(metric)
+    return metric
+
+
+def summary(name, help, labels=(), window=1024):
+    metric = Summary(name, help, labels, window)
+    REGISTRY.append(metric)
+    return metric
+
+
+def gauge(name, help, fn):
+    metric = Gauge(name, help, fn)
+    REGISTRY.append(metric)
+    return metric
+
+
+def render():
+    lines = list()
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,260 @@
+"""
+Versioned schema changes.
+
+Every change the app makes to the database is one entry of MIGRATIONS,
+applied in order by migrate() (python server.py initdb, or
+python server.py migrate) and recorded in SCHEMA_MIGRATIONS, so each runs
+once per database. Each step is plain SQL, written out here rather than
+taken from the modules that use the tables, so that editing a module can
+never change what an applied migration did. Each runs in its own
+transaction, under an advisory lock so two processes starting together
+don't both apply it.
+
+Add new changes at the end with the next version number; never edit one
+that has been applied somewhere. Expression indexes (search, date ranges)
+only serve queries using exactly the same expression, so a module changing
+such a query needs a new migration for its index.
+"""
+
+from sqlalchemy import text
+
+LOCK_KEY = 4111  # pg_advisory_xact_lock key
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS schema_migrations (
+    version integer PRIMARY KEY,
+    name text NOT NULL,
+    applied_at timestamptz NOT NULL DEFAULT now()
+);'''
+
+# The lookups and joins of the named queries (see queries.py), by route.
+# Primary keys already cover USER_FRIENDS.uid, USER_TRIP.user_id and
+# REVIEWS.uid as leading columns.
+LOOKUP_INDEXES = '''
+-- /loginreq (email only: an index on password would copy every password)
+CREATE INDEX IF NOT EXISTS users_email_idx ON users (email);
+-- followers of a user (feed fan-out)
+CREATE INDEX IF NOT EXISTS user_friends_uid_2_idx
+    ON user_friends (uid_2, uid);
+-- a user's activities (/activity, profiles, recommendations)
+CREATE INDEX IF NOT EXISTS user_activity_uid_idx
+    ON user_activity (uid, name);
+-- reviews of a location (/reviews, leaderboard backfill, feed)
+CREATE INDEX IF NOT EXISTS reviews_lid_idx ON reviews (lid, uid);
+-- members of a trip (/tripjoinreq, feed fan-out)
+CREATE INDEX IF NOT EXISTS user_trip_trip_idx ON user_trip (trip_id, user_id);
+-- trips to a location (feed fan-out of reviews)
+CREATE INDEX IF NOT EXISTS trip_lid_idx ON trip (lid, start_date);
+-- /rental, in its sort order
+CREATE INDEX IF NOT EXISTS rental_lease_start_idx
+    ON rental_lease (start_date, owner, address);
+-- /requests, in its sort order
+CREATE INDEX IF NOT EXISTS rental_request_owner_idx
+    ON rental_request (owner, start_date, requester, address);
+ANALYZE users; ANALYZE user_friends; ANALYZE user_activity;
+ANALYZE reviews; ANALYZE user_trip; ANALYZE trip; ANALYZE rental_lease;
+ANALYZE rental_request;'''
+
+MIGRATIONS = [
+    # leaderboard.py: per-location rating summary, backfilled from REVIEWS;
+    # a trigger adds the summary row of every location inserted later,
+    # however it is inserted
+    (1, 'location rating summary', '''
+CREATE TABLE IF NOT EXISTS location_rating (
+    lid integer PRIMARY KEY REFERENCES location(lid) ON DELETE CASCADE,
+    review_count integer NOT NULL DEFAULT 0,
+    rating_sum numeric NOT NULL DEFAULT 0,
+    avg_rating numeric NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS location_rating_avg_idx ON location_rating
+    (avg_rating, lid);
+INSERT INTO location_rating
+    SELECT location.lid, count(reviews.lid),
+        coalesce(sum(coalesce(rating, 0)), 0), AVG(coalesce(rating, 0))
+    FROM location LEFT JOIN reviews ON location.lid = reviews.lid
+    GROUP BY location.lid
+    ON CONFLICT (lid) DO NOTHING;
+CREATE OR REPLACE FUNCTION location_rating_add() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO location_rating (lid) SELECT lid FROM new_locations
+        ORDER BY lid ON CONFLICT (lid) DO NOTHING;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS location_rating_add ON location;
+CREATE TRIGGER location_rating_add AFTER INSERT ON location
+    REFERENCING NEW TABLE AS new_locations
+    FOR EACH STATEMENT EXECUTE PROCEDURE location_rating_add();'''),
+
+    # rentals.py: leases covering some dates, and the requests of one
+    # property (overlap checks)
+    (2, 'rental date range indexes', '''
+CREATE INDEX IF NOT EXISTS rental_lease_dates_idx
+    ON rental_lease USING gist (daterange(start_date, end_date, '[]'));
+CREATE INDEX IF NOT EXISTS rental_request_property_idx
+    ON rental_request (owner, address, start_date);'''),
+
+    # feed.py
+    (3, 'home page feed', '''
+CREATE TABLE IF NOT EXISTS feed_head (
+    uid integer PRIMARY KEY,
+    seq bigint NOT NULL
+);
+CREATE TABLE IF NOT EXISTS feed_event (
+    uid integer NOT NULL,
+    slot integer NOT NULL,
+    seq bigint NOT NULL,
+    kind text NOT NULL,
+    body json NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (uid, slot)
+);'''),
+
+    # jobs.py ("durable": true)
+    (4, 'background job queue', '''
+CREATE TABLE IF NOT EXISTS job_queue (
+    id bigserial PRIMARY KEY,
+    name text NOT NULL,
+    args json NOT NULL,
+    attempts integer NOT NULL DEFAULT 0,
+    run_at timestamptz NOT NULL DEFAULT now(),
+    created_at timestamptz NOT NULL DEFAULT now(),
+    failed_at timestamptz,
+    last_error text
+);
+CREATE INDEX IF NOT EXISTS job_queue_due_idx ON job_queue (run_at)
+    WHERE failed_at IS NULL;'''),
+
+    (5, 'lookup indexes', LOOKUP_INDEXES),
+
+    # search.py: the tsvector expressions of LOCATION_VECTOR,
+    # ACTIVITY_VECTOR and REVIEW_VECTOR
+    (6, 'full-text search indexes', '''
+CREATE INDEX IF NOT EXISTS location_search_idx
+    ON location USING gin ((setweight(to_tsvector('english',
+        coalesce(location.name, '')), 'A') ||
+    setweight(to_tsvector('english', coalesce(location.description, '')),
+        'B') ||
+    setweight(to_tsvector('english', coalesce(location.country, '')),
+        'C')));
+CREATE INDEX IF NOT EXISTS activity_search_idx
+    ON activity USING gin ((setweight(to_tsvector('english',
+        coalesce(activity.name, '')), 'A') ||
+    setweight(to_tsvector('english', coalesce(activity.description, '')),
+        'B')));
+CREATE INDEX IF NOT EXISTS reviews_search_idx
+    ON reviews USING gin (to_tsvector('english', coalesce(reviews.comment,
+        '')));
+CREATE INDEX IF NOT EXISTS location_name_prefix_idx
+    ON location (lower(name) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS activity_name_prefix_idx
+    ON activity (lower(name) text_pattern_ops);'''),
+
+    # companions.py; the candidates are filled by the companions_horizon job
+    (7, 'trip companion candidates', '''
+CREATE TABLE IF NOT EXISTS trip_candidate (
+    uid integer NOT NULL,
+    trip_id integer NOT NULL,
+    score integer NOT NULL,
+    PRIMARY KEY (uid, trip_id)
+);
+CREATE INDEX IF NOT EXISTS trip_candidate_trip_idx
+    ON trip_candidate (trip_id);
+CREATE INDEX IF NOT EXISTS trip_dates_idx
+    ON trip USING gist (daterange(start_date, end_date, '[]'));'''),
+
+    (8, 'trip companion horizon', '''
+CREATE TABLE IF NOT EXISTS companions_horizon (
+    id boolean PRIMARY KEY DEFAULT true CHECK (id),
+    through date
+);
+INSERT INTO companions_horizon VALUES (true, NULL)
+    ON CONFLICT DO NOTHING;'''),
+
+    # versions.py: cache versions shared by every process
+    (9, 'shared data versions', '''
+CREATE TABLE IF NOT EXISTS data_version (
+    name text PRIMARY KEY,
+    version bigint NOT NULL
+);'''),
+
+    # versions.py: changes to the in-memory indexes, replayed by every
+    # process (pruned by the data_change_prune job)
+    (10, 'index change log', '''
+CREATE TABLE IF NOT EXISTS data_change (
+    seq bigserial PRIMARY KEY,
+    name text NOT NULL,
+    origin text NOT NULL,
+    body json,
+    created_at timestamptz NOT NULL DEFAULT clock_timestamp()
+);
+CREATE INDEX IF NOT EXISTS data_change_created_idx
+    ON data_change (created_at);'''),
+]
+
+
+def apply(conn, version):
+    """
+    Runs migration version on conn without recording it (for the
+    benchmarks' scratch schemas).
+    """
+    for number, _, sql in MIGRATIONS:
+        if number == version:
+            conn.execute(text(sql))
+            return
+    raise KeyError(version)
+
+
+def _applied(conn):
+    res = conn.execute(text('SELECT version, applied_at '
+                            'FROM schema_migrations'))
+    applied = dict(res.fetchall())
+    res.close()
+    return applied
+
+
+def _check_names(conn):
+    """
+    Refuses to go on if a recorded version is a different migration than
+    the one of that number here (a database migrated by a development
+    version of this list); such a database has to be created again.
+    """
+    res = conn.execute(text('SELECT version, name FROM schema_migrations'))
+    recorded = dict(res.fetchall())
+    res.close()
+    names = dict((version, name) for version, name, _ in MIGRATIONS)
+    wrong = sorted(version for version, name in recorded.items()
+                   if version in names and names[version] != name)
+    if wrong:
+        raise RuntimeError('schema_migrations does not match migrations.py '
+                           'at version(s) %s: recreate this database' %
+                           ', '.join(str(version) for version in wrong))
+
+
+def status(engine):
+    """(version, name, applied_at or None) for every migration."""
+    with engine.connect() as conn:
+        conn.execute(text(SCHEMA))
+        applied = _applied(conn)
+    return [(version, name, applied.get(version))
+            for version, name, _ in MIGRATIONS]
+
+
+def migrate(engine, target=None):
+    """Applies the pending migrations up to target; returns their versions."""
+    done = list()
+    with engine.connect() as conn:
+        conn.execute(text(SCHEMA))
+        _check_names(conn)
+        for version, name, sql in MIGRATIONS:
+            if target is not None and version > target:
+                break
+            with conn.begin():
+                conn.execute(text('SELECT pg_advisory_xact_lock(:key)'),
+                             key=LOCK_KEY)
+                if version in _applied(conn):
+                    continue
+                conn.execute(text(sql))
+                conn.execute(text('INSERT INTO schema_migrations '
+                                  '(version, name) VALUES (:version, :name)'),
+                             version=version, name=name)
+            done.append(version)
+    return done
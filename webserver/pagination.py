@@ -0,0 +1,187 @@
+"""
+Keyset (seek) pagination for the list pages.
+
+A Keyset wraps a list query whose sort key is made of columns that are
+also selected. Instead of OFFSET, each page continues from the key of the
+last row shown (?after=) or the first one (?before=), so every page costs
+the same no matter how deep it is:
+
+        REVIEWS = Keyset('''SELECT ... WHERE %(seek)s ORDER BY %(order)s
+                            LIMIT :limit''',
+                         keys=[('location.name', 0), ('location.lid', 4)],
+                         name='reviews')
+        page = REVIEWS.page(g.conn, request.args)
+        html = render_template('reviews.html', reviews=page, page=page)
+        page.close()
+
+Cursors are the key values, JSON encoded and base64'd into the URL. Any
+other query arguments (filters) are carried over into the page links.
+Each variant of the query (first page, after, before) is a named query,
+see queries.py. page(..., stream=True) returns every row from the cursor
+on instead, read through a server-side cursor (see streaming.py).
+"""
+
+import base64
+import json
+
+try:
+    from urllib.parse import urlencode
+except ImportError:  # python 2
+    from urllib import urlencode
+
+import streaming
+from queries import Query, query
+
+DEFAULT_PAGE_SIZE = 25
+MAX_PAGE_SIZE = 100
+PAGE_ARGS = ('after', 'before', 'per_page', 'stream')
+
+KEYSETS = dict()  # name -> Keyset, for tools that walk the queries
+
+
+def encode_cursor(values):
+    raw = json.dumps([None if v is None else str(v) for v in values])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """The key values in a cursor, or None if it is not one of ours."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(
+            str(cursor).encode('ascii')).decode('utf-8'))
+    except Exception:
+        return None
+    return values if isinstance(values, list) else None
+
+
+def page_size(args):
+    size = args.get('per_page', DEFAULT_PAGE_SIZE, type=int)
+    return min(max(size, 1), MAX_PAGE_SIZE)
+
+
+class Keyset(object):
+    """
+    select must contain %(seek)s inside its WHERE clause, %(order)s as
+    its ORDER BY list and a :limit parameter. keys lists the sort key as
+    (SQL expression, index of that value in a result row) pairs; the last
+    ones must make the key unique. The variants are prepared as name_first,
+    name_after and name_before; without a name they run unprepared.
+    """
+
+    def __init__(self, select, keys, descending=False, name=None):
+        self.select = select
+        self.keys = keys
+        self.descending = descending
+        self.name = name
+        if name is not None:
+            KEYSETS[name] = self
+        # first page, after a cursor, before a cursor
+        self._compiled = dict(
+            (variant, self._compile(*variant))
+            for variant in ((False, True), (True, True), (True, False)))
+
+    def _compile(self, seek, forward):
+        columns = [expr for expr, _ in self.keys]
+        descending = self.descending != (not forward)
+        order = ', '.join('%s %s' % (c, 'DESC' if descending else 'ASC')
+                          for c in columns)
+        condition = 'TRUE'
+        if seek:
+            condition = '(%s) %s (%s)' % (
+                ', '.join(columns), '<' if descending else '>',
+                ', '.join(':k%d' % i for i in range(len(columns))))
+        sql = self.select % dict(seek=condition, order=order)
+        if self.name is None:
+            return Query(None, sql)
+        variant = 'first' if not seek else 'after' if forward else 'before'
+        return query('%s_%s' % (self.name, variant), sql)
+
+    def row_key(self, row):
+        return [row[i] for _, i in self.keys]
+
+    def page(self, conn, args, transform=None, stream=False, **params):
+        """
+        Runs the query for the page args (a request.args) asks for. With
+        stream, the page has no size limit and only goes forward.
+        """
+        size = None if stream else page_size(args)
+        after = decode_cursor(args.get('after')) if args.get('after') else None
+        before = decode_cursor(args.get('before')) \
+            if args.get('before') and after is None and not stream else None
+        seek = after or before
+        if seek is not None and len(seek) != len(self.keys):
+            seek = None
+        forward = before is None or seek is None
+
+        # LIMIT NULL is no limit
+        bind = dict(params, limit=None if stream else size + 1)
+        for i, value in enumerate(seek or ()):
+            bind['k%d' % i] = value
+        cmd = self._compiled[(seek is not None, forward)]
+        if stream:
+            res = streaming.cursor(conn).execute(cmd.text, **bind)
+        else:
+            res = cmd.execute(conn, **bind)
+        page = Page(self, res, size, forward, seek is not None, transform)
+        page.filters = urlencode([(k, v) for k, v in args.items(multi=True)
+                                  if k not in PAGE_ARGS])
+        return page
+
+
+class Page(object):
+    """
+    The rows of one page. Iterating streams them straight from the result
+    (going backwards needs the page reversed, so that one is buffered).
+    has_next/has_prev and the cursors are known once iteration is over,
+    which is why templates render the links below the table.
+    """
+
+    def __init__(self, keyset, result, size, forward, seeked, transform):
+        self.keyset = keyset
+        self.size = size
+        self.first_key = None
+        self.last_key = None
+        self._result = result
+        self._forward = forward
+        self._transform = transform
+        self._more = False
+        self.filters = ''
+        self.has_prev = seeked and forward
+        self.has_next = not forward
+
+    def _rows(self):
+        if self._forward:
+            for i, row in enumerate(self._result):
+                if i == self.size:
+                    self._more = True
+                    break
+                yield row
+        else:
+            rows = self._result.fetchmany(self.size + 1)
+            self._more = len(rows) > self.size
+            for row in reversed(rows[:self.size]):
+                yield row
+
+    def __iter__(self):
+        for row in self._rows():
+            key = self.keyset.row_key(row)
+            if self.first_key is None:
+                self.first_key = key
+            self.last_key = key
+            yield self._transform(row) if self._transform else row
+        if self._forward:
+            self.has_next = self._more
+        else:
+            self.has_prev = self._more
+        self.close()
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(self.last_key) if self.last_key else None
+
+    @property
+    def prev_cursor(self):
+        return encode_cursor(self.first_key) if self.first_key else None
+
+    def close(self):
+        self._result.close()
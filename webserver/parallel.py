@@ -0,0 +1,76 @@
+"""
+Concurrent queries for the pages that need several independent ones
+(/, /activity, /friend, /trip).
+
+        trips, friends = parallel.gather(
+            lambda conn: TRIPS.execute(conn, uid=uid).fetchall(),
+            lambda conn: PROFILES.get(conn, uid, 'friends'))
+
+gather() runs each call(conn) on a shared thread pool, each with a lazy
+connection of its own to the request's engine (so replica routing,
+prepared statements and the profile cache work as on g.conn), and counts
+their statements towards the request (instrument.bind). The calls run
+outside the request context: they must not touch session, request or g.
+
+The request's own connection goes back to the pool while it waits, so a
+request never holds one connection while waiting for another and a busy
+pool can't deadlock. Set the number of threads with "page_workers" in
+credentials.json (or PAGE_WORKERS); 0 runs the calls one after another on
+g.conn.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import g
+
+import instrument
+
+WORKERS = 8
+
+_executor = None
+_lock = threading.Lock()
+
+
+def configure(creds):
+    global WORKERS
+    WORKERS = int(os.environ.get('PAGE_WORKERS',
+                                 creds.get('page_workers', WORKERS)))
+
+
+def _pool():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=WORKERS,
+                                           thread_name_prefix='page')
+        return _executor
+
+
+def _run(conn, stats, route, call):
+    try:
+        with instrument.bind(stats, route):
+            return call(conn)
+    finally:
+        conn.close()
+
+
+def gather(*calls):
+    """
+    The results of call(conn) for each of calls, in order. Raises the first
+    exception a call raised, once they have all finished. Not for use inside
+    a transaction on g.conn.
+    """
+    if WORKERS <= 0 or len(calls) < 2:
+        return [call(g.conn) for call in calls]
+    g.conn.close()
+    stats, route = instrument.current()
+    pool = _pool()
+    futures = [pool.submit(_run, g.conn.sibling(), stats, route, call)
+               for call in calls]
+    errors = [f.exception() for f in futures]
+    for error in errors:
+        if error is not None:
+            raise error
+    return [f.result() for f in futures]
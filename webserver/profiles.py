@@ -0,0 +1,127 @@
+"""
+Per-user profile cache: home location, friends, activities and the
+locations a user has reviewed.
+
+Each part is loaded with one query the first time a page needs it and then
+served from the cache until a route that changes it calls invalidate(), or
+the TTL runs out. Entries are keyed on the part's shared data version
+('activities:<uid>' ..., see versions.py), which invalidate() bumps, so a
+change made through one server process is seen by all of them: a get()
+costs one primary key lookup of that version, and the entries of older
+versions are never looked up again. The cache lives in a backend:
+LocalBackend (an in-process TTL/LRU cache) by default, or RedisBackend when
+several processes should share the entries. Values are plain lists so any
+backend can serialize them.
+
+        credentials.json: "profile_cache": {"backend": "redis",
+                                            "url": "redis://localhost:6379/0",
+                                            "ttl": 300}
+"""
+
+import json
+from decimal import Decimal
+
+import versions
+from cache import TTLCache
+from queries import query
+
+PARTS = dict(
+    home=query('profile_home', '''SELECT lid, location.name, gps_lat,
+        gps_long FROM users JOIN location ON lid = home WHERE uid=:uid'''),
+    friends=query('profile_friends', '''SELECT users.name, users.uid,
+        location.name, gps_lat, gps_long
+        FROM user_friends JOIN users ON uid_2 = users.uid
+        LEFT JOIN location ON lid = home WHERE user_friends.uid=:uid'''),
+    activities=query('profile_activities', '''SELECT name, description
+        FROM user_activity NATURAL JOIN activity WHERE uid=:uid'''),
+    reviewed=query('profile_reviewed',
+                   '''SELECT lid FROM reviews WHERE uid=:uid'''),
+)
+
+
+def _plain(value):
+    # numeric columns come back as Decimal, which JSON can't store
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+class LocalBackend(object):
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value):
+        self._cache.set(key, value)
+
+    def delete(self, *keys):
+        for key in keys:
+            self._cache.delete(key)
+
+
+class RedisBackend(object):
+    """Shared backend; needs the redis package (pip install redis)."""
+
+    def __init__(self, url, ttl=300):
+        import redis
+        self._redis = redis.StrictRedis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self._redis.get(key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value):
+        self._redis.setex(key, self.ttl, json.dumps(value))
+
+    def delete(self, *keys):
+        if keys:
+            self._redis.delete(*keys)
+
+
+class ProfileCache(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @staticmethod
+    def version_name(uid, part):
+        """The data version of one part of uid's profile."""
+        return '%s:%s' % (part, uid)
+
+    def key(self, conn, uid, part):
+        name = self.version_name(uid, part)
+        version = versions.current(conn, [name])[name]
+        return 'profile:%s:%s:%s' % (uid, part, version)
+
+    def get(self, conn, uid, part):
+        """The rows of one part of uid's profile, loading them if needed."""
+        # the version is read before the rows, on the same connection, so
+        # rows are never older than the version they are stored under
+        key = self.key(conn, uid, part)
+        rows = self.backend.get(key)
+        if rows is None:
+            res = PARTS[part].execute(conn, uid=uid)
+            rows = [[_plain(value) for value in row] for row in res]
+            res.close()
+            self.backend.set(key, rows)
+        return rows
+
+    def put(self, conn, uid, part, rows):
+        self.backend.set(self.key(conn, uid, part),
+                         [[_plain(value) for value in row] for row in rows])
+
+    def invalidate(self, conn, uid, *parts):
+        """Marks parts of uid's profile as changed, for every process."""
+        versions.bump(conn, *[self.version_name(uid, part)
+                              for part in parts])
+
+def from_config(creds):
+    config = creds.get('profile_cache', {})
+    ttl = config.get('ttl', 300)
+    if config.get('backend') == 'redis':
+        return ProfileCache(RedisBackend(config['url'], ttl=ttl))
+    return ProfileCache(LocalBackend(config.get('maxsize', 10000), ttl=ttl))
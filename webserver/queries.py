@@ -0,0 +1,119 @@
+"""
+Named queries, declared once and run as server-side prepared statements.
+
+Every statement the routes run is declared at import with query():
+
+        TRIPS = query('trips', '''SELECT ... WHERE user_id=:uid''')
+        res = TRIPS.execute(g.conn, uid=session['uid'])
+
+On PostgreSQL the first execution on a pooled connection sends
+PREPARE trips AS ..., and every execution (that one included) is an
+EXECUTE trips(...). The statement is parsed and analyzed once per
+connection, and after a few executions the server may switch to a cached
+generic plan. The names prepared on a connection are kept in its info
+dict, which SQLAlchemy clears when the connection is replaced (recycled,
+invalidated), so a new connection prepares again.
+
+Parameter types are inferred by the server; pass types= for parameters
+that only appear where it can't tell (e.g. the select list of an
+INSERT ... SELECT). Prepared statements don't survive a transaction-mode
+pooler such as pgbouncer: turn them off with "prepared_statements": false
+in credentials.json or DB_PREPARED_STATEMENTS=0, and queries run as plain
+text() statements (as they also do on other databases).
+
+Per query, /metrics shows
+
+        db_prepare_seconds    PREPARE time (parse, analyze, rewrite)
+        db_execute_seconds    EXECUTE time (plan or cached plan, run, fetch)
+"""
+
+import os
+import re
+from timeit import default_timer
+
+from sqlalchemy import text
+
+import metrics
+
+# same rule text() uses to find :name binds
+PARAM = re.compile(r'(?<![:\w\\]):(\w+)(?!:)')
+WRITE = re.compile(r'\b(INSERT|UPDATE|DELETE)\b', re.I)
+
+PREPARE_SECONDS = metrics.histogram(
+    'db_prepare_seconds', 'Time to PREPARE a named query', ('query',))
+EXECUTE_SECONDS = metrics.histogram(
+    'db_execute_seconds', 'Time to EXECUTE a named query', ('query',))
+
+REGISTRY = dict()
+ENABLED = True
+
+
+class Query(object):
+    """
+    One named statement. execute() takes the same arguments as
+    Connection.execute() with a text() statement: keyword binds, one dict,
+    or a list of dicts for an executemany. A Query without a name is never
+    prepared.
+    """
+
+    def __init__(self, name, sql, types=None):
+        self.name = name
+        self.sql = sql
+        self.text = text(sql)
+        self.params = list()
+        for param in PARAM.findall(sql):
+            if param not in self.params:
+                self.params.append(param)
+        types = types or dict()
+        signature = ''
+        if types:
+            signature = '(%s)' % ', '.join(types.get(p, 'unknown')
+                                          for p in self.params)
+        # the statement with $1, $2 ... in the order of params
+        self.positional = PARAM.sub(
+            lambda m: '$%d' % (self.params.index(m.group(1)) + 1), sql)
+        self._prepare = text('PREPARE %s%s AS %s' % (name, signature,
+                                                     self.positional))
+        args = ''
+        if self.params:
+            args = '(%s)' % ', '.join(':' + p for p in self.params)
+        # EXECUTE doesn't look like a write to SQLAlchemy's autocommit
+        self._execute = text('EXECUTE %s%s' % (name, args)) \
+            .execution_options(autocommit=bool(WRITE.search(sql)))
+
+    def prepared(self, conn):
+        return ENABLED and self.name is not None and \
+            conn.dialect.name == 'postgresql'
+
+    def execute(self, conn, *multiparams, **params):
+        if not self.prepared(conn):
+            return conn.execute(self.text, *multiparams, **params)
+        names = conn.info.setdefault('prepared_queries', set())
+        if self.name not in names:
+            start = default_timer()
+            conn.execute(self._prepare).close()
+            PREPARE_SECONDS.observe(default_timer() - start, self.name)
+            names.add(self.name)
+        start = default_timer()
+        res = conn.execute(self._execute, *multiparams, **params)
+        EXECUTE_SECONDS.observe(default_timer() - start, self.name)
+        return res
+
+
+def query(name, sql, types=None):
+    """Declares (or returns the already declared) query called name."""
+    existing = REGISTRY.get(name)
+    if existing is not None:
+        if existing.sql != sql:
+            raise ValueError('query %r is already declared' % name)
+        return existing
+    REGISTRY[name] = Query(name, sql, types)
+    return REGISTRY[name]
+
+
+def configure(creds):
+    """Reads prepared_statements from credentials.json / the environment."""
+    global ENABLED
+    value = os.environ.get('DB_PREPARED_STATEMENTS',
+                           creds.get('prepared_statements', True))
+    ENABLED = str(value).lower() in ('1', 'true', 'yes', 'on')
@@ -0,0 +1,203 @@
+"""
+"Activities in common" friend suggestions for /friend.
+
+Recommender keeps an inverted index (activity -> users) and every user's
+activities and friends. It is built from USER_ACTIVITY and USER_FRIENDS the
+first time it is needed and then patched by the routes that change either
+table. A suggestion page counts, for each of the user's activities, least
+popular first, the other members, so it costs O(members of those
+activities) instead of a self-join of USER_ACTIVITY; like graph.py it looks
+at no more than max_paths of them, so sharing a hugely popular activity
+costs no more than anything else. The routes log what they change as
+'user_activity' and 'friends' changes, which every other process replays
+into its own index (see versions.Watch); only a bulk reload rebuilds it
+from the database, in the background.
+"""
+
+import heapq
+import itertools
+import threading
+from collections import defaultdict
+
+from sqlalchemy import text
+
+import versions
+from queries import query
+
+MAX_PATHS = 200000  # activity members looked at per suggestion query
+
+# one array parameter rather than IN :uids, so the statement can be prepared
+USER_NAMES = query('user_names', '''SELECT uid, name FROM users
+    WHERE uid = ANY(CAST(:uids AS integer[]))''')
+
+
+class Recommender(object):
+
+    def __init__(self, max_paths=MAX_PATHS,
+                 refresh=versions.POLL_SECONDS):
+        self.max_paths = max_paths
+        self.members = defaultdict(set)     # activity -> uids
+        self.activities = defaultdict(set)  # uid -> activities
+        self.friends = defaultdict(set)     # uid -> uids they added
+        self.loaded = False
+        self.watch = versions.Watch(['user_activity', 'friends'], refresh)
+        self._log = None  # changes made while a rebuild reads the tables
+        self._lock = threading.RLock()
+
+    def _read(self, conn):
+        """(last change, members, activities, friends) as the tables are."""
+        seen = self.watch.snapshot(conn)
+        members, activities = defaultdict(set), defaultdict(set)
+        friends = defaultdict(set)
+        res = conn.execute(text('SELECT name, uid FROM user_activity'))
+        for name, uid in res:
+            members[name].add(uid)
+            activities[uid].add(name)
+        res.close()
+        res = conn.execute(text('SELECT uid, uid_2 FROM user_friends'))
+        for uid, uid_2 in res:
+            friends[uid].add(uid_2)
+        res.close()
+        return seen, members, activities, friends
+
+    def _adopt(self, seen, members, activities, friends):
+        self.members, self.activities = members, activities
+        self.friends = friends
+        self.loaded = True
+        self.watch.built(seen)
+
+    def load(self, conn):
+        """
+        Builds the index from the database on first use; later replays the
+        changes other processes made.
+        """
+        with self._lock:
+            if not self.loaded:
+                self._adopt(*self._read(conn))
+                return
+        self.watch.check(conn, self._rebuild, self._apply)
+
+    def _apply(self, name, change):
+        uid, other, present = change
+        if name == 'user_activity':
+            self._patch(self._add_activity if present else
+                        self._remove_activity, int(uid), other)
+        else:
+            self._patch(self._add_friend if present else
+                        self._remove_friend, int(uid), int(other))
+
+    def _rebuild(self, conn):
+        with self._lock:
+            self._log = list()
+        built = self._read(conn)
+        with self._lock:
+            log, self._log = self._log, None
+            self._adopt(*built)
+            # changes that committed after the read started (they are all
+            # idempotent)
+            for change, args in log:
+                change(*args)
+
+    def _patch(self, change, *args):
+        with self._lock:
+            if self.loaded:
+                change(*args)
+                if self._log is not None:
+                    self._log.append((change, args))
+
+    def _add_activity(self, uid, name):
+        self.members[name].add(uid)
+        self.activities[uid].add(name)
+
+    def _remove_activity(self, uid, name):
+        self.members[name].discard(uid)
+        self.activities[uid].discard(name)
+
+    def _add_friend(self, uid, other):
+        self.friends[uid].add(other)
+
+    def _remove_friend(self, uid, other):
+        self.friends[uid].discard(other)
+
+    def add_activity(self, uid, name):
+        self._patch(self._add_activity, int(uid), name)
+
+    def remove_activity(self, uid, name):
+        self._patch(self._remove_activity, int(uid), name)
+
+    def add_friend(self, uid, other):
+        self._patch(self._add_friend, int(uid), int(other))
+
+    def remove_friend(self, uid, other):
+        self._patch(self._remove_friend, int(uid), int(other))
+
+    def _candidates(self, uid):
+        uid = int(uid)
+        common = defaultdict(int)
+        with self._lock:
+            friends = self.friends.get(uid, ())
+            mine = sorted(self.activities.get(uid, ()),
+                          key=lambda name: (len(self.members[name]), name))
+            budget = self.max_paths
+            for name in mine:
+                if budget <= 0:
+                    break
+                members = self.members[name]
+                for other in itertools.islice(members, budget):
+                    common[other] += 1
+                budget -= len(members)
+        return [(count, other) for other, count in common.items()
+                if other != uid and other not in friends]
+
+    def ranked(self, uid):
+        """Every [uid, activities in common] suggestion, best first."""
+        candidates = self._candidates(uid)
+        candidates.sort(key=lambda c: (-c[0], c[1]))
+        return [[other, count] for count, other in candidates]
+
+    def suggestions(self, uid, page=0, per_page=20):
+        """
+        One page of [uid, activities in common] for users uid has not
+        added yet, most activities in common first. Returns (rows, has_next).
+        """
+        candidates = self._candidates(uid)
+        end = (page + 1) * per_page
+        # sort by count descending, then uid ascending
+        best = heapq.nsmallest(end + 1, candidates,
+                               key=lambda c: (-c[0], c[1]))
+        rows = [[other, count] for count, other in best[page * per_page:end]]
+        return rows, len(best) > end
+
+
+RECOMMENDER = Recommender()
+
+
+def suggestion_page(conn, uid, page=0, per_page=20):
+    """
+    Suggestions shaped like the /friend template rows,
+    [uid, name, activities in common], plus whether a next page exists.
+    """
+    RECOMMENDER.load(conn)
+    rows, has_next = RECOMMENDER.suggestions(uid, page, per_page)
+    names = dict()
+    if rows:
+        res = USER_NAMES.execute(conn, uids=[row[0] for row in rows])
+        names = dict(res.fetchall())
+        res.close()
+    return [[row[0], names.get(row[0]), row[1]] for row in rows], has_next
+
+
+def suggestion_stream(conn, uid, chunk=500):
+    """
+    All of suggestion_page()'s rows for uid, names looked up a chunk at a
+    time (for the streamed /friend page, see streaming.py).
+    """
+    RECOMMENDER.load(conn)
+    rows = RECOMMENDER.ranked(uid)
+    for start in range(0, len(rows), chunk):
+        part = rows[start:start + chunk]
+        res = USER_NAMES.execute(conn, uids=[row[0] for row in part])
+        names = dict(res.fetchall())
+        res.close()
+        for row in part:
+            yield [row[0], names.get(row[0]), row[1]]
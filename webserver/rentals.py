@@ -0,0 +1,74 @@
+"""
+Rental availability on top of PostgreSQL date ranges.
+
+Migration 2 (see migrations.py) adds a GiST index over
+daterange(start_date, end_date) for RENTAL_LEASE, so "which leases cover
+D1..D2" (@>) is an index search instead of a scan; the statements below
+must use exactly the indexed expression. Requests overlapping another one
+for the same property (&&) are found through the property's own requests,
+by the (owner, address) index on RENTAL_REQUEST.
+
+request() keeps two requests for one property from overlapping: it takes
+a transaction-level advisory lock on the property before checking, so
+requests sent at the same moment are checked one after the other and the
+second sees the first.
+"""
+
+from pagination import Keyset
+from queries import query
+
+# Future leases (not the user's own) free for the whole of :start .. :end:
+# covering it, with no request overlapping it
+AVAILABLE = Keyset('''select owner, address, start_date, end_date, price
+    from rental_lease
+    where daterange(start_date, end_date, '[]') @>
+        daterange(CAST(:start AS date), CAST(:end AS date), '[]')
+    and start_date > CURRENT_DATE and owner <> :uid
+    and not exists (select 1 from rental_request r
+        where r.owner = rental_lease.owner
+        and r.address = rental_lease.address
+        and daterange(r.start_date, r.end_data, '[]') &&
+            daterange(CAST(:start AS date), CAST(:end AS date), '[]'))
+    and %(seek)s
+    order by %(order)s limit :limit''',
+    keys=[('start_date', 2), ('owner', 0), ('address', 1)],
+    name='rentals_available')
+
+# Serializes the requests for one property until the end of the transaction
+LOCK_PROPERTY = query('rental_property_lock', '''SELECT
+    pg_advisory_xact_lock(:owner, hashtext(:address))''',
+    types=dict(owner='integer', address='text'))
+
+# Inserts the request only if a lease of that property covers its dates and
+# no request for the property overlaps them
+REQUEST = query('rental_request', '''INSERT INTO rental_request(requester,
+        address, owner, comment, start_date, end_data)
+    SELECT :uid, :address, :owner, :comment, CAST(:start AS date),
+        CAST(:end AS date)
+    WHERE EXISTS (SELECT 1 FROM rental_lease
+        WHERE owner = :owner AND address = :address
+        AND daterange(start_date, end_date, '[]') @>
+            daterange(CAST(:start AS date), CAST(:end AS date), '[]'))
+    AND NOT EXISTS (SELECT 1 FROM rental_request
+        WHERE owner = :owner AND address = :address
+        AND daterange(start_date, end_data, '[]') &&
+            daterange(CAST(:start AS date), CAST(:end AS date), '[]'))
+    ON CONFLICT DO NOTHING''',
+    types=dict(uid='integer', address='text', owner='integer',
+               comment='text'))
+
+
+def request(conn, uid, owner, address, start, end, comment):
+    """
+    Requests the property for start .. end in a transaction of its own.
+    Returns False, inserting nothing, when no lease covers the dates or
+    another request overlaps them.
+    """
+    with conn.begin():
+        res = LOCK_PROPERTY.execute(conn, owner=owner, address=address)
+        res.close()
+        res = REQUEST.execute(conn, uid=uid, owner=owner, address=address,
+                              start=start, end=end, comment=comment)
+        requested = res.rowcount
+        res.close()
+    return requested > 0
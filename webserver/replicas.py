@@ -0,0 +1,208 @@
+"""
+Read replicas: GET requests read from a replica, everything else goes to
+the primary.
+
+        credentials.json: "replicas": {
+            "servers": [{"db_server": "10.0.0.2", "weight": 2},
+                        {"db_server": "10.0.0.3"}],
+            "pin_seconds": 5, "check_interval": 5, "max_lag": 10}
+
+Each server takes the primary's db_user / db_pass unless it sets its own.
+Reads are spread over the healthy replicas by smooth weighted round-robin.
+A replica is healthy while a background check (every check_interval
+seconds) can reach it and it is at most max_lag seconds behind the
+primary; one that refuses a connection is taken out at once. With no
+healthy replica reads go to the primary too.
+
+After a user's POST (session['wrote_at']) their requests stay on the
+primary for pin_seconds, so the page a POST redirects to shows the write
+even if the replicas lag. Background jobs always use the primary.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+import metrics
+from db import make_engine
+
+log = logging.getLogger('replicas')
+
+READ_METHODS = ('GET', 'HEAD')
+
+# seconds of replay lag, 0 when caught up (or when asked of a primary)
+LAG = '''SELECT CASE WHEN NOT pg_is_in_recovery()
+        OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END'''
+
+
+class Replica(object):
+
+    def __init__(self, name, engine, weight=1):
+        self.name = name
+        self.engine = engine
+        self.weight = weight
+        self.healthy = True
+        self.lag = 0.0
+        self.current = 0  # smooth weighted round-robin state
+
+
+class Reads(object):
+    """
+    Stands in for the engine of a read-only request: connect() picks a
+    replica at checkout, so requests that never query don't pick one.
+    """
+
+    def __init__(self, router):
+        self._router = router
+
+    def connect(self):
+        return self._router.connect_read()
+
+
+class Router(object):
+
+    def __init__(self, primary, replicas=(), pin_seconds=5.0,
+                 check_interval=5.0, max_lag=10.0):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.pin_seconds = pin_seconds
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self.counts = dict(primary=0, replica=0)
+        self._reads = Reads(self)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stopping = threading.Event()
+
+    @property
+    def engines(self):
+        return [self.primary] + [r.engine for r in self.replicas]
+
+    def pinned(self, wrote_at):
+        return wrote_at is not None and \
+            time.time() - wrote_at < self.pin_seconds
+
+    def engine_for(self, method, wrote_at=None):
+        """The engine (or Reads) for a request with this method."""
+        if not self.replicas or method not in READ_METHODS or \
+                self.pinned(wrote_at):
+            return self.primary
+        return self._reads
+
+    def pick(self, exclude=()):
+        """The next healthy replica by weight, or None."""
+        with self._lock:
+            healthy = [r for r in self.replicas
+                       if r.healthy and r not in exclude]
+            if not healthy:
+                return None
+            total = 0
+            best = None
+            for replica in healthy:
+                replica.current += replica.weight
+                total += replica.weight
+                if best is None or replica.current > best.current:
+                    best = replica
+            best.current -= total
+            return best
+
+    def connect_read(self):
+        tried = list()
+        while True:
+            replica = self.pick(tried)
+            if replica is None:
+                self.counts['primary'] += 1
+                return self.primary.connect()
+            try:
+                conn = replica.engine.connect()
+            except DBAPIError as e:
+                log.warning('replica %s unreachable, taking it out: %r',
+                            replica.name, e)
+                replica.healthy = False
+                tried.append(replica)
+                continue
+            self.counts['replica'] += 1
+            return conn
+
+    def check(self):
+        """Updates every replica's health and lag."""
+        for replica in self.replicas:
+            try:
+                with replica.engine.connect() as conn:
+                    lag = float(conn.execute(text(LAG)).scalar() or 0)
+            except DBAPIError as e:
+                if replica.healthy:
+                    log.warning('replica %s failed its check: %r',
+                                replica.name, e)
+                replica.healthy = False
+                continue
+            healthy = lag <= self.max_lag
+            if healthy != replica.healthy:
+                log.warning('replica %s %s (%.1f s behind)', replica.name,
+                            'back' if healthy else 'lagging, taking it out',
+                            lag)
+            replica.lag = lag
+            replica.healthy = healthy
+
+    def start(self):
+        """Starts the health checks once per process (so again after a fork)."""
+        if not self.replicas:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        checker = threading.Thread(target=self._check_loop,
+                                   name='replica-check')
+        checker.daemon = True
+        checker.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def _check_loop(self):
+        while not self._stopping.wait(self.check_interval):
+            try:
+                self.check()
+            except Exception:
+                log.exception('replica check failed')
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+
+def from_config(primary, creds, uri):
+    """
+    The Router for credentials.json's "replicas" settings; uri(user,
+    password, server) builds a server's database URI.
+    """
+    config = creds.get('replicas', {})
+    replicas = list()
+    for i, server in enumerate(config.get('servers', ())):
+        engine = make_engine(uri(server.get('db_user', creds['db_user']),
+                                 server.get('db_pass', creds['db_pass']),
+                                 server['db_server']),
+                             dict(creds, **server), gauges=False)
+        replicas.append(Replica(server['db_server'], engine,
+                                server.get('weight', 1)))
+    router = Router(primary, replicas,
+                    pin_seconds=config.get('pin_seconds', 5.0),
+                    check_interval=config.get('check_interval', 5.0),
+                    max_lag=config.get('max_lag', 10.0))
+    if replicas:
+        metrics.gauge('db_replicas_healthy', 'Replicas taking reads',
+                      lambda: sum(r.healthy for r in router.replicas))
+        metrics.gauge('db_replica_max_lag_seconds',
+                      'Replay lag of the furthest behind replica',
+                      lambda: max(r.lag for r in router.replicas))
+        for target in ('primary', 'replica'):
+            metrics.gauge('db_reads_%s' % target,
+                          'Read-only requests served by the %s' % target,
+                          lambda target=target: router.counts[target])
+    return router
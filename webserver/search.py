@@ -0,0 +1,97 @@
+"""
+Full-text search over locations, activities and reviews (/search).
+
+Each table gets a GIN index over a weighted tsvector expression
+(migration 6, see migrations.py). PostgreSQL keeps expression indexes up
+to date on every insert, so rows added by /locationadd, /activitycreate or
+/reviewsubmit are searchable at once. Queries must use exactly the indexed
+expressions below.
+
+Every word of the query matches as a prefix ("par fra" finds "Paris,
+France"). Each table contributes its own best :limit matches, ranked by
+ts_rank over all of its matches, so the overall top :limit is exact: it
+can only come from those. /search/suggest completes location and activity
+names from a prefix index.
+"""
+
+import re
+
+from queries import query
+
+MAX_WORDS = 8
+
+LOCATION_VECTOR = '''(setweight(to_tsvector('english', coalesce(location.name,
+        '')), 'A') ||
+    setweight(to_tsvector('english', coalesce(location.description, '')),
+        'B') ||
+    setweight(to_tsvector('english', coalesce(location.country, '')),
+        'C'))'''
+
+ACTIVITY_VECTOR = '''(setweight(to_tsvector('english', coalesce(activity.name,
+        '')), 'A') ||
+    setweight(to_tsvector('english', coalesce(activity.description, '')),
+        'B'))'''
+
+REVIEW_VECTOR = '''to_tsvector('english', coalesce(reviews.comment, ''))'''
+
+TSQUERY = "to_tsquery('english', CAST(:query AS text))"
+
+# [kind, lid, title, detail, rank], best first
+SEARCH = query('search', '''WITH locations AS (SELECT 'location' AS kind,
+            lid, name AS title, country AS detail,
+            ts_rank(%(location)s, %(q)s) AS rank
+        FROM location WHERE %(location)s @@ %(q)s
+        ORDER BY rank DESC, title LIMIT :limit),
+    activities AS (SELECT 'activity' AS kind, CAST(NULL AS integer) AS lid,
+            name AS title, description AS detail,
+            ts_rank(%(activity)s, %(q)s) AS rank
+        FROM activity WHERE %(activity)s @@ %(q)s
+        ORDER BY rank DESC, title LIMIT :limit),
+    review_hits AS (SELECT 'review' AS kind, location.lid,
+            location.name AS title, comment AS detail,
+            ts_rank(%(review)s, %(q)s) AS rank
+        FROM reviews JOIN location ON location.lid = reviews.lid
+        WHERE %(review)s @@ %(q)s
+        ORDER BY rank DESC, title LIMIT :limit)
+SELECT * FROM locations
+UNION ALL SELECT * FROM activities
+UNION ALL SELECT * FROM review_hits
+ORDER BY rank DESC, title LIMIT :limit''' % dict(
+    location=LOCATION_VECTOR, activity=ACTIVITY_VECTOR,
+    review=REVIEW_VECTOR, q=TSQUERY))
+
+SUGGEST = query('search_suggest', '''(SELECT name FROM location
+        WHERE lower(name) LIKE :prefix ORDER BY lower(name) LIMIT :limit)
+    UNION (SELECT name FROM activity
+        WHERE lower(name) LIKE :prefix ORDER BY lower(name) LIMIT :limit)
+    ORDER BY 1 LIMIT :limit''')
+
+
+def tsquery(text):
+    """'par fra' -> 'par:* & fra:*', or None if there are no words."""
+    words = re.findall(r'\w+', text.lower(), re.UNICODE)[:MAX_WORDS]
+    if not words:
+        return None
+    return ' & '.join('%s:*' % word for word in words)
+
+
+def search(conn, text, limit=20):
+    terms = tsquery(text)
+    if terms is None:
+        return list()
+    res = SEARCH.execute(conn, query=terms, limit=limit)
+    rows = res.fetchall()
+    res.close()
+    return rows
+
+
+def suggest(conn, prefix, limit=10):
+    prefix = prefix.strip().lower()
+    if not prefix:
+        return list()
+    # LIKE wildcards in the prefix are matched literally
+    pattern = re.sub(r'([\\%_])', r'\\\1', prefix) + '%'
+    res = SUGGEST.execute(conn, prefix=pattern, limit=limit)
+    names = [row[0] for row in res]
+    res.close()
+    return names
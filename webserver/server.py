@@ -17,13 +17,38 @@ Read about it online.
 
 import os
 import json
-import math
-from math import radians
+import time
+import timeit
+STARTED = timeit.default_timer()  # boot time is reported by launcher.py
 from sqlalchemy import *
-from sqlalchemy.pool import NullPool
-from flask import Flask, request, render_template, g, redirect
+from flask import Flask, request, render_template, g, redirect, flash
 from flask import Response, session
 
+import bulk
+import companions
+import feed
+import graph
+import httpcache
+import instrument
+import jobs
+import leaderboard
+import metrics
+import migrations
+import pagination
+import parallel
+import profiles
+import queries
+import recommend
+import rentals
+import replicas
+import search
+import spatial
+import streaming
+import versions
+import writes
+from db import LazyConnection, make_engine
+from distance import nearest
+
 with open('credentials.json') as data_file:
     creds = json.load(data_file)
 DB_USER = creds['db_user']
@@ -45,37 +70,85 @@ app.secret_key = creds['secret_key']
 
 # Use the DB credentials you received by e-mail
 
-DATABASEURI = "postgresql://"+DB_USER+":"+DB_PASSWORD+"@"+DB_SERVER+"/w4111"
+def database_uri(user, password, server):
+    return "postgresql://"+user+":"+password+"@"+server+"/w4111"
+
+
+DATABASEURI = database_uri(DB_USER, DB_PASSWORD, DB_SERVER)
 
 
 #
-# Creates a database engine that knows how to connect to the URI above
+# Creates a database engine that knows how to connect to the URI above.
+# Connections come from a QueuePool sized by credentials.json / env, see db.py
 #
-engine = create_engine(DATABASEURI)
+engine = make_engine(DATABASEURI, creds)
 
+#
+# GET requests read from the replicas in credentials.json, if any, see
+# replicas.py
+#
+ROUTER = replicas.from_config(engine, creds, database_uri)
+versions.configure(ROUTER.primary)
 
-# Here we create a test table and insert some values in it
-engine.execute("""DROP TABLE IF EXISTS test;""")
-engine.execute("""CREATE TABLE IF NOT EXISTS test (
-    id serial,
-    name text
-);""")
-engine.execute("""INSERT INTO test(name) VALUES ('grace hopper'),
-    ('alan turing'), ('ada lovelace');""")
+#
+# Statements are named queries, prepared once per pooled connection,
+# see queries.py
+#
+queries.configure(creds)
 
+#
+# Follow-up work (feed fan-out) runs on background workers, see jobs.py
+#
+jobs.configure(engine, creds)
 
-def getMiles(lat1, long1, lat2, long2):
-    lat1 = radians(float(lat1))
-    long1 = radians(float(long1))
-    lat2 = radians(float(lat2))
-    long2 = radians(float(long2))
+#
+# Threads running a page's independent queries concurrently, see parallel.py
+#
+parallel.configure(creds)
 
-    d_lat = lat2 - lat1
-    d_lng = long2 - long1
-    temp = (math.sin(d_lat / 2) ** 2 + math.cos(lat1) *
-            math.cos(lat2) * math.sin(d_lng / 2) ** 2)
-    return round(
-        3963.0 * (2 * math.atan2(math.sqrt(temp), math.sqrt(1 - temp))), 2)
+#
+# Per-user home / friends / activities / reviews, see profiles.py
+#
+PROFILES = profiles.from_config(creds)
+
+#
+# Per-route latency, DB time, query/row counts and the slow query log,
+# all served at /metrics. See instrument.py
+#
+instrument.install(app, ROUTER.engines,
+                   instrument.slow_query_threshold(creds))
+
+
+def warm_indexes():
+    """
+    Loads the in-memory indexes (spatial.py, recommend.py, graph.py) up
+    front, so no request waits while one is built. The production launcher
+    runs it in the master, before forking the workers.
+    """
+    with engine.connect() as conn:
+        spatial.INDEX.load(conn)
+        recommend.RECOMMENDER.load(conn)
+        graph.GRAPH.load(conn)
+
+
+def init_db():
+    """
+    Creates the tables and indexes the app needs. Run once per deployment
+    (python server.py initdb) or by the development server at start, never
+    at import, so workers don't do DDL when they boot.
+    """
+    # Here we create a test table and insert some values in it
+    engine.execute("""DROP TABLE IF EXISTS test;""")
+    engine.execute("""CREATE TABLE IF NOT EXISTS test (
+        id serial,
+        name text
+    );""")
+    engine.execute("""INSERT INTO test(name) VALUES ('grace hopper'),
+        ('alan turing'), ('ada lovelace');""")
+
+    # Rating summary, rental date ranges, feed, job queue and the lookup
+    # indexes, each applied once, see migrations.py
+    migrations.migrate(engine)
 
 
 @app.before_request
@@ -83,24 +156,33 @@ def before_request():
     """
     This function is run at the beginning of every web request
     (every time you enter an address in the web browser).
-    Used to setup a database connection that can be used throughout the request
+    Used to setup a database connection that can be used throughout the request.
+    The connection is only checked out of the pool when a route first uses it.
 
     The variable g is globally accessible
     """
-    try:
-        g.conn = engine.connect()
-    except:
-        print("uh oh, problem connecting to database")
-        import traceback
-        traceback.print_exc()
-        g.conn = None
+    g.conn = LazyConnection(ROUTER.engine_for(request.method,
+                                              session.get('wrote_at')))
+    ROUTER.start()
+    jobs.ensure_started()
+
+
+@app.after_request
+def after_request(response):
+    """
+    Keeps the user on the primary for a while after a write, so the page
+    a POST redirects to reads its own write.
+    """
+    if ROUTER.replicas and request.method not in replicas.READ_METHODS:
+        session['wrote_at'] = time.time()
+    return response
 
 
 @app.teardown_request
 def teardown_request(exception):
     """
-    At the end of the web request, ensures the database connection is closed.
-    If you don't the database could run out of memory!
+    At the end of the web request, returns the database connection to the
+    pool. If you don't the database could run out of memory!
     """
     try:
         g.conn.close()
@@ -108,6 +190,14 @@ def teardown_request(exception):
         pass
 
 
+@app.route('/metrics')
+def metrics_text():
+    """
+    Prometheus text exposition of the counters in metrics.REGISTRY
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 #
 # @app.route is a decorator around index() that means:
 # run index() whenever a user tries to access the "/" path using a GET request
@@ -138,37 +228,54 @@ def index():
     """
     if ('uid' not in session or session['uid'] is None):
         return redirect('/login')
-    # DEBUG: this is debugging code to see what request looks like
-    print(request.args)
+    uid = session['uid']
+    lat, lng = session.get('home_lat'), session.get('home_long')
+    before = request.args.get('before', type=int)
+
+    # The three parts below don't depend on each other and run
+    # concurrently (see parallel.py), so they can't use session themselves
 
     #
     # example of a database query
     #
-    if ('home_name' not in session):
+    def home(conn):
         try:
-            cmd = '''SELECT name FROM LOCATION where lid=:user_home'''
-            res = g.conn.execute(text(cmd), user_home=session['home'])
-            session['home_name'] = res.fetchone()[0]
-            res.close()
+            return PROFILES.get(conn, uid, 'home')
         except:
-            pass
+            return None
 
     # Get friends
-    try:
-        cmd = '''SELECT friends.name, LOCATION.name, gps_lat, gps_long FROM
-                LOCATION join (SELECT * FROM USERS JOIN USER_FRIENDS on
-                USER_FRIENDS.uid_2 = USERS.uid  WHERE USER_FRIENDS.uid=:uid) as
-                friends on lid=home'''
-        res = g.conn.execute(text(cmd), uid=session['uid'])
-        data = list()
-        for row in res:
-            distance = getMiles(session['home_lat'], session['home_long'],
-                                row[2], row[3])
-            data.append([row[0], row[1], distance])
-        res.close()
-        data = sorted(data, key=lambda x: x[2])  # sort by distance
-    except:
-        pass
+    def friends(conn):
+        try:
+            # name, uid, home name, home lat, home long
+            rows = [row for row in PROFILES.get(conn, uid, 'friends')
+                    if row[3] is not None and row[4] is not None]
+            # all distances in one vectorized pass, sorted by distance
+            order, miles = nearest(lat, lng, [row[3] for row in rows],
+                                   [row[4] for row in rows])
+            miles = miles.tolist()
+            # friends in common, from the in-memory graph (graph.py)
+            mutual = graph.mutual_counts(conn, uid, [row[1] for row in rows])
+            return [[rows[i][0], rows[i][2], miles[i], mutual[i]]
+                    for i in order.tolist()]
+        except:
+            return list()
+
+    # What's new: the user's precomputed feed, a page at a time
+    def whats_new(conn):
+        try:
+            return feed.page(conn, uid, before=before)
+        except:
+            app.logger.exception('feed failed')
+            return list(), None
+
+    if 'home_name' in session:
+        data, (events, feed_next) = parallel.gather(friends, whats_new)
+    else:
+        found, data, (events, feed_next) = parallel.gather(home, friends,
+                                                           whats_new)
+        if found:
+            session['home_name'] = found[0][1]
 
     #
     # Flask uses Jinja templates, which is an extension to HTML where you can
@@ -197,7 +304,7 @@ def index():
     #         <div>{{n}}</div>
     #         {% endfor %}
     #
-    context = dict(data=data)
+    context = dict(data=data, events=events, feed_next=feed_next)
 
     #
     # render_template looks in the templates/ folder for files.
@@ -215,32 +322,33 @@ def index():
 #
 
 
+OTHER_ACTIVITIES = queries.query('other_activities', '''select name,
+    description from activity where name not in (select name from
+    user_activity natural join activity where uid=:uid)''')
+
+
 @app.route('/activity')
+@httpcache.cached_page(
+    lambda: ['activity',
+             PROFILES.version_name(session.get('uid'), 'activities')],
+    per_user=True)
 def activity():
     if ('uid' not in session or session['uid'] is None):
         return redirect('/login')
-    current_activities = list()
-    other_activities = list()
+    uid = session["uid"]
 
-    cmd = '''select name, description from user_activity natural join
-        activity where uid=:uid'''
-    try:
-        res = g.conn.execute(text(cmd), uid=session["uid"])
-        for row in res:
-            current_activities.append(row)
+    def others(conn):
+        res = OTHER_ACTIVITIES.execute(conn, uid=uid)
+        rows = res.fetchall()
         res.close()
-    except:
-        return redirect('/activity')
-    
-    cmd = '''select name, description from activity where name not in (select
-        name from user_activity natural join activity where uid=:uid);'''
+        return rows
+
+    # both at once, see parallel.py
     try:
-        res = g.conn.execute(text(cmd), uid=session["uid"])
-        for row in res:
-            other_activities.append(row)
-        res.close()
+        current_activities, other_activities = parallel.gather(
+            lambda conn: PROFILES.get(conn, uid, 'activities'), others)
     except:
-        return redirect('/activity')
+        return redirect('/')
 
     context = dict(current_activities=current_activities,
                    other_activities=other_activities)
@@ -249,13 +357,41 @@ def activity():
 
 @app.route('/activityadd/<activity>', methods=['POST'])
 def activityadd(activity):
-    cmd = '''INSERT INTO user_activity VALUES (:activity, :uid)'''
     try:
-        res = g.conn.execute(text(cmd), uid=session["uid"],
-                             activity=activity)
-        res.close()
+        writes.execute(g.conn, writes.ADD_ACTIVITY,
+                       dict(uid=session["uid"], activity=activity))
+        recommend.RECOMMENDER.add_activity(session["uid"], activity)
+        versions.record(g.conn, 'user_activity',
+                        [[session["uid"], activity, True]])
+        PROFILES.invalidate(g.conn, session["uid"], 'activities')
+        companions.changed(g.conn, [session["uid"]])
     except:
-        pass
+        app.logger.exception('activityadd failed')
+
+    return redirect('/activity')
+
+
+@app.route('/activityaddbulk', methods=['POST'])
+def activityaddbulk():
+    """
+    Adds every checked activity (form field "activity", repeated)
+    in one round trip
+    """
+    activities = request.form.getlist('activity')
+    try:
+        if activities:
+            writes.execute(g.conn, writes.ADD_ACTIVITY,
+                           [dict(uid=session["uid"], activity=activity)
+                            for activity in activities])
+        for activity in activities:
+            recommend.RECOMMENDER.add_activity(session["uid"], activity)
+        versions.record(g.conn, 'user_activity',
+                        [[session["uid"], activity, True]
+                         for activity in activities])
+        PROFILES.invalidate(g.conn, session["uid"], 'activities')
+        companions.changed(g.conn, [session["uid"]])
+    except:
+        app.logger.exception('activityaddbulk failed')
 
     return redirect('/activity')
 
@@ -264,31 +400,36 @@ def activityadd(activity):
 def activitycreate():
     name = request.form['name']
     description = request.form['description']
-    if (description == '' or description is None):
-        cmd = '''INSERT INTO activity values (:name);
-            INSERT INTO user_activity VALUES (:name, :uid);'''
-    else:
-        cmd = '''INSERT INTO activity values (:name, :description);
-            INSERT INTO user_activity VALUES (:name, :uid);'''
+    if (description == ''):
+        description = None
     try:
-        res = g.conn.execute(text(cmd), name=name, description=description,
-                             uid=session["uid"])
-        res.close()
+        writes.execute(g.conn, writes.CREATE_ACTIVITY,
+                       dict(name=name, description=description,
+                            uid=session["uid"]))
+        recommend.RECOMMENDER.add_activity(session["uid"], name)
+        versions.record(g.conn, 'user_activity',
+                        [[session["uid"], name, True]])
+        PROFILES.invalidate(g.conn, session["uid"], 'activities')
+        httpcache.bump(g.conn, 'activity')
+        companions.changed(g.conn, [session["uid"]])
     except:
-        pass
+        app.logger.exception('activitycreate failed')
 
     return redirect('/activity')
 
 
 @app.route('/activityremove/<activity>', methods=['POST'])
 def activityremove(activity):
-    cmd = '''DELETE FROM user_activity WHERE uid=:uid and name=:activity'''
     try:
-        res = g.conn.execute(text(cmd), uid=session["uid"],
-                             activity=activity)
-        res.close()
+        writes.execute(g.conn, writes.REMOVE_ACTIVITY,
+                       dict(uid=session["uid"], activity=activity))
+        recommend.RECOMMENDER.remove_activity(session["uid"], activity)
+        versions.record(g.conn, 'user_activity',
+                        [[session["uid"], activity, False]])
+        PROFILES.invalidate(g.conn, session["uid"], 'activities')
+        companions.changed(g.conn, [session["uid"]])
     except:
-        pass
+        app.logger.exception('activityremove failed')
 
     return redirect('/activity')
 
@@ -296,91 +437,126 @@ def activityremove(activity):
 def friend():
     if ('uid' not in session or session['uid'] is None):
         return redirect('/login')
-    friends = list()
-    non_friends = list()
+    if streaming.requested(request.args):
+        # every friend and suggestion, sent as they are read
+        friends = streaming.rows(g.conn, profiles.PARTS['friends'],
+                                 uid=session["uid"])
+        non_friends = recommend.suggestion_stream(g.conn, session["uid"])
+        return streaming.render("friend.html", friends=friends,
+                                non_friends=non_friends, page=0,
+                                has_next=False,
+                                friends_of_friends=graph.suggestion_rows(
+                                    g.conn, session["uid"]))
+    uid = session["uid"]
+
+    # Suggestions come from the in-memory activity index, a page at a time
+    page = max(request.args.get('page', 0, type=int), 0)
+
+    # People the user's friends have added, from the friend graph
+    def second_hop(conn):
+        try:
+            return graph.suggestion_rows(conn, uid)
+        except:
+            app.logger.exception('friend of friend suggestions failed')
+            return list()
 
-    cmd = '''select name, users.uid from user_friends join users on uid_2=users.uid WHERE
-        user_friends.uid=:uid'''
+    # all three at once, see parallel.py
     try:
-        res = g.conn.execute(text(cmd), uid=session["uid"])
-        for row in res:
-            friends.append(row)
-        res.close()
+        friends, (non_friends, has_next), friends_of_friends = \
+            parallel.gather(
+                lambda conn: PROFILES.get(conn, uid, 'friends'),
+                lambda conn: recommend.suggestion_page(conn, uid, page=page),
+                second_hop)
     except:
-        return redirect('/friend')
-    
-    cmd = '''select * from (select * from users where uid not in (SELECT uid_2
-        from user_friends where uid = :uid)) as non_friends LEFT JOIN
-        (SELECT U.name, UA2.uid, COUNT(*) as "Activities in Common"
-        FROM USER_ACTIVITY as UA1, USER_ACTIVITY as UA2, Users as U
-        WHERE UA1.uid <> UA2.uid and UA1.name = UA2.name and
-        UA1.uid = :uid and U.uid = UA2.uid GROUP BY (UA1.uid, UA2.uid, U.name)
-        ORDER BY COUNT(*) DESC) as similarUSERS on non_friends.uid =
-        similarUSERS.uid WHERE non_friends.uid != :uid
-        ORDER by "Activities in Common";'''
-    try:
-        res = g.conn.execute(text(cmd), uid=session["uid"])
-        for row in res:
-            non_friends.append([row[0], row[3], row[8]])
-        res.close()
-    except:
-        return redirect('/friends')
+        return redirect('/')
 
     context = dict(friends=friends,
-                   non_friends=non_friends)
+                   non_friends=non_friends,
+                   friends_of_friends=friends_of_friends,
+                   page=page, has_next=has_next)
     return render_template("friend.html", **context)
 
 
 @app.route('/friendaddreq/<friend>', methods=['POST'])
 def friendaddreq(friend):
-    cmd = '''INSERT INTO user_friends VALUES(:uid, :uid_2);'''
     try:
-        res = g.conn.execute(text(cmd), uid=session["uid"],
-                             uid_2=friend)
-        res.close()
+        writes.execute(g.conn, writes.ADD_FRIEND,
+                       dict(uid=session["uid"], uid_2=friend))
+        recommend.RECOMMENDER.add_friend(session["uid"], friend)
+        graph.GRAPH.add(session["uid"], friend)
+        versions.record(g.conn, 'friends', [[session["uid"], friend, True]])
+        PROFILES.invalidate(g.conn, session["uid"], 'friends')
+        companions.changed(g.conn, [session["uid"]])
     except:
-        pass
+        app.logger.exception('friendaddreq failed')
+
+    return redirect('/friend')
+
+
+@app.route('/friendaddbulk', methods=['POST'])
+def friendaddbulk():
+    """
+    Adds every checked user (form field "friend", repeated) in one round trip
+    """
+    friends = request.form.getlist('friend')
+    try:
+        if friends:
+            writes.execute(g.conn, writes.ADD_FRIEND,
+                           [dict(uid=session["uid"], uid_2=friend)
+                            for friend in friends])
+        for friend in friends:
+            recommend.RECOMMENDER.add_friend(session["uid"], friend)
+            graph.GRAPH.add(session["uid"], friend)
+        versions.record(g.conn, 'friends', [[session["uid"], friend, True]
+                                            for friend in friends])
+        PROFILES.invalidate(g.conn, session["uid"], 'friends')
+        companions.changed(g.conn, [session["uid"]])
+    except:
+        app.logger.exception('friendaddbulk failed')
 
     return redirect('/friend')
 
 
 @app.route('/friendremovereq/<friend>', methods=['POST'])
 def friendremovereq(friend):
-    cmd = '''DELETE FROM user_friends WHERE uid=:uid and uid_2=:uid_2'''
     try:
-        res = g.conn.execute(text(cmd), uid=session["uid"],
-                             uid_2=friend)
-        res.close()
+        writes.execute(g.conn, writes.REMOVE_FRIEND,
+                       dict(uid=session["uid"], uid_2=friend))
+        recommend.RECOMMENDER.remove_friend(session["uid"], friend)
+        graph.GRAPH.remove(session["uid"], friend)
+        versions.record(g.conn, 'friends', [[session["uid"], friend, False]])
+        PROFILES.invalidate(g.conn, session["uid"], 'friends')
+        companions.changed(g.conn, [session["uid"]])
     except:
-        pass
+        app.logger.exception('friendremovereq failed')
 
     return redirect('/friend')
 
 
+def location_row(row):
+    avg_rating = row[6]
+    if avg_rating < 0.001:
+        avg_rating = "Not yet rated"
+    return [row[0], row[1], row[2], row[3], row[4], row[5], avg_rating]
+
+
 @app.route('/location')
+@httpcache.cached_page(lambda: ['location'])
 def location():
-    location = list()
-    cmd = '''SELECT max(lid), max(gps_lat), max(gps_long), max(name),
-        max(description), max(country),  AVG(coalesce(rating, 0)) AS avg from
-        (SELECT location.lid, gps_lat, gps_long, name, description, country,
-        rating FROM Location left Join Reviews on location.lid = reviews.lid)
-        as f group by lid order by avg DESC;'''
-
+    stream = streaming.requested(request.args)
     try:
-        res = g.conn.execute(text(cmd))
-        for row in res:
-            avg_rating = row[6]
-            if avg_rating < 0.001:
-                avg_rating = "Not yet rated"
-            location.append([row[0], row[1], row[2], row[3], row[4], row[5],
-                             avg_rating])
-        res.close()
-        res.close()
+        location = leaderboard.LEADERBOARD.page(g.conn, request.args,
+                                                transform=location_row,
+                                                stream=stream)
     except:
         return redirect('/')
 
-    context = dict(location=location)
-    return render_template("location.html", **context)
+    context = dict(location=location, page=location)
+    if stream:
+        return streaming.render("location.html", **context)
+    page = render_template("location.html", **context)
+    location.close()
+    return page
 
 
 @app.route('/locationadd', methods=['POST'])
@@ -390,49 +566,115 @@ def locationadd():
     name = request.form['name']
     desc = request.form['description']
     country = request.form['country']
-    cmd = '''INSERT INTO location(gps_lat, gps_long, name,
-        description, country) VALUES (:lat, :lng, :name, :desc, :country);
-        '''
     try:
-        res = g.conn.execute(text(cmd), lat=lat, lng=lng, name=name,
-                             desc=desc, country=country)
-        res.close()
+        with g.conn.begin():
+            res = leaderboard.ADD_LOCATION.execute(
+                g.conn, lat=lat, lng=lng, name=name, desc=desc,
+                country=country)
+            lid = res.scalar()
+        httpcache.bump(g.conn, 'location')
+        spatial.INDEX.add(lid, lat, lng)
+        versions.record(g.conn, 'location', [[lid, float(lat), float(lng)]])
     except:
         pass
 
     return redirect('/location')
 
 
+LOCATION_NAMES = queries.query('location_names', '''SELECT lid, name,
+    country FROM location WHERE lid = ANY(CAST(:lids AS integer[]))''')
+
+
+@app.route('/nearby')
+def nearby():
+    """
+    Locations within ?radius= miles (default 50) of ?lat=&long=, or of the
+    user's home when no point is given.
+    """
+    if ('uid' not in session or session['uid'] is None):
+        return redirect('/login')
+    lat = request.args.get('lat', session.get('home_lat'), type=float)
+    lng = request.args.get('long', session.get('home_long'), type=float)
+    radius = request.args.get('radius', 50.0, type=float)
+    if lat is None or lng is None:
+        return redirect('/location')
+
+    places = list()
+    try:
+        spatial.INDEX.load(g.conn)
+        hits = spatial.INDEX.within(lat, lng, radius, limit=100)
+        if hits:
+            res = LOCATION_NAMES.execute(g.conn,
+                                         lids=[hit[0] for hit in hits])
+            names = dict((row[0], row[1:]) for row in res)
+            res.close()
+            for lid, miles in hits:
+                name, country = names.get(lid, (None, None))
+                places.append([lid, name, country, miles])
+    except:
+        return redirect('/')
+
+    context = dict(places=places, lat=lat, lng=lng, radius=radius)
+    return render_template("nearby.html", **context)
+
+
+@app.route('/search')
+@httpcache.cached_page(lambda: ['location', 'activity', 'reviews'])
+def search_page():
+    """
+    Locations, activities and reviews matching ?q=, best first.
+    """
+    if ('uid' not in session or session['uid'] is None):
+        return redirect('/login')
+    q = request.args.get('q', '')
+    try:
+        results = search.search(g.conn, q)
+    except:
+        return redirect('/')
+
+    context = dict(q=q, results=results)
+    return render_template("search.html", **context)
+
+
+@app.route('/search/suggest')
+def search_suggest():
+    """
+    Location and activity names starting with ?q=, as a JSON list.
+    """
+    if ('uid' not in session or session['uid'] is None):
+        return Response('[]', status=401, mimetype='application/json')
+    names = search.suggest(g.conn, request.args.get('q', ''))
+    return Response(json.dumps(names), mimetype='application/json')
+
+
+LOGIN = queries.query('login', '''SELECT uid, users.name, profile_picture,
+    home, lid, location.name, gps_lat, gps_long FROM USERS LEFT JOIN LOCATION
+    on lid=home where email=:username and password=:password''')
+
+
 # Example of adding new data to the database
 @app.route('/loginreq', methods=['POST'])
 def loginreq():
     username = request.form['username']
     password = request.form['password']
-    cmd = '''SELECT COUNT(*), MIN(uid), MIN(name), MIN(profile_picture),
-        MIN(home) FROM USERS where email=:username and password=:password'''
     try:
-        res = g.conn.execute(text(cmd), username=username,
-                             password=password)
-        user = res.fetchone()
+        res = LOGIN.execute(g.conn, username=username, password=password)
+        users = res.fetchall()
         res.close()
-        if(user[0] == 1):
-            session['uid'] = user[1]
-            session['name'] = user[2]
-            session['profile_picture'] = user[3]
-            session['home'] = user[4]
+        if(len(users) == 1):
+            user = users[0]
+            session['uid'] = user[0]
+            session['name'] = user[1]
+            session['profile_picture'] = user[2]
+            session['home'] = user[3]
+            session['home_lat'] = user[6]
+            session['home_long'] = user[7]
+            if user[4] is not None:
+                session['home_name'] = user[5]
+                PROFILES.put(g.conn, user[0], 'home', [user[4:]])
     except:
         return redirect('/login')
 
-    cmd = '''SELECT gps_lat, gps_long FROM LOCATION where lid=:home'''
-    try:
-        res = g.conn.execute(text(cmd), home=session['home'])
-        loc = res.fetchone()
-        res.close()
-        session['home_lat'] = loc[0]
-        session['home_long'] = loc[1]
-    except:
-        pass
-
     return redirect('/')
 
 
@@ -449,24 +691,40 @@ def logout():
     return redirect('/login')
 
 
+RENTALS = pagination.Keyset('''select owner, address, start_date,
+    end_date, price from rental_lease
+    where start_date > CURRENT_DATE and owner <> :uid and %(seek)s
+    order by %(order)s limit :limit''',
+    keys=[('start_date', 2), ('owner', 0), ('address', 1)], name='rentals')
+
+
 @app.route('/rental')
 def rental():
     if ('uid' not in session or session['uid'] is None):
         return redirect('/login')
-    rentals = list()
-    
-    cmd = '''select * from rental_lease where start_date > CURRENT_DATE and
-        owner <> :uid;'''
+
+    # ?start=&end= narrows the list to leases free for all of those dates
+    start = request.args.get('start')
+    end = request.args.get('end')
+    stream = streaming.requested(request.args)
     try:
-        res = g.conn.execute(text(cmd), uid=session["uid"])
-        for row in res:
-            rentals.append(row)
-        res.close()
+        if start and end:
+            leases = rentals.AVAILABLE.page(g.conn, request.args,
+                                            stream=stream,
+                                            uid=session["uid"], start=start,
+                                            end=end)
+        else:
+            leases = RENTALS.page(g.conn, request.args, stream=stream,
+                                  uid=session["uid"])
     except:
         return redirect('/')
 
-    context = dict(rentals=rentals)
-    return render_template("rental.html", **context)
+    context = dict(rentals=leases, page=leases, start=start, end=end)
+    if stream:
+        return streaming.render("rental.html", **context)
+    page = render_template("rental.html", **context)
+    leases.close()
+    return page
 
 
 @app.route('/rentalrequest/<owner>/<address>/<start>/<end>')
@@ -482,38 +740,53 @@ def rentalrequest(owner, address, start, end):
 def rentalreq(owner, address, start, end):
     comment = request.form['comment']
 
-    cmd = '''INSERT INTO rental_request(requester, address, owner, comment,
-        start_date, end_data) VALUES(:uid, :address, :owner,
-        :comment, :start, :end)'''
+    # refused (nothing inserted) when no lease covers the dates or another
+    # request overlaps them, including one sent at the same moment
     try:
-        res = g.conn.execute(text(cmd), uid=session["uid"], address=address,
-                             owner=owner, start=start, end=end,
-                             comment=comment)
-        res.close()
+        requested = rentals.request(g.conn, session["uid"], owner, address,
+                                    start, end, comment)
     except:
         return redirect('/')
 
+    if requested:
+        try:
+            jobs.enqueue(g.conn, 'feed', event='rental',
+                         params=dict(uid=session["uid"], owner=owner,
+                                     address=address, start=start, end=end))
+        except:
+            app.logger.exception('rental feed failed')
+    else:
+        flash('%s is already requested for some of %s .. %s, or not '
+              'leased for all of it' % (address, start, end))
+
     return redirect('/rental')
 
+REVIEWS = pagination.Keyset('''select location.name, t.name, rating,
+    comment, location.lid, t.uid from (select * from reviews natural join
+    users) as t join location on t.lid = location.lid where %(seek)s
+    order by %(order)s limit :limit''',
+    keys=[('location.name', 0), ('location.lid', 4), ('t.uid', 5)],
+    name='reviews')
+
+
 @app.route('/reviews')
+@httpcache.cached_page(lambda: ['reviews'])
 def reviews():
     if ('uid' not in session or session['uid'] is None):
         return redirect('/login')
-    reviews = list()
-    
-    cmd = '''select location.name, t.name, rating, comment from (select * from
-        reviews natural join users) as t join location on t.lid = location.lid
-        order by location.name;'''
+
+    stream = streaming.requested(request.args)
     try:
-        res = g.conn.execute(text(cmd))
-        for row in res:
-            reviews.append(row)
-        res.close()
+        reviews = REVIEWS.page(g.conn, request.args, stream=stream)
     except:
         return redirect('/')
 
-    context = dict(reviews=reviews)
-    return render_template("reviews.html", **context)
+    context = dict(reviews=reviews, page=reviews)
+    if stream:
+        return streaming.render("reviews.html", **context)
+    page = render_template("reviews.html", **context)
+    reviews.close()
+    return page
 
 
 @app.route('/review/<lid>/<lname>')
@@ -526,40 +799,59 @@ def review(lid, lname):
     return render_template('/review.html', **context)
 
 
+ADD_REVIEW = queries.query('add_review', '''INSERT INTO reviews
+    VALUES(:rating, :comment, :uid, :lid)''')
+
+
 @app.route('/reviewsubmit/<lid>', methods=['POST'])
 def reviewsubmit(lid):
     rating = request.form['rating']
     comment = request.form['comment']
-    
-    cmd = '''INSERT INTO reviews VALUES(:rating, :comment, :uid, :lid)'''
+
     try:
-        res = g.conn.execute(text(cmd), rating=rating, comment=comment,
-                             uid=session["uid"], lid=lid)
-        res.close()
+        with g.conn.begin():
+            res = ADD_REVIEW.execute(g.conn, rating=rating, comment=comment,
+                                     uid=session["uid"], lid=lid)
+            res.close()
+            res = leaderboard.ADD_REVIEW.execute(g.conn, lid=lid,
+                                                 rating=rating)
+            res.close()
+        httpcache.bump(g.conn, 'location', 'reviews')
+        PROFILES.invalidate(g.conn, session["uid"], 'reviewed')
     except:
         return redirect('/trip')
 
+    try:
+        jobs.enqueue(g.conn, 'feed', event='review',
+                     params=dict(uid=session["uid"], lid=lid, rating=rating))
+    except:
+        app.logger.exception('review feed failed')
+
     return redirect('/trip')
 
 
+REQUESTS = pagination.Keyset('''select name, address, start_date,
+    end_data, comment, requester from rental_request join users on
+    requester=uid where owner=:uid and %(seek)s
+    order by %(order)s limit :limit''',
+    keys=[('start_date', 2), ('requester', 5), ('address', 1)],
+    name='requests')
+
+
 @app.route('/requests')
 def requests():
     if ('uid' not in session or session['uid'] is None):
         return redirect('/login')
-    requests = list()
 
-    cmd = '''select name, address, start_date, end_data, comment from
-        rental_request join users on requester=uid where owner=:uid;'''
     try:
-        res = g.conn.execute(text(cmd), uid=session["uid"])
-        for row in res:
-            requests.append(row)
-        res.close()
+        requests = REQUESTS.page(g.conn, request.args, uid=session["uid"])
     except:
         return redirect('/')
 
-    context = dict(requests=requests)
-    return render_template("requests.html", **context)
+    context = dict(requests=requests, page=requests)
+    page = render_template("requests.html", **context)
+    requests.close()
+    return page
 
 
 @app.route('/signup')
@@ -567,6 +859,11 @@ def signup():
     return render_template("signup.html")
 
 
+SIGNUP = queries.query('signup', '''INSERT INTO USERS(email, password,
+    name, profile_picture, home) VALUES
+    (:email, :password, :name, :profilepic, :home)''')
+
+
 @app.route('/signupreq', methods=['POST'])
 def signupreq():
     email = request.form['email']
@@ -575,11 +872,8 @@ def signupreq():
     profilepic = request.form['profilepic']
     home = request.form['home']
 
-    cmd = '''INSERT INTO USERS(email, password, name, profile_picture, home) VALUES
-        (:email, :password, :name, :profilepic, :home)'''
-
     try:
-        res = g.conn.execute(text(cmd), email=email, password=password,
+        res = SIGNUP.execute(g.conn, email=email, password=password,
                              name=name, profilepic=profilepic, home=home)
         res.close()
     except:
@@ -588,67 +882,92 @@ def signupreq():
     return redirect('/login')
 
 
+# upcoming and previous trips in one round trip, split on end_date
+TRIPS = queries.query('trips', '''select id, start_date, end_date, name,
+    location.lid, end_date >= CURRENT_DATE from trip join user_trip on
+    id = trip_id join location on trip.lid = location.lid where user_id=:uid
+    order by start_date ASC''')
+
+
 @app.route('/trip')
 def trip():
     if ('uid' not in session or session['uid'] is None):
         return redirect('/login')
+    uid = session["uid"]
     upcoming_trips = list()
     previous_trips = list()
 
-    cmd = '''select id, start_date, end_date, name from (select * from trip join
-             user_trip on id = trip_id where user_id=:uid and end_date >=
-             CURRENT_DATE) as tripList natural join location order by
-             start_date ASC;'''
-    try:
-        res = g.conn.execute(text(cmd), uid=session["uid"])
-        for row in res:
-            upcoming_trips.append(row)
+    def trips(conn):
+        res = TRIPS.execute(conn, uid=uid)
+        rows = res.fetchall()
         res.close()
-    except:
-        return redirect('/')
-    
-    cmd = '''select id, start_date, end_date, name, location.lid from (select * from trip join
-             user_trip on id = trip_id where user_id=:uid and end_date <
-             CURRENT_DATE) as tripList natural join location order by
-             start_date DESC;'''
-    try:
-        res = g.conn.execute(text(cmd), uid=session["uid"])
-        for row in res:
-            previous_trips.append(list(row))
-        res.close()
-    except:
-        return redirect('/')
+        return rows
 
-    cmd = '''select lid from reviews where uid=:uid;'''
+    def friend_rows(conn):
+        try:
+            return PROFILES.get(conn, uid, 'friends')
+        except:
+            return list()
+
+    # precomputed, see companions.py
+    def joinable_trips(conn):
+        try:
+            return companions.page(conn, uid)
+        except:
+            return list()
+
+    # all four at once, see parallel.py
     try:
-        res = g.conn.execute(text(cmd), uid=session["uid"])
-        rows = list(res)
-        for i in range(len(previous_trips)):
-            exists = False
-            for row in rows:
-                if(previous_trips[i][4] == row[0]):
-                    exists = True
-            previous_trips[i].append(exists)
-        print(previous_trips)
-        res.close()
+        reviewed, rows, friends, joinable = parallel.gather(
+            lambda conn: PROFILES.get(conn, uid, 'reviewed'), trips,
+            friend_rows, joinable_trips)
     except:
         return redirect('/')
+    reviewed = set(row[0] for row in reviewed)
+    for row in rows:
+        if row[5]:
+            upcoming_trips.append(row)
+        else:
+            previous_trips.append(list(row[:5]) + [row[4] in reviewed])
+    previous_trips.reverse()  # most recent first
 
     context = dict(upcoming_trips=upcoming_trips,
-                   previous_trips=previous_trips)
+                   previous_trips=previous_trips,
+                   friends=friends, joinable=joinable)
     return render_template("trip.html", **context)
 
 
 @app.route('/tripjoinreq', methods=['POST'])
 def tripjoinreq():
     trip_id = request.form['trip']
-    cmd = '''INSERT INTO user_trip VALUES (:id, :trip)'''
     try:
-        res = g.conn.execute(text(cmd), id=session["uid"],
-                             trip=trip_id)
-        res.close()
+        if writes.execute(g.conn, writes.JOIN_TRIP,
+                          dict(uid=session["uid"], trip=trip_id)):
+            jobs.enqueue(g.conn, 'feed', event='join',
+                         params=dict(uid=session["uid"], trip=trip_id))
+            companions.changed(g.conn, [session["uid"]], [trip_id])
     except:
-        pass
+        app.logger.exception('tripjoinreq failed')
+
+    return redirect('/trip')
+
+
+@app.route('/tripaddmembers', methods=['POST'])
+def tripaddmembers():
+    """
+    Puts every checked friend (form field "member", repeated) on a trip
+    the user is on, in one round trip
+    """
+    trip_id = request.form['trip']
+    members = request.form.getlist('member')
+    try:
+        if members:
+            writes.execute(g.conn, writes.ADD_TRIP_MEMBER,
+                           [dict(uid=session["uid"], trip=trip_id,
+                                 member=member) for member in members])
+            companions.changed(g.conn, members, [trip_id])
+    except:
+        app.logger.exception('tripaddmembers failed')
 
     return redirect('/trip')
 
@@ -656,13 +975,12 @@ def tripjoinreq():
 @app.route('/tripleavereq', methods=['POST'])
 def tripleavereq():
     trip_id = request.form['trip']
-    cmd = '''DELETE FROM user_trip WHERE user_id=:id and trip_id=:trip'''
     try:
-        res = g.conn.execute(text(cmd), id=session["uid"],
-                             trip=trip_id)
-        res.close()
+        if writes.execute(g.conn, writes.LEAVE_TRIP,
+                          dict(uid=session["uid"], trip=trip_id)):
+            companions.changed(g.conn, [session["uid"]], [trip_id])
     except:
-        pass
+        app.logger.exception('tripleavereq failed')
 
     return redirect('/trip')
 
@@ -672,15 +990,16 @@ def tripreq():
     start = request.form['start']
     end = request.form['end']
     location = request.form['location']
-    cmd = '''INSERT INTO trip(start_date, end_date, lid)
-        VALUES (:start, :end, :location);\
-        INSERT INTO USER_TRIP SELECT :uid, max(id) from trip;'''
     try:
-        res = g.conn.execute(text(cmd), start=start, end=end,
-                             location=location, uid=session["uid"])
-        res.close()
+        trip_id = writes.insert_returning(
+            g.conn, writes.CREATE_TRIP,
+            dict(start=start, end=end, location=location,
+                 uid=session["uid"]))
+        jobs.enqueue(g.conn, 'feed', event='trip',
+                     params=dict(uid=session["uid"], trip=trip_id))
+        companions.changed(g.conn, [session["uid"]], [trip_id])
     except:
-        pass
+        app.logger.exception('tripreq failed')
 
     return redirect('/trip')
 
@@ -688,26 +1007,137 @@ def tripreq():
 if __name__ == "__main__":
     import click
 
-    @click.command()
+    class DefaultGroup(click.Group):
+        """
+        Falls back to the run command, so "python server.py [HOST PORT]"
+        keeps working next to the subcommands.
+        """
+
+        def parse_args(self, ctx, args):
+            if not args or (args[0] not in self.commands and
+                            args[0] not in ('--help', '-h')):
+                args = ['run'] + list(args)
+            return super(DefaultGroup, self).parse_args(ctx, args)
+
+    @click.group(cls=DefaultGroup)
+    def cli():
+        """
+        This function handles command line parameters.
+        Show the help text using
+
+                python server.py --help
+
+        """
+
+    @cli.command()
     @click.option('--debug', is_flag=True)
     @click.option('--threaded', is_flag=True)
     @click.argument('HOST', default='0.0.0.0')
     @click.argument('PORT', default=8111, type=int)
     def run(debug, threaded, host, port):
         """
-        This function handles command line parameters.
-        Run the server using
+        Development server. Run the server using
 
                 python server.py
 
-        Show the help text using
-
-                python server.py --help
-
         """
 
         HOST, PORT = host, port
+        init_db()
         print("running on %s:%d" % (HOST, PORT))
+        warm_indexes()
         app.run(host=HOST, port=PORT, debug=debug, threaded=threaded)
 
-    run()
+    @cli.command()
+    def initdb():
+        """
+        Creates the tables and indexes the app needs.
+        """
+        init_db()
+
+    @cli.command()
+    @click.option('--to', 'target', default=None, type=int,
+                  help='stop after this version')
+    @click.option('--status', is_flag=True,
+                  help='list the migrations and when they were applied')
+    def migrate(target, status):
+        """
+        Applies the pending schema migrations (see migrations.py).
+        """
+        if not status:
+            for version in migrations.migrate(engine, target):
+                print("applied migration %d" % version)
+        for version, name, applied_at in migrations.status(engine):
+            print("%3d  %-28s %s" % (version, name, applied_at or 'pending'))
+
+    @cli.command('import')
+    @click.argument('TABLE', type=click.Choice(sorted(bulk.TABLES)))
+    @click.argument('SOURCE', type=click.File('r'))
+    @click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+                  default=None, help='default: from the file extension')
+    @click.option('--chunk', default=bulk.CHUNK, type=int,
+                  help='rows per COPY and merge')
+    @click.option('--rejects', type=click.File('w'), default=None,
+                  help='write the line number and reason of bad rows here')
+    def import_rows(table, source, fmt, chunk, rejects):
+        """
+        Loads a CSV or JSON lines file into a table with COPY, skipping
+        invalid and duplicate rows (see bulk.py).
+
+                python server.py import location places.csv --rejects bad.txt
+        """
+        if fmt is None:
+            fmt = 'jsonl' if source.name.endswith(('.jsonl', '.json')) \
+                else 'csv'
+        with engine.connect() as conn:
+            progress = bulk.import_file(
+                conn, bulk.TABLES[table], source, fmt, chunk, rejects,
+                report=lambda p: click.echo(str(p), err=True))
+        if progress.rejected and rejects is None:
+            click.echo('use --rejects to see why rows were rejected',
+                       err=True)
+
+    @cli.command('export')
+    @click.argument('TABLE', type=click.Choice(sorted(bulk.TABLES)))
+    @click.argument('TARGET', type=click.File('w'), default='-')
+    @click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+                  default='csv')
+    @click.option('--where', default=None,
+                  help='SQL condition on the rows to export')
+    def export_rows(table, target, fmt, where):
+        """
+        Streams a table out as CSV or JSON lines (to stdout by default).
+
+                python server.py export reviews --where "lid = 7" > 7.csv
+        """
+        query = bulk.TABLES[table].export
+        if where:
+            query = 'SELECT * FROM (%s) AS t WHERE %s' % (query, where)
+        with engine.connect() as conn:
+            bulk.export(conn, query, target, fmt)
+
+    @cli.command()
+    @click.option('--workers', default=None, type=int,
+                  help='worker processes (default: number of cores)')
+    @click.option('--threads', default=1, type=int,
+                  help='threads per worker')
+    @click.option('--max-requests', default=10000, type=int,
+                  help='recycle a worker after this many requests (0: never)')
+    @click.option('--max-rss-mb', default=None, type=int,
+                  help='recycle a worker once its RSS exceeds this')
+    @click.argument('HOST', default='0.0.0.0')
+    @click.argument('PORT', default=8111, type=int)
+    def serve(workers, threads, max_requests, max_rss_mb, host, port):
+        """
+        Production server: preforked workers sharing the preloaded app,
+        see launcher.py. Run "python server.py initdb" once first.
+
+                python server.py serve --workers 8 --max-rss-mb 300
+        """
+        import launcher
+        launcher.serve(app, ROUTER, host, port, workers=workers,
+                       threads=threads, max_requests=max_requests,
+                       max_rss_mb=max_rss_mb, started=STARTED,
+                       warm=warm_indexes)
+
+    cli()
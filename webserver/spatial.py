@@ -0,0 +1,156 @@
+"""
+Grid index over LOCATION.gps_lat/gps_long for "near me" searches.
+
+Locations are bucketed into cells of cell_deg x cell_deg degrees. A radius
+query only visits the cells overlapping the query's bounding box and then
+computes exact haversine distances (distance.miles_from) for the points in
+them, so it touches nearby rows only. The index is loaded from LOCATION on
+first use and /locationadd adds new locations to it, logging them as
+'location' changes that every other process replays (see versions.Watch).
+A bulk import of locations makes every process rebuild the index in the
+background.
+"""
+
+import math
+import threading
+from collections import defaultdict
+
+from sqlalchemy import text
+
+import versions
+from distance import EARTH_RADIUS_MILES, miles_from
+
+MILES_PER_DEGREE = EARTH_RADIUS_MILES * math.pi / 180
+
+
+def _cells():
+    return defaultdict(lambda: ([], [], []))  # lids, lats, longs
+
+
+class GridIndex(object):
+
+    def __init__(self, cell_deg=1.0, refresh=versions.POLL_SECONDS):
+        self.cell_deg = cell_deg
+        self.rows = int(math.ceil(180 / cell_deg))
+        self.cols = int(math.ceil(360 / cell_deg))
+        self.cells = _cells()
+        self.size = 0
+        self.loaded = False
+        self.watch = versions.Watch(['location'], refresh)
+        self._added = None  # adds made while a rebuild reads LOCATION
+        self._lock = threading.Lock()
+
+    def _cell(self, lat, lng):
+        row = min(int((lat + 90) // self.cell_deg), self.rows - 1)
+        col = int((lng + 180) // self.cell_deg) % self.cols
+        return row, col
+
+    def _put(self, cells, lid, lat, lng):
+        lids, lats, lngs = cells[self._cell(lat, lng)]
+        lids.append(lid)
+        lats.append(lat)
+        lngs.append(lng)
+
+    def _add(self, lid, lat, lng):
+        self._put(self.cells, lid, lat, lng)
+        self.size += 1
+
+    def _read(self, conn):
+        """(last change, cells, size) of LOCATION as it is now."""
+        seen = self.watch.snapshot(conn)
+        cells, size = _cells(), 0
+        res = conn.execute(text('''SELECT lid, gps_lat, gps_long
+            FROM location WHERE gps_lat IS NOT NULL
+            AND gps_long IS NOT NULL'''))
+        for lid, lat, lng in res:
+            self._put(cells, lid, float(lat), float(lng))
+            size += 1
+        res.close()
+        return seen, cells, size
+
+    def _adopt(self, seen, cells, size):
+        self.cells, self.size = cells, size
+        self.loaded = True
+        self.watch.built(seen)
+
+    def load(self, conn):
+        """
+        Fills the index from LOCATION on first use; later adds the
+        locations other processes added.
+        """
+        with self._lock:
+            if not self.loaded:
+                self._adopt(*self._read(conn))
+                return
+        self.watch.check(conn, self._rebuild, self._apply)
+
+    def _has(self, lid, lat, lng):
+        return lid in self.cells.get(self._cell(lat, lng), ((),))[0]
+
+    def _apply(self, name, change):
+        lid, lat, lng = change[0], float(change[1]), float(change[2])
+        with self._lock:
+            if not self._has(lid, lat, lng):
+                self._add(lid, lat, lng)
+            if self._added is not None:
+                self._added.append((lid, lat, lng))
+
+    def _rebuild(self, conn):
+        with self._lock:
+            self._added = list()
+        built = self._read(conn)
+        with self._lock:
+            added, self._added = self._added, None
+            self._adopt(*built)
+            # adds that committed after the read started
+            for lid, lat, lng in added:
+                if not self._has(lid, lat, lng):
+                    self._add(lid, lat, lng)
+
+    def add(self, lid, lat, lng):
+        with self._lock:
+            if self.loaded:
+                self._add(lid, float(lat), float(lng))
+                if self._added is not None:
+                    self._added.append((lid, float(lat), float(lng)))
+
+    def _candidate_cells(self, lat, lng, miles):
+        d_lat = miles / MILES_PER_DEGREE
+        lo_row, _ = self._cell(max(lat - d_lat, -90), 0)
+        hi_row, _ = self._cell(min(lat + d_lat, 90), 0)
+        # a degree of longitude shrinks with cos(latitude); near a pole, or
+        # for huge radii, every column is in the box
+        widest = max(abs(lat - d_lat), abs(lat + d_lat))
+        if widest >= 90 or d_lat / math.cos(math.radians(widest)) >= 180:
+            cols = range(self.cols)
+        else:
+            d_lng = d_lat / math.cos(math.radians(widest))
+            first = int((lng - d_lng + 180) // self.cell_deg)
+            last = int((lng + d_lng + 180) // self.cell_deg)
+            cols = set(c % self.cols for c in range(first, last + 1))
+        for row in range(lo_row, hi_row + 1):
+            for col in cols:
+                if (row, col) in self.cells:
+                    yield self.cells[(row, col)]
+
+    def within(self, lat, lng, miles, limit=None):
+        """
+        [lid, distance] for every location within miles of (lat, lng),
+        closest first (only the closest limit ones if given).
+        """
+        lat, lng = float(lat), float(lng)
+        lids, lats, lngs = list(), list(), list()
+        with self._lock:
+            for cell in self._candidate_cells(lat, lng, miles):
+                lids.extend(cell[0])
+                lats.extend(cell[1])
+                lngs.extend(cell[2])
+        if not lids:
+            return []
+        distances = miles_from(lat, lng, lats, lngs).tolist()
+        hits = sorted((d, lid) for d, lid in zip(distances, lids)
+                      if d <= miles)
+        return [[lid, d] for d, lid in hits[:limit]]
+
+
+INDEX = GridIndex()
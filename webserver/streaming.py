@@ -0,0 +1,61 @@
+"""
+Chunked responses for lists too long to build in memory.
+
+With ?stream=1, /reviews, /rental, /location and /friend send the whole
+list (from the ?after= cursor on) instead of one page. Rows are read from
+a server-side cursor (a psycopg2 named cursor, SQLAlchemy's stream_results)
+a fetch at a time, and the template is rendered as a generator:
+
+        rows = streaming.rows(g.conn, REVIEWS_QUERY, uid=uid)
+        return streaming.render('reviews.html', reviews=rows)
+
+so the first bytes go out before the query has finished and memory use
+doesn't depend on how many rows there are. A named cursor can't be
+declared over EXECUTE, so streamed queries run as plain text() rather than
+as prepared statements (see queries.py). The request context, and with it
+g.conn, lives until the last chunk is sent.
+"""
+
+from flask import Response, before_render_template, current_app
+from flask import stream_with_context, template_rendered
+
+FETCH_SIZE = 500  # rows per round trip from the server-side cursor
+BUFFER = 50       # template fragments per chunk written to the client
+
+
+def requested(args):
+    return args.get('stream', '').lower() in ('1', 'true', 'yes', 'on')
+
+
+def cursor(conn, fetch_size=FETCH_SIZE):
+    """conn with results streamed through a server-side cursor."""
+    return conn.execution_options(stream_results=True,
+                                  max_row_buffer=fetch_size)
+
+
+def rows(conn, cmd, fetch_size=FETCH_SIZE, **params):
+    """Yields the rows of the named query cmd a fetch at a time."""
+    res = cursor(conn, fetch_size).execute(cmd.text, **params)
+    try:
+        for row in res:
+            yield row
+    finally:
+        res.close()
+
+
+def render(template_name, **context):
+    """Like render_template(), but sends the page as it is rendered."""
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+
+    def generate():
+        # the signals let instrument.py time the render like any other
+        before_render_template.send(app, template=template, context=context)
+        stream = template.stream(context)
+        stream.enable_buffering(BUFFER)
+        for chunk in stream:
+            yield chunk
+        template_rendered.send(app, template=template, context=context)
+
+    return Response(stream_with_context(generate()), mimetype='text/html')
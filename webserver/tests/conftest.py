@@ -0,0 +1,11 @@
+"""
+Unit tests for the parts of the server that need no database:
+
+        cd webserver && python -m pytest -q tests
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
@@ -0,0 +1,92 @@
+import decimal
+import io
+
+import pytest
+
+import bulk
+
+
+def test_number_parses_and_checks_range():
+    lat = bulk.number(float, -90, 90)
+    assert lat('45.5') == 45.5
+    assert lat(-90) == -90.0
+    for value, message in (('91', 'out of range'), ('', 'missing'),
+                           (None, 'missing'), ('abc', 'not a number'),
+                           ('nan', 'not a number'), ('inf', 'not a number'),
+                           (True, 'not a number')):
+        with pytest.raises(bulk.Invalid) as e:
+            lat(value)
+        assert message in str(e.value)
+
+
+def test_integer_columns_refuse_fractions():
+    uid = bulk.number(int, 1)
+    assert uid('7') == 7
+    assert uid(7.0) == 7
+    with pytest.raises(bulk.Invalid, match='not an integer'):
+        uid(3.7)
+    with pytest.raises(bulk.Invalid, match='not a number'):
+        uid('3.7')
+    with pytest.raises(bulk.Invalid, match='out of range'):
+        uid(0)
+
+
+def test_optional_values():
+    assert bulk.number(decimal.Decimal, 0, required=False)('') is None
+    assert bulk.string(required=False)(None) is None
+    assert bulk.string()(12) == '12'
+    with pytest.raises(bulk.Invalid, match='missing'):
+        bulk.string()('')
+    with pytest.raises(bulk.Invalid, match='not a number'):
+        bulk.number(decimal.Decimal)('1,5')
+
+
+def test_date():
+    assert str(bulk.date('2024-02-29')) == '2024-02-29'
+    with pytest.raises(bulk.Invalid, match='YYYY-MM-DD'):
+        bulk.date('2023-02-29')
+
+
+def test_table_parse_names_the_column():
+    row = bulk.LOCATION.parse(dict(gps_lat='1', gps_long='2', name='Park'))
+    assert row == [1.0, 2.0, 'Park', None, None]
+    with pytest.raises(bulk.Invalid, match='^gps_long: 200.0 is out of '):
+        bulk.LOCATION.parse(dict(gps_lat='1', gps_long='200', name='Park'))
+
+
+def test_table_check():
+    lease = dict(owner='1', address='1 Main St', start_date='2024-05-02',
+                 end_date='2024-05-01')
+    with pytest.raises(bulk.Invalid, match='end_date is before start_date'):
+        bulk.RENTAL_LEASE.parse(lease)
+
+
+def test_csv_records_keep_their_line_numbers():
+    f = io.StringIO('name,comment\na,"two\nlines"\nb,x\n')
+    assert [(n, r['name']) for n, r in bulk.numbered(f, 'csv')] == \
+        [(3, 'a'), (4, 'b')]
+
+
+def test_chunks_report_rejects():
+    f = io.StringIO('{"uid": 1, "lid": 2, "rating": 5}\n'
+                    '\n'
+                    '{"uid": 1, "lid": 2, "rating": 9}\n'
+                    '[1, 2]\n'
+                    '{bad\n'
+                    '{"uid": 2, "lid": 3, "rating": 1, "comment": "ok"}\n')
+    progress = bulk.Progress()
+    rejects = io.StringIO()
+    chunks = list(bulk._chunks(bulk.REVIEWS, f, 'json', 1, progress,
+                               rejects))
+    assert chunks == [[[1, 2, 5, None]], [[2, 3, 1, 'ok']]]
+    assert (progress.read, progress.rejected) == (5, 3)
+    lines = rejects.getvalue().splitlines()
+    assert [line.split('\t')[0] for line in lines] == ['3', '4', '5']
+    assert lines[0].endswith('rating: 9 is out of range')
+    assert lines[1].endswith('not an object')
+    assert 'bad JSON' in lines[2]
+
+
+def test_fields_are_quoted_for_copy():
+    assert bulk._field(None) == ''
+    assert bulk._field('say "hi", ok') == '"say ""hi"", ok"'
@@ -0,0 +1,56 @@
+from cache import TTLCache
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_get_and_expiry():
+    clock = Clock()
+    cache = TTLCache(maxsize=4, ttl=10, clock=clock)
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    clock.now = 9.9
+    assert cache.get('a') == 1
+    clock.now = 10
+    assert cache.get('a') is None
+    assert cache.get('a', 'gone') == 'gone'
+    assert (cache.hits, cache.misses) == (2, 2)
+    assert len(cache) == 0
+
+
+def test_set_restarts_the_ttl():
+    clock = Clock()
+    cache = TTLCache(ttl=10, clock=clock)
+    cache.set('a', 1)
+    clock.now = 8
+    cache.set('a', 2)
+    clock.now = 15
+    assert cache.get('a') == 2
+
+
+def test_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=60, clock=Clock())
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+    assert len(cache) == 2
+
+
+def test_delete_and_clear():
+    cache = TTLCache(clock=Clock())
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.delete('a')
+    cache.delete('missing')
+    assert cache.get('a') is None
+    cache.clear()
+    assert len(cache) == 0
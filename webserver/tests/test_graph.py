@@ -0,0 +1,112 @@
+import numpy as np
+
+import graph
+
+
+def make(edges, **kwargs):
+    g = graph.FriendGraph(**kwargs)
+    g.build([u for u, _ in edges], [v for _, v in edges])
+    g.loaded = True
+    return g
+
+
+def edges_of(g):
+    uids = set(g.ids.tolist()) | set(g.added)
+    return set((u, int(v)) for u in uids for v in g.friends(u))
+
+
+def test_csr_rows_are_sorted_slices():
+    ids, indptr, indices = graph._csr([3, 1, 3, 1], [1, 30, 2, 2])
+    assert ids.tolist() == [1, 2, 3, 30]
+    assert indptr.tolist() == [0, 2, 2, 4, 4]
+    assert ids[indices].tolist() == [2, 30, 1, 2]
+
+
+def test_gather_stops_at_max_paths():
+    indptr = np.array([0, 2, 5, 6])
+    indices = np.arange(6)
+    rows = np.array([0, 1, 2])
+    assert graph._gather(indptr, indices, rows, 100).tolist() == \
+        [0, 1, 2, 3, 4, 5]
+    # whole rows only
+    assert graph._gather(indptr, indices, rows, 4).tolist() == [0, 1]
+    assert graph._gather(indptr, indices, rows[:0], 4).tolist() == []
+
+
+def test_overlay_add_and_remove():
+    g = make([(1, 2), (1, 3), (2, 3)])
+    g.add(1, 4)
+    g.remove(1, 2)
+    assert g.friends(1).tolist() == [3, 4]
+    assert g.delta == 2
+    # undoing a patch empties the overlay again
+    g.add(1, 2)
+    g.remove(1, 4)
+    assert g.friends(1).tolist() == [2, 3]
+    assert g.delta == 0 and not g.added and not g.removed
+    # no-ops don't grow the overlay
+    g.add(1, 2)
+    g.remove(5, 6)
+    assert g.delta == 0
+
+
+def test_unloaded_graph_ignores_changes():
+    g = graph.FriendGraph()
+    g.add(1, 2)
+    assert g.friends(1).tolist() == [] and g.delta == 0
+
+
+def test_merge_keeps_the_edges():
+    g = make([(1, 2), (1, 3), (2, 3)])
+    g.add(1, 5)
+    g.add(7, 1)
+    g.remove(2, 3)
+    before = edges_of(g)
+    g.merge()
+    assert edges_of(g) == before == {(1, 2), (1, 3), (1, 5), (7, 1)}
+    assert g.delta == 0 and not g.added and not g.removed
+
+
+def test_merge_overtaken_by_a_rebuild_is_dropped(monkeypatch):
+    g = make([(1, 2)])
+    g.add(1, 3)
+    real = graph._csr
+
+    def rebuilt_meanwhile(sources, targets):
+        with monkeypatch.context() as m:
+            m.setattr(graph, '_csr', real)
+            g.build([1], [9])
+        return real(sources, targets)
+    monkeypatch.setattr(graph, '_csr', rebuilt_meanwhile)
+    g.merge()
+    assert edges_of(g) == {(1, 9)}
+
+
+def test_mutual_and_suggestions():
+    g = make([(1, 2), (1, 3), (2, 4), (3, 4), (3, 5), (2, 1), (4, 1)])
+    assert g.mutual(2, 3) == 1  # 4
+    # friends of 2 and 3, not 1 itself nor its friends
+    assert g.suggestions(1) == [[4, 2], [5, 1]]
+    g.add(2, 5)  # seen through the overlay
+    assert g.suggestions(1) == [[4, 2], [5, 2]]
+    assert g.suggestions(1, limit=1) == [[4, 2]]
+
+
+def test_replayed_changes():
+    g = make([(1, 2)])
+    g._apply('friends', [1, 3, True])
+    g._apply('friends', [1, 2, False])
+    assert g.friends(1).tolist() == [3]
+
+
+def test_changes_during_a_rebuild_survive(monkeypatch):
+    g = make([(1, 2)])
+
+    def read(conn, chunk=graph.CHUNK):
+        g.add(1, 3)  # committed while the table was being read
+        return 7, np.array([1, 1]), np.array([2, 4])
+    monkeypatch.setattr(g, '_read', read)
+    monkeypatch.setattr(g.watch, 'built', lambda seen: None)
+    g._rebuild(None)
+    assert g.friends(1).tolist() == [2, 3, 4]
+    assert g._log is None
@@ -0,0 +1,60 @@
+import metrics
+
+
+def test_histogram_buckets_are_cumulative():
+    h = metrics.Histogram('latency_seconds', 'Latency', labels=('route',),
+                          buckets=(0.1, 1.0))
+    h.observe(0.05, '/a')
+    h.observe(0.5, '/a')
+    h.observe(5, '/a')
+    assert h.render() == [
+        '# HELP latency_seconds Latency',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{route="/a",le="0.1"} 1',
+        'latency_seconds_bucket{route="/a",le="1.0"} 2',
+        'latency_seconds_bucket{route="/a",le="+Inf"} 3',
+        'latency_seconds_sum{route="/a"} 5.55',
+        'latency_seconds_count{route="/a"} 3',
+    ]
+
+
+def test_label_values_are_escaped():
+    h = metrics.Histogram('h', 'H', labels=('q',), buckets=())
+    h.observe(1, 'say "hi"')
+    assert 'h_count{q="say \\"hi\\""} 1' in h.render()
+
+
+def test_summary_quantiles():
+    s = metrics.Summary('s', 'S', window=100)
+    assert s.quantiles() == {0.5: 0.0, 0.95: 0.0, 0.99: 0.0}
+    for value in range(1, 101):
+        s.observe(value)
+    assert s.quantiles() == {0.5: 51, 0.95: 96, 0.99: 100}
+    lines = s.render()
+    assert 's{quantile="0.5"} 51' in lines
+    assert 's_count 100' in lines
+
+
+def test_summary_keeps_the_last_window():
+    s = metrics.Summary('s', 'S', window=2)
+    for value in (100, 1, 2):
+        s.observe(value)
+    assert s.quantiles()[0.99] == 2
+    assert 's_sum 103.0' in s.render()
+
+
+def test_gauge_reads_its_callback():
+    assert metrics.Gauge('g', 'G', lambda: 3).render() == [
+        '# HELP g G', '# TYPE g gauge', 'g 3']
+
+
+def test_failing_gauge_is_left_out():
+    assert metrics.Gauge('g', 'G', lambda: 1 / 0).render() == []
+
+
+def test_render_joins_the_registry(monkeypatch):
+    monkeypatch.setattr(metrics, 'REGISTRY', list())
+    metrics.gauge('a', 'A', lambda: 1)
+    metrics.gauge('b', 'B', lambda: 2)
+    assert metrics.render() == \
+        '# HELP a A\n# TYPE a gauge\na 1\n# HELP b B\n# TYPE b gauge\nb 2\n'
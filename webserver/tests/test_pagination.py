@@ -0,0 +1,97 @@
+import base64
+
+from werkzeug.datastructures import MultiDict
+
+import pagination
+
+
+def test_cursor_round_trip():
+    cursor = pagination.encode_cursor(['Café "Zoë"', 42, None])
+    assert pagination.decode_cursor(cursor) == ['Café "Zoë"', '42', None]
+
+
+def test_cursor_is_url_safe():
+    cursor = pagination.encode_cursor(['???>>>~~~' * 5])
+    assert set(cursor) <= set('abcdefghijklmnopqrstuvwxyz'
+                              'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_=')
+
+
+def test_foreign_cursors_are_rejected():
+    for cursor in ('not base64!', base64.urlsafe_b64encode(b'{"a": 1}'),
+                   base64.urlsafe_b64encode(b'not json'), '', 'é'):
+        assert pagination.decode_cursor(cursor) is None
+
+
+def test_page_size_is_clamped():
+    assert pagination.page_size(MultiDict()) == pagination.DEFAULT_PAGE_SIZE
+    assert pagination.page_size(MultiDict({'per_page': '10'})) == 10
+    assert pagination.page_size(MultiDict({'per_page': '0'})) == 1
+    assert pagination.page_size(MultiDict({'per_page': '100000'})) == \
+        pagination.MAX_PAGE_SIZE
+    assert pagination.page_size(MultiDict({'per_page': 'x'})) == \
+        pagination.DEFAULT_PAGE_SIZE
+
+
+def test_seek_conditions():
+    keyset = pagination.Keyset(
+        'SELECT a, b FROM t WHERE %(seek)s ORDER BY %(order)s LIMIT :limit',
+        keys=[('a', 0), ('b', 1)], descending=True)
+    first = keyset._compiled[(False, True)].sql
+    after = keyset._compiled[(True, True)].sql
+    before = keyset._compiled[(True, False)].sql
+    assert 'WHERE TRUE ORDER BY a DESC, b DESC' in first
+    assert 'WHERE (a, b) < (:k0, :k1) ORDER BY a DESC, b DESC' in after
+    assert 'WHERE (a, b) > (:k0, :k1) ORDER BY a ASC, b ASC' in before
+    assert keyset.row_key(('x', 'y', 'z')) == ['x', 'y']
+
+
+class Result(object):
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def fetchmany(self, n):
+        return self.rows[:n]
+
+    def close(self):
+        self.closed = True
+
+
+KEYSET = pagination.Keyset(
+    'SELECT n FROM t WHERE %(seek)s ORDER BY %(order)s LIMIT :limit',
+    keys=[('n', 0)])
+
+
+def test_page_forward():
+    result = Result([(1,), (2,), (3,)])
+    page = pagination.Page(KEYSET, result, 2, True, True, None)
+    assert list(page) == [(1,), (2,)]
+    assert (page.has_prev, page.has_next) == (True, True)
+    assert pagination.decode_cursor(page.next_cursor) == ['2']
+    assert pagination.decode_cursor(page.prev_cursor) == ['1']
+    assert result.closed
+
+
+def test_last_page():
+    page = pagination.Page(KEYSET, Result([(1,), (2,)]), 2, True, False,
+                           lambda row: row[0] * 10)
+    assert list(page) == [10, 20]
+    assert (page.has_prev, page.has_next) == (False, False)
+
+
+def test_page_backward_is_reversed():
+    # a ?before= query reads the rows nearest the cursor first
+    page = pagination.Page(KEYSET, Result([(5,), (4,), (3,)]), 2, False,
+                           True, None)
+    assert list(page) == [(4,), (5,)]
+    assert (page.has_prev, page.has_next) == (True, True)
+
+
+def test_empty_page_has_no_cursors():
+    page = pagination.Page(KEYSET, Result([]), 2, True, False, None)
+    assert list(page) == []
+    assert page.next_cursor is None and page.prev_cursor is None
@@ -0,0 +1,79 @@
+from collections import defaultdict
+
+import recommend
+
+
+def make(activities, friends=(), **kwargs):
+    r = recommend.Recommender(**kwargs)
+    r.loaded = True
+    for uid, name in activities:
+        r.add_activity(uid, name)
+    for uid, other in friends:
+        r.add_friend(uid, other)
+    return r
+
+
+ACTIVITIES = [(1, 'chess'), (1, 'golf'), (1, 'rowing'),
+              (2, 'chess'), (2, 'golf'),
+              (3, 'chess'), (3, 'rowing'),
+              (4, 'chess'), (5, 'golf')]
+
+
+def test_ranked_by_activities_in_common():
+    r = make(ACTIVITIES)
+    assert r.ranked(1) == [[2, 2], [3, 2], [4, 1], [5, 1]]
+
+
+def test_friends_are_left_out():
+    r = make(ACTIVITIES, friends=[(1, 3)])
+    assert r.ranked(1) == [[2, 2], [4, 1], [5, 1]]
+    r.remove_friend(1, 3)
+    assert [3, 2] in r.ranked(1)
+
+
+def test_pages():
+    r = make(ACTIVITIES)
+    assert r.suggestions(1, page=0, per_page=3) == (
+        [[2, 2], [3, 2], [4, 1]], True)
+    assert r.suggestions(1, page=1, per_page=3) == ([[5, 1]], False)
+    assert r.suggestions(99) == ([], False)
+
+
+def test_removed_activity():
+    r = make(ACTIVITIES)
+    r.remove_activity(2, 'golf')
+    assert r.ranked(1)[0] == [3, 2]
+    assert r.members['golf'] == {1, 5}
+
+
+def test_max_paths_starts_with_the_rarest_activity():
+    r = make(ACTIVITIES, max_paths=2)
+    # rowing (2 members) is counted, chess and golf (3 and 4) are not
+    assert r.ranked(1) == [[3, 1]]
+
+
+def test_replayed_changes():
+    r = make(ACTIVITIES)
+    r._apply('user_activity', ['4', 'golf', True])
+    r._apply('friends', ['1', '2', True])
+    assert r.ranked(1) == [[3, 2], [4, 2], [5, 1]]
+
+
+def test_unloaded_recommender_ignores_changes():
+    r = recommend.Recommender()
+    r.add_activity(1, 'chess')
+    assert not r.activities
+
+
+def test_changes_during_a_rebuild_survive(monkeypatch):
+    r = make(ACTIVITIES)
+
+    def read(conn):
+        r.add_activity(6, 'chess')  # committed while the tables were read
+        members = defaultdict(set, chess={1, 2})
+        activities = defaultdict(set, {1: {'chess'}, 2: {'chess'}})
+        return 7, members, activities, defaultdict(set)
+    monkeypatch.setattr(r, '_read', read)
+    monkeypatch.setattr(r.watch, 'built', lambda seen: None)
+    r._rebuild(None)
+    assert r.ranked(1) == [[2, 1], [6, 1]]
@@ -0,0 +1,72 @@
+import random
+
+import distance
+import spatial
+
+
+def make(points, **kwargs):
+    index = spatial.GridIndex(**kwargs)
+    index.loaded = True
+    for lid, lat, lng in points:
+        index.add(lid, lat, lng)
+    return index
+
+
+def brute_force(points, lat, lng, miles):
+    lids, lats, lngs = zip(*points)
+    distances = distance.miles_from(lat, lng, lats, lngs).tolist()
+    return sorted(lid for lid, d in zip(lids, distances) if d <= miles)
+
+
+def test_matches_a_full_scan():
+    rng = random.Random(7)
+    points = [(i, rng.uniform(-90, 90), rng.uniform(-180, 180))
+              for i in range(3000)]
+    index = make(points, cell_deg=2.0)
+    for _ in range(50):
+        lat, lng = rng.uniform(-90, 90), rng.uniform(-180, 180)
+        miles = rng.choice((10, 200, 1500))
+        found = sorted(lid for lid, _ in index.within(lat, lng, miles))
+        assert found == brute_force(points, lat, lng, miles)
+
+
+def test_crosses_the_antimeridian_and_poles():
+    points = [(1, 0.0, 179.9), (2, 0.0, -179.9), (3, 89.9, 0.0),
+              (4, 89.9, 180.0), (5, -89.99, 90.0)]
+    index = make(points)
+    assert sorted(l for l, _ in index.within(0, 179.95, 20)) == [1, 2]
+    assert sorted(l for l, _ in index.within(89.95, 90, 50)) == [3, 4]
+    assert [l for l, _ in index.within(-90, 0, 5)] == [5]
+
+
+def test_closest_first_and_limit():
+    index = make([(1, 0, 0.2), (2, 0, 0.1), (3, 0, 0.3), (4, 10, 10)])
+    rows = index.within(0, 0, 100, limit=2)
+    assert [lid for lid, _ in rows] == [2, 1]
+    assert rows[0][1] < rows[1][1]
+    assert index.within(50, 50, 1) == []
+
+
+def test_replayed_locations_are_not_added_twice():
+    index = make([(1, 10, 10)])
+    index._apply('location', [1, '10', '10'])
+    index._apply('location', [2, 10.5, 10.5])
+    index._apply('location', [2, 10.5, 10.5])
+    assert index.size == 2
+    assert sorted(l for l, _ in index.within(10, 10, 100)) == [1, 2]
+
+
+def test_adds_during_a_rebuild_survive(monkeypatch):
+    index = make([(1, 0, 0)])
+
+    def read(conn):
+        index.add(2, 1, 1)  # committed while LOCATION was being read
+        cells = spatial._cells()
+        for lid, lat, lng in ((1, 0, 0), (2, 1, 1), (3, 2, 2)):
+            index._put(cells, lid, lat, lng)
+        return 7, cells, 3
+    monkeypatch.setattr(index, '_read', read)
+    monkeypatch.setattr(index.watch, 'built', lambda seen: None)
+    index._rebuild(None)
+    assert index.size == 3
+    assert sorted(l for l, _ in index.within(1, 1, 500)) == [1, 2, 3]
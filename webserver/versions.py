@@ -0,0 +1,230 @@
+"""
+Data versions shared by every server process.
+
+DATA_VERSION keeps one counter per name of data that something caches
+('location', 'reviews', 'activities:<uid>' ...). Routes that change the
+data bump() its names in the database, so every process sees the change;
+whatever caches it (rendered pages in httpcache.py, profiles.py) compares
+current() with the versions it was built from. The table is
+created by migration 9 (see migrations.py).
+
+The in-memory indexes (spatial.py, recommend.py, graph.py) follow a log
+of changes instead. A route that patches an index in its own process also
+record()s the change in DATA_CHANGE (migration 10), and a Watch in every
+other process replays it: at most every POLL_SECONDS it reads the changes
+logged since the last one it saw, skipping the ones its own process made,
+and applies them to the index. Only a reload() (what bulk imports log),
+more than MAX_CHANGES changes at once, or a process that stopped following
+the log for longer than it is kept (KEEP_SECONDS) make it rebuild the
+index from the database, on a thread of its own while the old copy keeps
+serving.
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+import jobs
+from queries import query
+
+POLL_SECONDS = 5     # between reads of the change log, per index
+KEEP_SECONDS = 3600  # changes older than this are pruned
+MAX_CHANGES = 10000  # more pending than this and the index is rebuilt
+SETTLE_SECONDS = 1   # see CHANGES
+
+PRIMARY = None  # see configure()
+
+log = logging.getLogger('versions')
+
+BUMP = query('bump_versions', '''INSERT INTO data_version AS v (name, version)
+    SELECT name, 1 FROM unnest(CAST(:names AS text[])) AS name ORDER BY name
+    ON CONFLICT (name) DO UPDATE SET version = v.version + 1''')
+
+CURRENT = query('data_versions', '''SELECT name, version FROM data_version
+    WHERE name = ANY(CAST(:names AS text[]))''')
+
+RECORD = query('record_changes', '''INSERT INTO data_change (name, origin, body)
+    SELECT :name, :origin, CAST(body AS json)
+    FROM unnest(CAST(:bodies AS text[])) WITH ORDINALITY AS b (body, i)
+    ORDER BY i''')
+
+# A row's seq is taken when it is inserted but it shows up when it commits,
+# so a later seq can be seen first; rows are only read once they are
+# SETTLE_SECONDS old, by when the earlier ones have committed too
+CHANGES = query('data_changes', '''SELECT seq, name, origin, body
+    FROM data_change WHERE seq > :since
+    AND name = ANY(CAST(:names AS text[]))
+    AND created_at < clock_timestamp()
+        - CAST(:settle AS double precision) * interval '1 s'
+    ORDER BY seq LIMIT :limit''')
+
+LAST_CHANGE = query('data_change_last', '''SELECT coalesce(max(seq), 0)
+    FROM data_change''')
+
+PRUNE = query('data_change_prune', '''DELETE FROM data_change
+    WHERE created_at < clock_timestamp()
+        - interval '1 s' * CAST(:keep AS double precision)''')
+
+
+def bump(conn, *names):
+    """Marks the data behind names as changed."""
+    # sorted, so concurrent bumps lock the rows in the same order
+    res = BUMP.execute(conn, names=sorted(set(names)))
+    res.close()
+
+
+def current(conn, names):
+    """{name: version} for names; 0 for data never changed."""
+    res = CURRENT.execute(conn, names=list(names))
+    found = dict(res.fetchall())
+    res.close()
+    return dict((name, found.get(name, 0)) for name in names)
+
+
+def configure(primary):
+    """Sets the engine of the primary, which latest() reads."""
+    global PRIMARY
+    PRIMARY = primary
+
+
+def on_primary(conn):
+    """Whether conn (a db.LazyConnection or a Connection) is the primary's."""
+    source = getattr(conn, 'source', None)
+    return PRIMARY is None or source is None or source is PRIMARY
+
+
+def latest(conn, names):
+    """
+    current() as the primary sees it, on conn if that is the primary's
+    and on a connection of the primary's own otherwise: a replica can be
+    behind.
+    """
+    if on_primary(conn):
+        return current(conn, names)
+    with PRIMARY.connect() as primary:
+        return current(primary, names)
+
+
+def origin():
+    """This process, as the origin of the changes it records."""
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def record(conn, name, changes):
+    """
+    Logs changes (JSON values) to the index data called name, which this
+    process has already applied to its own copy.
+    """
+    res = RECORD.execute(conn, name=name, origin=origin(),
+                         bodies=[json.dumps(change) for change in changes])
+    res.close()
+
+
+def reload(conn, *names):
+    """Makes every process rebuild the indexes of names from the database."""
+    for name in names:
+        res = RECORD.execute(conn, name=name, origin='', bodies=['null'])
+        res.close()
+
+
+@jobs.job('data_change_prune', every=KEEP_SECONDS / 4)
+def prune(conn):
+    """The "data_change_prune" job: drops changes older than KEEP_SECONDS."""
+    res = PRUNE.execute(conn, keep=KEEP_SECONDS)
+    res.close()
+
+
+class Watch(object):
+    """
+    Keeps an in-memory copy of some tables up to date with the change log.
+    The copy reads snapshot() before it loads the tables and passes it to
+    built() once it uses them, then calls check() on every use.
+    """
+
+    def __init__(self, names, seconds=POLL_SECONDS):
+        self.names = list(names)
+        self.seconds = seconds
+        self.since = None  # the last change applied
+        self.checked_at = 0.0
+        self._running = False
+        self._lock = threading.Lock()
+
+    def snapshot(self, conn):
+        res = LAST_CHANGE.execute(conn)
+        since = res.scalar()
+        res.close()
+        return since
+
+    def built(self, since):
+        with self._lock:
+            self.since = since
+            self.checked_at = time.time()
+
+    def _claim(self):
+        """(since, seconds since the last check), or None if not due."""
+        with self._lock:
+            now = time.time()
+            if self.since is None or self._running or \
+                    now - self.checked_at < self.seconds:
+                return None
+            self._running = True
+            idle, self.checked_at = now - self.checked_at, now
+            return self.since, idle
+
+    def check(self, conn, rebuild, apply):
+        """
+        Calls apply(name, change) for every change logged by other
+        processes since the last check, or starts rebuild(conn), with a
+        connection of its own, if replaying them won't do.
+        """
+        claim = self._claim()
+        if claim is None:
+            return
+        since, idle = claim
+        try:
+            rows = list()
+            if idle < KEEP_SECONDS - self.seconds:
+                res = CHANGES.execute(conn, since=since, names=self.names,
+                                      settle=SETTLE_SECONDS,
+                                      limit=MAX_CHANGES + 1)
+                rows = res.fetchall()
+                res.close()
+            if idle >= KEEP_SECONDS - self.seconds or \
+                    len(rows) > MAX_CHANGES or \
+                    any(row[3] is None for row in rows):
+                self._start(conn.engine, rebuild)
+                return
+            mine = origin()
+            for seq, name, source, body in rows:
+                if source != mine:
+                    apply(name, body)
+                since = seq
+            self.built(since)
+        except Exception:
+            log.exception('could not replay the changes of %s, rebuilding',
+                          ', '.join(self.names))
+            self._start(conn.engine, rebuild)
+            return
+        with self._lock:
+            self._running = False
+
+    def _start(self, engine, rebuild):
+        worker = threading.Thread(target=self._rebuild,
+                                  args=(engine, rebuild),
+                                  name='refresh-%s' % '-'.join(self.names))
+        worker.daemon = True
+        worker.start()
+
+    def _rebuild(self, engine, rebuild):
+        try:
+            with engine.connect() as conn:
+                rebuild(conn)
+        except Exception:
+            log.exception('could not rebuild the index of %s',
+                          ', '.join(self.names))
+        finally:
+            with self._lock:
+                self._running = False
@@ -0,0 +1,70 @@
+"""
+Write statements for the POST routes.
+
+Every write runs in an explicit transaction (execute()). Rows that need a
+generated key are created with INSERT ... RETURNING in the same statement
+as whatever references them, never with SELECT max(id), so concurrent
+users can't pick up each other's trips. The bulk routes pass a list of
+parameter dicts, which is sent as one executemany (psycopg2 batches it).
+The statements are named queries, see queries.py.
+"""
+
+from queries import query
+
+ADD_ACTIVITY = query('add_activity', '''INSERT INTO user_activity
+    VALUES (:activity, :uid) ON CONFLICT DO NOTHING''')
+
+REMOVE_ACTIVITY = query('remove_activity', '''DELETE FROM user_activity
+    WHERE uid=:uid and name=:activity''')
+
+CREATE_ACTIVITY = query('create_activity', '''WITH new AS (INSERT INTO
+        activity VALUES (:name, :description) RETURNING name)
+    INSERT INTO user_activity SELECT name, :uid FROM new''',
+    types=dict(uid='integer'))
+
+ADD_FRIEND = query('add_friend', '''INSERT INTO user_friends
+    VALUES (:uid, :uid_2) ON CONFLICT DO NOTHING''')
+
+REMOVE_FRIEND = query('remove_friend', '''DELETE FROM user_friends
+    WHERE uid=:uid and uid_2=:uid_2''')
+
+CREATE_TRIP = query('create_trip', '''WITH new AS (INSERT INTO
+        trip(start_date, end_date, lid)
+        VALUES (:start, :end, :location) RETURNING id)
+    INSERT INTO user_trip SELECT :uid, id FROM new RETURNING trip_id''',
+    types=dict(uid='integer'))
+
+JOIN_TRIP = query('join_trip', '''INSERT INTO user_trip VALUES (:uid, :trip)
+    ON CONFLICT DO NOTHING''')
+
+LEAVE_TRIP = query('leave_trip', '''DELETE FROM user_trip
+    WHERE user_id=:uid and trip_id=:trip''')
+
+# Only someone already on the trip can bring others along
+ADD_TRIP_MEMBER = query('add_trip_member', '''INSERT INTO user_trip
+    SELECT :member, :trip
+    WHERE EXISTS (SELECT 1 FROM user_trip
+                  WHERE user_id = :uid AND trip_id = :trip)
+    ON CONFLICT DO NOTHING''',
+    types=dict(member='integer', trip='integer', uid='integer'))
+
+
+def execute(conn, cmd, params):
+    """
+    Runs the query cmd in its own transaction, once with params if it is a
+    dict or once per dict (executemany) if it is a list. Returns the
+    rowcount.
+    """
+    with conn.begin():
+        res = cmd.execute(conn, params)
+        count = res.rowcount
+        res.close()
+    return count
+
+
+def insert_returning(conn, cmd, params):
+    """Runs a single INSERT ... RETURNING in a transaction, returns the key."""
+    with conn.begin():
+        res = cmd.execute(conn, params)
+        key = res.scalar()
+    return key